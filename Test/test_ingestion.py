@@ -1,5 +1,6 @@
 import io
 import json
+import os
 import pandas as pd
 import pytest
 from unittest.mock import patch, MagicMock
@@ -8,6 +9,14 @@ import src.process_lambda as process
 import src.warehousing_lambda as warehouse
 
 
+@pytest.fixture(autouse=True)
+def clear_warm_caches():
+    """Keep cached secrets, clients and connections from leaking between tests."""
+    ingestion.clear_caches()
+    yield
+    ingestion.clear_caches()
+
+
 def test_get_secret_returns_dict(monkeypatch):
     """Check secret parsing works with fake Secrets Manager response."""
 
@@ -40,37 +49,6 @@ def test_connect_to_original_database_success(monkeypatch):
         mock_connect.assert_called_once()
 
 
-def test_check_original_update_returns_latest(monkeypatch):
-    """Check latest date string is returned."""
-    mock_conn = MagicMock()
-    fake_df = pd.DataFrame({"last_updated": ["2025-09-11 12:00:00"]})
-
-    monkeypatch.setattr(
-        ingestion.wr.postgresql,
-        "read_sql_query",
-        lambda sql, con: fake_df,
-    )
-
-    date = ingestion.check_original_update("staff", mock_conn)
-    assert date == "2025-09-11 12:00:00"
-
-
-def test_get_original_updates_fetches_dataframe(monkeypatch):
-    """Check dataframe returned for updated rows."""
-    mock_conn = MagicMock()
-    fake_df = pd.DataFrame({"staff_id": [1], "first_name": ["Alice"]})
-
-    monkeypatch.setattr(
-        ingestion.wr.postgresql,
-        "read_sql_query",
-        lambda sql, con: fake_df,
-    )
-
-    df = ingestion.get_original_updates("staff", mock_conn, "2025-09-10 00:00:00")
-    assert not df.empty
-    assert "first_name" in df.columns
-
-
 def test_put_in_s3_calls_wr_s3(monkeypatch):
     """Check that wr.s3.to_csv is called."""
     fake_df = pd.DataFrame({"id": [1]})
@@ -103,3 +81,499 @@ def test_get_updates_table_creates_file(monkeypatch):
     updates = ingestion.get_updates_table(mock_client)
     assert isinstance(updates, dict)
     mock_client.put_object.assert_called_once()
+
+
+def test_ingest_table_skips_unchanged_table(monkeypatch):
+    """Check no extract or upload happens when the watermark is current."""
+    monkeypatch.setattr(ingestion, "check_all_original_updates", lambda c, tables: {t: "2025-09-10 00:00:00" for t in tables})
+    monkeypatch.setattr(ingestion, "get_original_updates_since", MagicMock())
+    monkeypatch.setattr(ingestion, "put_in_s3", MagicMock())
+
+    date = ingestion.ingest_table("staff", MagicMock(), "2025-09-10 00:00:00", "2025-09-11 12:00")
+    assert date is None
+    ingestion.get_original_updates_since.assert_not_called()
+    ingestion.put_in_s3.assert_not_called()
+
+
+def test_ingest_tables_concurrently_uses_connection_per_worker(monkeypatch):
+    """Check every worker gets its own connection and hands it back for reuse."""
+    opened = []
+
+    def fake_connect():
+        conn = MagicMock()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(ingestion, "connect_to_original_database", fake_connect)
+    monkeypatch.setattr(
+        ingestion,
+        "check_all_original_updates",
+        lambda c, tables: {
+            t: "2025-09-11 12:00:00" if t in ("staff", "currency") else "0000-00-00 00:00:00.0" for t in tables
+        },
+    )
+    monkeypatch.setattr(ingestion, "get_original_updates_since", lambda t, c, cutoff: pd.DataFrame({"id": [1]}))
+    uploaded = []
+    monkeypatch.setattr(ingestion, "put_in_s3", lambda t, d, time: uploaded.append(t))
+
+    updates = ingestion.ingest_tables_concurrently(dict(ingestion.DATA_UPDATES), "2025-09-11 12:00", max_workers=3)
+
+    assert updates == {"currency": "2025-09-11 12:00:00", "staff": "2025-09-11 12:00:00"}
+    assert sorted(uploaded) == ["currency", "staff"]
+    assert 1 <= len(opened) <= 3
+    assert len(ingestion._idle_connections) == len(opened)
+    for conn in opened:
+        conn.rollback.assert_called_once()
+        conn.close.assert_not_called()
+
+
+def test_check_all_original_updates_single_query(monkeypatch):
+    """Check one query probes every table and empty tables keep the default watermark."""
+    queries = []
+    fake_df = pd.DataFrame({
+        "table_name": ["staff", "currency"],
+        "last_updated": ["2025-09-11 12:00:00", None],
+    })
+
+    def fake_read_sql_query(sql, con):
+        queries.append(sql)
+        return fake_df
+
+    monkeypatch.setattr(ingestion.wr.postgresql, "read_sql_query", fake_read_sql_query)
+
+    latest = ingestion.check_all_original_updates(MagicMock(), ["staff", "currency"])
+    assert len(queries) == 1
+    assert "UNION ALL" in queries[0]
+    assert latest == {"staff": "2025-09-11 12:00:00", "currency": "0000-00-00 00:00:00.0"}
+
+
+def test_ingest_tables_serially_only_extracts_probed_tables(monkeypatch):
+    """Check the per-table probe is skipped when the batched probe already ran."""
+    monkeypatch.setattr(ingestion, "check_all_original_updates", MagicMock())
+    monkeypatch.setattr(ingestion, "get_original_updates_since", lambda t, c, cutoff: pd.DataFrame({"id": [1]}))
+    monkeypatch.setattr(ingestion, "put_in_s3", MagicMock())
+
+    updates = ingestion.ingest_tables_serially(
+        dict(ingestion.DATA_UPDATES),
+        "2025-09-11 12:00",
+        {"staff": "2025-09-11 12:00:00"},
+        MagicMock(),
+    )
+    assert updates == {"staff": "2025-09-11 12:00:00"}
+    ingestion.check_all_original_updates.assert_not_called()
+    ingestion.put_in_s3.assert_called_once()
+
+
+def test_parse_watermark_handles_initial_marker():
+    """Check the never-ingested marker sorts before any real timestamp."""
+    assert ingestion.parse_watermark("0000-00-00 00:00:00.0") < ingestion.parse_watermark("2025-09-11 12:00:00.5")
+    assert ingestion.parse_watermark("2025-09-11 12:00:00") < ingestion.parse_watermark("2025-09-11 12:00:00.5")
+
+
+def test_iter_original_update_pages_uses_keyset(monkeypatch):
+    """Check pages use bound typed parameters and resume after the last (last_updated, id) seen."""
+    calls = []
+    pages = [
+        pd.DataFrame({
+            "currency_id": [1, 2],
+            "currency_code": ["GBP", "USD"],
+            "last_updated": pd.to_datetime(["2025-09-11 12:00:00", "2025-09-11 12:00:00"]),
+        }),
+        pd.DataFrame({
+            "currency_id": [3],
+            "currency_code": ["EUR"],
+            "last_updated": pd.to_datetime(["2025-09-11 13:00:00"]),
+        }),
+    ]
+
+    def fake_read_sql_query(sql, con, params):
+        calls.append((sql, params))
+        return pages[len(calls) - 1]
+
+    monkeypatch.setattr(ingestion.wr.postgresql, "read_sql_query", fake_read_sql_query)
+
+    result = list(ingestion.iter_original_update_pages("currency", MagicMock(), "2025-09-10 00:00:00", page_size=2))
+
+    assert [len(page) for page, _ in result] == [2, 1]
+    assert list(result[0][0].columns) == ["currency_id", "currency_code"]
+    assert "::text" not in calls[0][0]
+    assert calls[0][1] == [ingestion.datetime(2025, 9, 10), 2]
+    assert "(last_updated, currency_id) > (%s, %s)" in calls[1][0]
+    assert calls[1][1] == [ingestion.datetime(2025, 9, 11, 12), 2, 2]
+    assert result[-1][1] == (ingestion.datetime(2025, 9, 11, 13), 3)
+
+
+def test_iter_original_update_batches_fetches_from_cursor():
+    """Check rows come from a declared server-side cursor in fixed-size batches."""
+    mock_conn = MagicMock()
+    cursor = mock_conn.cursor.return_value
+    cursor.fetchall.side_effect = [[(1, "GBP"), (2, "USD")], [(3, "EUR")], []]
+
+    batches = list(ingestion.iter_original_update_batches("currency", mock_conn, "2025-09-10 00:00:00", batch_size=2))
+
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert list(batches[0].columns) == ["currency_id", "currency_code"]
+    assert cursor.execute.call_args_list[0].args[0].startswith("DECLARE currency_updates")
+    assert cursor.execute.call_args_list[1].args[0] == "FETCH FORWARD 2 FROM currency_updates"
+    mock_conn.rollback.assert_called_once()
+
+
+def test_stream_to_s3_uses_multipart_for_large_deltas(monkeypatch):
+    """Check batches past the part size are uploaded as multipart parts with a single header."""
+    monkeypatch.setattr(ingestion.multipart, "MULTIPART_CHUNK_SIZE", 10)
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+    client.upload_part.side_effect = lambda **kwargs: {"ETag": f"etag-{kwargs['PartNumber']}"}
+
+    batches = [
+        pd.DataFrame({"currency_id": [1, 2], "currency_code": ["GBP", "USD"]}),
+        pd.DataFrame({"currency_id": [3], "currency_code": ["EUR"]}),
+    ]
+    ingestion.stream_to_s3(client, "currency", iter(batches), "2025-09-11 12:00")
+
+    bodies = [call.kwargs["Body"] for call in client.upload_part.call_args_list]
+    assert b"".join(bodies).decode() == "currency_id,currency_code\n1,GBP\n2,USD\n3,EUR\n"
+    client.complete_multipart_upload.assert_called_once()
+    assert client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"] == [
+        {"ETag": "etag-1", "PartNumber": 1},
+        {"ETag": "etag-2", "PartNumber": 2},
+    ]
+    client.put_object.assert_not_called()
+
+
+def test_stream_to_s3_small_delta_single_put():
+    """Check an empty delta is written as a header-only object without a multipart upload."""
+    client = MagicMock()
+
+    ingestion.stream_to_s3(client, "currency", iter([]), "2025-09-11 12:00")
+
+    client.create_multipart_upload.assert_not_called()
+    client.put_object.assert_called_once()
+    assert client.put_object.call_args.kwargs["Body"] == b"currency_id,currency_code\n"
+
+
+def test_column_types_cover_every_table():
+    """Check every extracted column has a declared ingest type."""
+    for table, columns in ingestion.TABLE_LIST.items():
+        assert set(ingestion.get_table_types(table)) == set(columns)
+
+
+def test_put_in_s3_parquet_format(monkeypatch):
+    """Check the parquet ingest format writes typed, zstd-compressed files."""
+    monkeypatch.setattr(ingestion, "INGEST_FORMAT", "parquet")
+    called = {}
+
+    def fake_to_parquet(df, path, index, compression, dtype):
+        called.update(path=path, compression=compression, dtype=dtype)
+
+    monkeypatch.setattr(ingestion.wr.s3, "to_parquet", fake_to_parquet)
+
+    ingestion.put_in_s3("currency", pd.DataFrame({"currency_id": [1], "currency_code": ["GBP"]}), "2025-09-11")
+    assert called["path"].endswith("currency/2025-09-11.parquet")
+    assert called["compression"] == "zstd"
+    assert called["dtype"] == {"currency_id": "bigint", "currency_code": "string"}
+
+
+def test_get_secret_is_cached_between_invocations():
+    """Check a warm invocation does not call Secrets Manager again."""
+    fake_response = {"SecretString": '"crigglestone":{"host":"localhost","port":5432,"database":"db","user":"u","password":"p"}'}
+    mock_client = MagicMock()
+    mock_client.get_secret_value.return_value = fake_response
+
+    with patch("boto3.client", return_value=mock_client) as mock_boto3_client:
+        assert ingestion.get_secret() == ingestion.get_secret()
+        mock_client.get_secret_value.assert_called_once()
+        mock_boto3_client.assert_called_once()
+
+
+def test_get_connection_reuses_live_connection_and_replaces_dead_one(monkeypatch):
+    """Check released connections are reused while alive and replaced once they fail."""
+    opened = []
+
+    def fake_connect():
+        conn = MagicMock()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(ingestion, "connect_to_original_database", fake_connect)
+
+    connection, opened_at = ingestion.get_connection()
+    ingestion.release_connection(connection, opened_at)
+    assert ingestion.get_connection()[0] is connection
+
+    ingestion.release_connection(connection, opened_at)
+    connection.cursor.return_value.execute.side_effect = Exception("server closed the connection")
+    assert ingestion.get_connection()[0] is not connection
+    assert len(opened) == 2
+    connection.close.assert_called_once()
+
+
+def wal2json_change(action, table=None, **values):
+    change = {"action": action}
+    if table is not None:
+        change.update(schema="public", table=table, columns=[
+            {"name": name, "type": "text", "value": value} for name, value in values.items()
+        ])
+    return change
+
+
+def test_changes_to_frames_groups_rows_by_table():
+    """Check inserts and updates become TABLE_LIST-shaped frames and the last commit is tracked."""
+    changes = [
+        ("0/10", wal2json_change("B")),
+        ("0/11", wal2json_change("I", "currency", currency_id=1, currency_code="GBP", last_updated="2025-09-11")),
+        ("0/12", wal2json_change("U", "currency", currency_id=1, currency_code="EUR", last_updated="2025-09-11")),
+        ("0/13", wal2json_change("D", "staff", staff_id=4)),
+        ("0/14", wal2json_change("C")),
+    ]
+
+    frames, commit_lsn = ingestion.changes_to_frames(changes)
+
+    assert commit_lsn == "0/14"
+    assert list(frames) == ["currency"]
+    assert list(frames["currency"].columns) == ["currency_id", "currency_code"]
+    assert frames["currency"]["currency_code"].tolist() == ["GBP", "EUR"]
+
+
+def test_ingest_replicated_changes_advances_slot_after_upload(monkeypatch):
+    """Check each micro-batch is written before the slot moves past it."""
+    events = []
+    batches = [
+        [
+            ("0/11", wal2json_change("I", "currency", currency_id=1, currency_code="GBP")),
+            ("0/12", wal2json_change("C")),
+        ],
+        [],
+    ]
+    monkeypatch.setattr(ingestion, "ensure_replication_slot", lambda c, s: None)
+    monkeypatch.setattr(ingestion, "peek_replicated_changes", lambda c, s, m: batches.pop(0))
+    monkeypatch.setattr(ingestion, "put_in_s3", lambda t, d, date: events.append(("put", t, date)))
+    monkeypatch.setattr(ingestion, "advance_replication_slot", lambda c, lsn, s: events.append(("advance", lsn)))
+
+    updated = ingestion.ingest_replicated_changes("2025-09-11 12:00", MagicMock())
+
+    assert updated == ["currency"]
+    assert events == [("put", "currency", "2025-09-11 12:00-0000"), ("advance", "0/12")]
+
+
+@pytest.mark.skipif(not os.environ.get("CDC_TEST_HOST"), reason="needs a local Postgres with wal2json, see make cdc-postgres")
+def test_ingest_replicated_changes_against_local_postgres(monkeypatch):
+    """Check changes flow from a real wal2json slot and are not replayed once consumed."""
+    conn = ingestion.pg8000.connect(
+        host=os.environ["CDC_TEST_HOST"],
+        port=int(os.environ.get("CDC_TEST_PORT", "5432")),
+        user=os.environ.get("CDC_TEST_USER", "postgres"),
+        password=os.environ.get("CDC_TEST_PASSWORD", "postgres"),
+        database=os.environ.get("CDC_TEST_DATABASE", "postgres"),
+    )
+    slot = "crigglestone_ingest_test"
+    written = {}
+    monkeypatch.setattr(ingestion, "put_in_s3", lambda t, d, date: written.setdefault(t, []).append(d))
+
+    try:
+        conn.run("DROP TABLE IF EXISTS currency")
+        conn.run("CREATE TABLE currency (currency_id serial PRIMARY KEY, currency_code text, last_updated timestamp DEFAULT now())")
+        conn.commit()
+        ingestion.ensure_replication_slot(conn, slot)
+
+        conn.run("INSERT INTO currency (currency_code) VALUES ('GBP'), ('USD')")
+        conn.run("UPDATE currency SET currency_code = 'EUR' WHERE currency_id = 2")
+        conn.commit()
+
+        assert ingestion.ingest_replicated_changes("2025-09-11 12:00", conn, slot) == ["currency"]
+        assert pd.concat(written["currency"])["currency_code"].tolist() == ["GBP", "USD", "EUR"]
+        assert ingestion.ingest_replicated_changes("2025-09-11 12:20", conn, slot) == []
+    finally:
+        conn.rollback()
+        conn.run("SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = :slot", slot=slot)
+        conn.run("DROP TABLE IF EXISTS currency")
+        conn.commit()
+        conn.close()
+
+
+class FakeCheckpointS3Client:
+    """In-memory S3 with ETag conditional writes for checkpoint tests."""
+    def __init__(self):
+        self.objects = {}
+        self.version = 0
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ingestion.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        body, etag = self.objects[Key]
+        return {"Body": io.BytesIO(body.encode("utf-8")), "ETag": etag}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ingestion.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        body, etag = self.objects[Key]
+        return {"ContentLength": len(body), "ETag": etag}
+
+    def list_objects_v2(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        return {"Contents": [{"Key": key, "Size": len(self.objects[key][0])} for key in keys]}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        current = self.objects.get(Key)
+        if (IfNoneMatch == "*" and current is not None) or (IfMatch is not None and (current is None or current[1] != IfMatch)):
+            raise ingestion.ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        self.version += 1
+        self.objects[Key] = (Body, f'"{self.version}"')
+        return {"ETag": f'"{self.version}"'}
+
+
+def test_retry_only_extracts_unfinished_tables(monkeypatch):
+    """Check a crash after some tables keeps their checkpoints and the retry reports them."""
+    client = FakeCheckpointS3Client()
+    latest = {table: "2025-09-11 12:00:00" for table in ingestion.TABLE_LIST}
+    extracted = []
+    crash = {"table": "payment"}
+
+    def fake_ingest_table(table, connection, cutoff, current_time, date=None):
+        if table == crash["table"]:
+            raise RuntimeError("Lambda timed out")
+        extracted.append(table)
+        return date
+
+    monkeypatch.setattr(ingestion, "get_connection", lambda: (MagicMock(), 0))
+    monkeypatch.setattr(ingestion, "check_all_original_updates", lambda c: dict(latest))
+    monkeypatch.setattr(ingestion, "ingest_table", fake_ingest_table)
+
+    with pytest.raises(RuntimeError):
+        ingestion.ingest_polled_updates(client, "2025-09-11 12:00")
+    assert extracted == ["address", "counterparty", "currency", "department", "design"]
+
+    extracted.clear()
+    crash["table"] = None
+    updated = ingestion.ingest_polled_updates(client, "2025-09-11 12:20")
+
+    assert extracted == ["payment", "payment_type", "purchase_order", "sales_order", "staff", "transaction"]
+    assert sorted(updated) == sorted(ingestion.TABLE_LIST)
+
+    ingestion.mark_checkpoints_processed(client, updated)
+    checkpoints = ingestion.get_table_checkpoints(client)
+    assert not any(checkpoint["pending"] for checkpoint, _ in checkpoints.values())
+
+
+def test_marking_processed_keeps_a_flag_set_by_an_overlapping_run(monkeypatch):
+    """Check a run only clears the pending flags it committed, not ones set after them."""
+    client = FakeCheckpointS3Client()
+    monkeypatch.setattr(ingestion, "get_connection", lambda: (MagicMock(), 0))
+    monkeypatch.setattr(ingestion, "release_connection", lambda *a: None)
+    monkeypatch.setattr(ingestion, "check_all_original_updates", lambda c: {"staff": "2025-09-11 12:00:00", "currency": "2025-09-11 12:00:00"})
+    monkeypatch.setattr(ingestion, "ingest_table", lambda table, connection, cutoff, current_time, date=None: date)
+
+    reported = ingestion.ingest_polled_updates(client, "2025-09-11 12:00")
+    # An overlapping run commits newer staff files before this run clears its flags
+    _, etag = ingestion.get_table_checkpoint(client, "staff")
+    ingestion.commit_table_checkpoint(client, "staff", "2025-09-11 12:20:00", etag)
+    ingestion.mark_checkpoints_processed(client, reported)
+
+    staff, _ = ingestion.get_table_checkpoint(client, "staff")
+    currency, _ = ingestion.get_table_checkpoint(client, "currency")
+    assert sorted(reported) == ["currency", "staff"]
+    assert staff == {"last_updated": "2025-09-11 12:20:00", "pending": True}
+    assert currency == {"last_updated": "2025-09-11 12:00:00", "pending": False}
+
+
+def test_commit_table_checkpoint_keeps_newer_watermark_from_overlapping_run():
+    """Check an overlapping run with an older watermark cannot move a checkpoint backwards."""
+    client = FakeCheckpointS3Client()
+
+    ingestion.commit_table_checkpoint(client, "staff", "2025-09-11 12:20:00", None)
+    ingestion.commit_table_checkpoint(client, "staff", "2025-09-11 12:00:00", None)
+
+    checkpoint, _ = ingestion.get_table_checkpoint(client, "staff")
+    assert checkpoint["last_updated"] == "2025-09-11 12:20:00"
+
+
+def test_ingest_table_appends_manifest_entries(monkeypatch):
+    """Check each ingested file is appended to the table manifest, older files seeded first."""
+    client = FakeCheckpointS3Client()
+    client.put_object("nc-crigglestone-ingest-bucket", "payment/2025-09-11 11:40.csv", "payment_id\n1")
+    extracts = iter([
+        pd.DataFrame({"payment_id": [1, 2], "last_updated": ["2025-09-11 11:50:00", "2025-09-11 11:55:00"]}),
+        pd.DataFrame({"payment_id": [3], "last_updated": ["2025-09-11 12:10:00"]}),
+    ])
+
+    def fake_put_in_s3(table, data, date):
+        key = f"{table}/{date}.csv"
+        client.put_object("nc-crigglestone-ingest-bucket", key, data.to_csv(index=False))
+        return key
+
+    monkeypatch.setattr(ingestion, "INGEST_MANIFEST", True)
+    monkeypatch.setattr(ingestion, "get_client", lambda service: client)
+    monkeypatch.setattr(ingestion, "get_original_updates_since", lambda t, c, cutoff: next(extracts))
+    monkeypatch.setattr(ingestion, "put_in_s3", fake_put_in_s3)
+
+    ingestion.ingest_table("payment", MagicMock(), "2025-09-11 11:40:00", "2025-09-11 12:00", "2025-09-11 11:55:00")
+    ingestion.ingest_table("payment", MagicMock(), "2025-09-11 11:55:00", "2025-09-11 12:20", "2025-09-11 12:10:00")
+
+    manifest, _ = ingestion.get_manifest(client, "payment")
+    assert [entry["seq"] for entry in manifest] == [1, 2, 3]
+    assert [entry["key"] for entry in manifest] == [
+        "payment/2025-09-11 11:40.csv", "payment/2025-09-11 12:00.csv", "payment/2025-09-11 12:20.csv"
+    ]
+    assert manifest[0]["rows"] is None
+    assert manifest[1]["rows"] == 2
+    assert manifest[1]["min_last_updated"] == "2025-09-11 11:50:00"
+    assert manifest[1]["max_last_updated"] == "2025-09-11 11:55:00"
+    assert manifest[2]["bytes"] == len("payment_id,last_updated\n3,2025-09-11 12:10:00\n")
+    assert manifest[2]["checksum"] == client.objects["payment/2025-09-11 12:20.csv"][1].strip('"')
+
+
+def test_ingest_table_reports_rows_bytes_and_retries(monkeypatch):
+    """Check a streamed extraction emits one EMF span with its rows, bytes and manifest retries."""
+    telemetry = ingestion.telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY", "local")
+    monkeypatch.setattr(ingestion, "STREAM_EXTRACT", True)
+    monkeypatch.setattr(ingestion, "INGEST_MANIFEST", True)
+    telemetry.drain()
+
+    client = FakeCheckpointS3Client()
+    monkeypatch.setattr(ingestion, "get_client", lambda name: client)
+    batches = [pd.DataFrame({"currency_id": [1, 2, 3], "currency_code": ["GBP", "USD", "EUR"]})]
+    monkeypatch.setattr(ingestion, "iter_original_update_batches", lambda *args: iter(batches))
+
+    # Another run appends to the manifest between our read and write, once
+    real_put = ingestion.conditional_put
+    conflicts = iter([True])
+    monkeypatch.setattr(
+        ingestion, "conditional_put",
+        lambda *args: None if next(conflicts, False) else real_put(*args)
+    )
+
+    ingestion.ingest_table("currency", MagicMock(), "2025-09-11 12:00:00", "2025-09-11 12:20", "2025-09-11 12:10:00")
+
+    [span] = telemetry.drain()
+    assert (span["Stage"], span["Operation"], span["Table"]) == ("ingest", "extract", "currency")
+    assert span["rows"] == 3
+    assert span["bytes"] == len("currency_id,currency_code\n1,GBP\n2,USD\n3,EUR\n")
+    assert span["retries"] == 1
+    metrics = span["_aws"]["CloudWatchMetrics"][0]
+    assert {metric["Name"] for metric in metrics["Metrics"]} == {"rows", "bytes", "retries", "duration_ms", "max_rss_mb"}
+    assert metrics["Dimensions"] == [["Stage", "Operation"], ["Stage", "Operation", "Table"]]
+
+
+def test_put_in_s3_reports_the_bytes_written(monkeypatch):
+    """Check the default, non-streaming extraction reports the size of the object it wrote."""
+    telemetry = ingestion.telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY", "local")
+    telemetry.drain()
+
+    client = FakeCheckpointS3Client()
+    monkeypatch.setattr(ingestion, "get_client", lambda name: client)
+    monkeypatch.setattr(ingestion, "INGEST_FORMAT", "csv")
+
+    def fake_to_csv(df, path, index=False):
+        key = path.removeprefix(f"s3://{ingestion.INGEST_BUCKET}/")
+        client.put_object(Bucket=ingestion.INGEST_BUCKET, Key=key, Body=df.to_csv(index=index))
+
+    monkeypatch.setattr(ingestion.wr.s3, "to_csv", fake_to_csv)
+    data = pd.DataFrame({"currency_id": [1, 2], "currency_code": ["GBP", "USD"]})
+
+    ingestion.put_in_s3("currency", data, "2025-09-11 12:20")
+
+    [span] = telemetry.drain()
+    assert (span["Operation"], span["rows"]) == ("s3_put", 2)
+    assert span["bytes"] == len("currency_id,currency_code\n1,GBP\n2,USD\n")
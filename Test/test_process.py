@@ -1,6 +1,12 @@
+import datetime
+import decimal
 import io
+import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+import threading
 from unittest.mock import MagicMock
 
 import src.process_lambda as process
@@ -11,6 +17,7 @@ class FakeS3Client:
     def __init__(self, csv_data=None):
         self.csv_data = csv_data or "id,name\n1,Alice\n2,Bob"
         self.objects = {}
+        self.metadata = {}
 
     def get_object(self, Bucket, Key):
         return {"Body": io.BytesIO(self.csv_data.encode("utf-8"))}
@@ -18,14 +25,25 @@ class FakeS3Client:
     def list_objects(self, Bucket, Prefix):
         return {"Contents": [{"Key": "staff/file1.csv"}]}
 
-    def put_object(self, Bucket, Key, Body):
+    def put_object(self, Bucket, Key, Body, Metadata=None):
         self.objects[Key] = Body
+        self.metadata[Key] = Metadata or {}
         return True
 
     def head_object(self, Bucket, Key):
         if Key not in self.objects:
             raise process.ClientError({"Error": {"Code": "404"}}, "HeadObject")
-        return {}
+        return {"Metadata": self.metadata[Key]}
+
+
+class FakeLambdaClient:
+    """Fake Lambda client whose invoke takes only the arguments boto3's does."""
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.invocations.append((FunctionName, json.loads(Payload)))
+        return {"StatusCode": 202}
 
 
 def test_fetch_file_from_ingest_reads_csv():
@@ -35,6 +53,36 @@ def test_fetch_file_from_ingest_reads_csv():
     assert list(df.columns) == ["staff_id", "first_name"]
 
 
+def test_fetch_file_from_ingest_reads_parquet():
+    df = pd.DataFrame({
+        "payment_id": [1],
+        "created_at": pd.to_datetime(["2025-09-11 12:00:00"]),
+        "paid": [True],
+    })
+    client = MagicMock()
+    client.get_object.return_value = {"Body": io.BytesIO(df.to_parquet(index=False))}
+
+    fetched = process.fetch_file_from_ingest(client, "payment/2025-09-11 12:00.parquet")
+    assert fetched["created_at"].dtype.kind == "M"
+    assert fetched["paid"].dtype == "boolean"
+    assert fetched["payment_id"].dtype == "int32"
+
+
+def test_money_is_rounded_to_two_places_by_both_backends():
+    """Check amounts with more than two decimal places are rounded, not truncated, and overflow fails."""
+    csv = "payment_id,payment_amount\n1,10.555\n2,2.675\n3,10.554\n4,"
+    client = FakeS3Client(csv)
+
+    pandas_amounts = process.fetch_file_from_ingest(client, "payment/file1.csv")["payment_amount"]
+    arrow_amounts = process.fetch_arrow_file_from_ingest(client, "payment/file1.csv")["payment_amount"]
+
+    expected = [decimal.Decimal("10.56"), decimal.Decimal("2.68"), decimal.Decimal("10.55"), None]
+    assert [None if pd.isna(amount) else amount for amount in pandas_amounts] == expected
+    assert arrow_amounts.to_pylist() == expected
+    with pytest.raises(pa.ArrowInvalid):
+        process.apply_schema(pd.DataFrame({"payment_amount": [1e13]}), process.SOURCE_SCHEMAS["payment"])
+
+
 def test_get_keys_for_table_returns_keys():
     client = FakeS3Client()
     keys = process.get_keys_for_table(client, "staff")
@@ -67,8 +115,7 @@ def test_lambda_handler_with_currency(monkeypatch):
     s3_client = FakeS3Client("currency_id,currency_code\n1,GBP")
 
     # Fake Lambda client with an invoke method
-    lambda_client = MagicMock()
-    lambda_client.invoke.return_value = {"StatusCode": 202}
+    lambda_client = FakeLambdaClient()
 
     # Patch get_from_ingest to return a small dataframe
     monkeypatch.setattr(process, "get_from_ingest", lambda c, t: pd.DataFrame({
@@ -95,4 +142,571 @@ def test_lambda_handler_with_currency(monkeypatch):
 
     # Just check it runs without errors
     assert result is None
-    lambda_client.invoke.assert_called_once()
+    assert [name for name, _ in lambda_client.invocations] == ["warehousing_lambda"]
+
+
+class FakeIngestS3Client:
+    """Fake S3 holding timestamped ingest files and written objects."""
+    def __init__(self, files):
+        self.files = files
+        self.objects = {}
+        self.metadata = {}
+        self.fetched = []
+
+    def get_object(self, Bucket, Key):
+        if Bucket == "nc-crigglestone-ingest-bucket":
+            self.fetched.append(Key)
+            return {"Body": io.BytesIO(self.files[Key].encode("utf-8"))}
+        if Key not in self.objects:
+            raise process.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def list_objects(self, Bucket, Prefix, Marker=""):
+        stored = self.files if Bucket == "nc-crigglestone-ingest-bucket" else self.objects
+        keys = sorted(key for key in stored if key.startswith(Prefix) and key > Marker)
+        return {"Contents": [{"Key": key} for key in keys]} if keys else {}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        self.objects[Key] = Body
+        self.metadata[Key] = Metadata or {}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise process.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"Metadata": self.metadata[Key]}
+
+
+def test_incremental_snapshot_only_merges_new_files(monkeypatch):
+    """Check later runs fetch only newer ingest files and keep the latest version of each row."""
+    monkeypatch.setattr(process, "INCREMENTAL_TRANSFORM", True)
+    client = FakeIngestS3Client({
+        "currency/2025-09-11 12:00.csv": "currency_id,currency_code\n1,GBP\n2,USD",
+    })
+
+    first = process.get_from_ingest(client, "currency")
+    assert first["currency_code"].tolist() == ["GBP", "USD"]
+
+    client.files["currency/2025-09-11 12:20.csv"] = "currency_id,currency_code\n2,EUR\n3,JPY"
+    client.fetched.clear()
+    second = process.get_from_ingest(client, "currency")
+
+    assert client.fetched == ["currency/2025-09-11 12:20.csv"]
+    assert second.sort_values("currency_id")["currency_code"].tolist() == ["GBP", "EUR", "JPY"]
+
+    client.fetched.clear()
+    third = process.get_from_ingest(client, "currency")
+    assert client.fetched == []
+    assert len(third) == 3
+
+
+def test_incremental_loader_reads_tables_without_new_files(monkeypatch):
+    """Check a snapshot with no newer files is used as is and a table with neither reads as no rows."""
+    monkeypatch.setattr(process, "INCREMENTAL_TRANSFORM", True)
+    client = FakeIngestS3Client({
+        "currency/2025-09-11 12:00.csv": "currency_id,currency_code\n1,GBP\n2,USD",
+    })
+    process.get_from_ingest(client, "currency")
+    client.fetched.clear()
+
+    for backend in ("pandas", "arrow"):
+        loader = process.TableLoader(client, backend=backend)
+        currency = loader.get("currency")
+        staff = loader.get("staff")
+
+        assert len(currency) == 2
+        assert len(staff) == 0
+        assert list(staff.column_names if backend == "arrow" else staff.columns) == list(process.SOURCE_SCHEMAS["staff"])
+    assert client.fetched == []
+
+
+def test_incremental_snapshot_keeps_every_version_of_fact_sources(monkeypatch):
+    """Check facts built from snapshots keep the same row versions as a full read of the same files."""
+    monkeypatch.setattr(process, "get_parquet", lambda client, table: None)
+    files = dict(PARITY_FILES)
+    later = {"payment/2025-09-11 12:20.csv": "\n".join([
+        PARITY_FILES["payment/2025-09-11 12:00.csv"].splitlines()[0],
+        "2,2025-09-03 23:59:59.999,2025-09-04 09:00:00,,2,,2,1,True,",
+    ])}
+
+    written = {}
+    for incremental in (False, True):
+        monkeypatch.setattr(process, "INCREMENTAL_TRANSFORM", incremental)
+        client = FakeIngestS3Client(dict(files))
+        process.get_from_ingest(client, "payment")
+        client.files.update(later)
+        [key] = process.make_tasks(client, process.TableLoader(client), ["fact_payment"])[0]["fact_payment"]()
+        written[incremental] = pq.read_table(io.BytesIO(client.objects[key])).to_pylist()
+
+    assert written[True] == written[False]
+    assert len(written[True]) == 4
+
+
+def test_get_keys_for_table_pages_past_1000_keys():
+    """Check truncated listings are followed with the last key as marker."""
+    client = MagicMock()
+    client.list_objects.side_effect = [
+        {"Contents": [{"Key": f"staff/{i:04d}.csv"} for i in range(1000)], "IsTruncated": True},
+        {"Contents": [{"Key": "staff/1000.csv"}], "IsTruncated": False},
+    ]
+
+    keys = process.get_keys_for_table(client, "staff")
+
+    assert len(keys) == 1001
+    assert client.list_objects.call_args_list[1].kwargs["Marker"] == "staff/0999.csv"
+
+
+def test_get_from_ingest_concatenates_files_in_key_order():
+    """Check concurrently fetched files are combined in listing order."""
+    client = FakeIngestS3Client({
+        f"currency/2025-09-11 12:{minute:02d}.csv": f"currency_id,currency_code\n1,C{minute}"
+        for minute in range(0, 60, 5)
+    })
+
+    data = process.get_from_ingest(client, "currency")
+
+    assert data["currency_code"].tolist() == [f"C{minute}" for minute in range(0, 60, 5)]
+
+
+def test_get_keys_for_table_follows_manifest_order_without_listing(monkeypatch):
+    """Check the manifest replaces LIST and its write order decides which duplicate wins."""
+    monkeypatch.setattr(process, "INGEST_MANIFEST", True)
+    # "12:00-0000.csv" sorts before "12:00.csv" but was written after it
+    client = FakeIngestS3Client({
+        "currency/2025-09-11 12:00.csv": "currency_id,currency_code\n1,GBP",
+        "currency/2025-09-11 12:00-0000.csv": "currency_id,currency_code\n1,EUR",
+        "manifests/currency.jsonl": "\n".join([
+            '{"seq": 2, "key": "currency/2025-09-11 12:00-0000.csv"}',
+            '{"seq": 1, "key": "currency/2025-09-11 12:00.csv"}',
+        ]),
+    })
+    client.list_objects = MagicMock(side_effect=AssertionError("listed the prefix"))
+
+    keys = process.get_keys_for_table(client, "currency")
+    assert keys == ["currency/2025-09-11 12:00.csv", "currency/2025-09-11 12:00-0000.csv"]
+    assert process.get_keys_for_table(client, "currency", keys[0]) == keys[1:]
+
+    data = process.get_from_ingest(client, "currency")
+    assert data.drop_duplicates(subset=["currency_id"], keep="last")["currency_code"].tolist() == ["EUR"]
+
+
+def test_lambda_handler_fetches_shared_tables_once(monkeypatch):
+    """Check address is loaded once for both of its dimensions and released afterwards."""
+    sources = {
+        "address": pd.DataFrame({
+            "address_id": [7, 3, 7],
+            "address_line_1": ["Old Road", "High Street", "New Road"],
+            "address_line_2": [None, None, None],
+            "district": [None, None, None],
+            "city": ["Leeds", "York", "Leeds"],
+            "postal_code": ["LS1", "YO1", "LS1"],
+            "country": ["UK", "UK", "UK"],
+            "phone": ["1", "2", "3"],
+        }),
+        "counterparty": pd.DataFrame({
+            "counterparty_id": [1, 2],
+            "counterparty_legal_name": ["Acme", "Globex"],
+            "legal_address_id": [3, 7],
+        }),
+    }
+    fetched = []
+
+    def fake_get_from_ingest(client, table):
+        fetched.append(table)
+        return sources[table].copy()
+
+    outputs = {}
+    loaders = []
+    real_loader = process.TableLoader
+
+    def tracking_loader(*args, **kwargs):
+        loaders.append(real_loader(*args, **kwargs))
+        return loaders[-1]
+
+    monkeypatch.setattr(process, "get_from_ingest", fake_get_from_ingest)
+    monkeypatch.setattr(process, "put_in_processed", lambda c, t, d: outputs.__setitem__(t, d))
+    monkeypatch.setattr(process, "TableLoader", tracking_loader)
+    monkeypatch.setattr(process, "boto3", MagicMock())
+
+    process.lambda_handler({"updates": ["counterparty", "address"]}, None)
+
+    assert sorted(fetched) == ["address", "counterparty"]
+    assert loaders[0].tables == {}
+    assert outputs["dim_location"]["location_id"].tolist() == [3, 7]
+    assert outputs["dim_counterparty"]["counterparty_legal_address_line_1"].tolist() == ["High Street", "New Road"]
+
+
+def test_make_dim_dates_builds_contiguous_calendar_with_stable_keys():
+    """Check dim_date covers every day between the extremes and is only rebuilt when the range grows."""
+    payments = pd.DataFrame({
+        "created_at": ["2025-02-27 10:00:00.000"],
+        "last_updated": ["2025-03-02 09:30:00.500"],
+        "payment_date": ["2025-02-28"],
+    })
+    orders = pd.DataFrame({
+        "created_at": ["2025-02-27 11:00:00"],
+        "last_updated": ["2025-02-27 11:00:00"],
+        "agreed_delivery_date": ["2025-03-01"],
+        "agreed_payment_date": [None],
+    })
+
+    dates = process.make_dim_dates(payments, orders, orders)
+    assert dates["date_id"].tolist() == [20250227, 20250228, 20250301, 20250302]
+    assert dates.iloc[0][["day_name", "quarter"]].tolist() == ["Thursday", 1]
+
+    assert process.make_dim_dates(payments, orders, orders, dates) is None
+
+    orders.loc[0, "agreed_payment_date"] = "2025-03-04"
+    grown = process.make_dim_dates(payments, orders, orders, dates)
+    assert grown["date_id"].tolist()[:4] == dates["date_id"].tolist()
+    assert grown["date_id"].tolist()[-1] == 20250304
+
+
+def test_make_dim_dates_rebuilds_a_calendar_with_sequential_keys():
+    """Check a dim_date written before YYYYMMDD keys is rebuilt instead of failing the run."""
+    payments = pd.DataFrame({
+        "created_at": ["2025-02-27 10:00:00"],
+        "last_updated": ["2025-02-28 09:30:00"],
+        "payment_date": ["2025-02-28"],
+    })
+    orders = pd.DataFrame({
+        "created_at": ["2025-02-27 11:00:00"],
+        "last_updated": ["2025-02-27 11:00:00"],
+        "agreed_delivery_date": ["2025-03-01"],
+        "agreed_payment_date": [None],
+    })
+    existing = pd.DataFrame({
+        "date_id": [1, 2, 3],
+        "year": [2025, 2025, 2025],
+        "month": [2, 2, 3],
+        "day": [27, 28, 1],
+    })
+
+    dates = process.make_dim_dates(payments, orders, orders, existing)
+
+    assert dates["date_id"].tolist() == [20250227, 20250228, 20250301]
+
+
+def test_make_fact_payment_computes_date_keys_and_times():
+    """Check fact date columns hold YYYYMMDD keys and times are native time values."""
+    payment = pd.DataFrame({
+        "payment_id": [1],
+        "created_at": ["2025-09-11 12:00:00.123"],
+        "last_updated": ["2025-09-12 08:00:00"],
+        "transaction_id": [5],
+        "counterparty_id": [2],
+        "payment_amount": [10.5],
+        "currency_id": [1],
+        "payment_type_id": [3],
+        "paid": [True],
+        "payment_date": ["2025-10-01"],
+    })
+
+    fact = process.make_fact("fact_payment", payment)
+
+    assert list(fact.columns) == ["record_payment_id"] + [c[0] for c in process.FACT_SPECS["fact_payment"]["columns"]]
+    assert fact.iloc[0][["created_date", "last_updated_date", "payment_date"]].tolist() == [20250911, 20250912, 20251001]
+    assert fact.iloc[0]["created_time"] == datetime.time(12, 0, 0, 123000)
+    assert "created_date" not in payment.columns
+
+    stored = pd.read_parquet(io.BytesIO(fact.to_parquet(index=False)))
+    assert stored.iloc[0]["last_updated_time"] == datetime.time(8, 0)
+
+
+def test_make_fact_delta_keeps_record_ids_and_emits_only_changes():
+    """Check record ids survive reruns and only new or changed versions reach the delta."""
+    payment = pd.DataFrame({
+        "payment_id": [1, 2],
+        "created_at": ["2025-09-11 12:00:00", "2025-09-11 12:05:00"],
+        "last_updated": ["2025-09-11 12:00:00", "2025-09-11 12:05:00"],
+        "transaction_id": [5, 6],
+        "counterparty_id": [2, 2],
+        "payment_amount": [10.5, 20.0],
+        "currency_id": [1, 1],
+        "payment_type_id": [3, 3],
+        "paid": [False, True],
+        "payment_date": ["2025-10-01", "2025-10-02"],
+    })
+
+    first, state = process.make_fact_delta("fact_payment", payment)
+    assert first["record_payment_id"].tolist() == [1, 2]
+
+    rerun, state = process.make_fact_delta("fact_payment", payment, state)
+    assert rerun.empty
+
+    updated = pd.concat([payment, payment.iloc[[0]].assign(paid=True, last_updated="2025-09-12 09:00:00")])
+    updated.loc[1, "payment_amount"] = 21.0
+    delta, state = process.make_fact_delta("fact_payment", updated, state)
+
+    assert delta[["record_payment_id", "payment_id"]].values.tolist() == [[2, 2], [3, 1]]
+    assert delta["payment_amount"].tolist() == [21.0, 10.5]
+    assert sorted(state["record_id"].tolist()) == [1, 2, 3]
+
+
+def test_incremental_facts_send_deltas_again_until_the_warehouse_deletes_them(monkeypatch):
+    """Check each run writes its delta to a new key and passes on every delta not loaded yet."""
+    monkeypatch.setattr(process, "INCREMENTAL_FACTS", True)
+    client = FakeIngestS3Client(dict(PARITY_FILES))
+
+    def run():
+        tasks, _ = process.make_tasks(client, process.TableLoader(client), ["fact_payment"])
+        return tasks["fact_payment"]()
+
+    [first] = run()
+    assert first.startswith("deltas/fact-payment/")
+
+    client.files["payment/2025-09-11 12:20.csv"] = "\n".join([
+        PARITY_FILES["payment/2025-09-11 12:00.csv"].splitlines()[0],
+        "2,2025-09-03 23:59:59.999,2025-09-04 09:00:00,,2,,2,1,True,",
+    ])
+    pending = run()
+    assert pending[0] == first and len(pending) == 2
+    assert len(pq.read_table(io.BytesIO(client.objects[pending[1]]))) == 1
+
+    # Once the warehouse has loaded and deleted them, an unchanged source sends nothing
+    for key in pending:
+        del client.objects[key]
+    assert run() == []
+
+
+def test_put_partitioned_in_processed_rewrites_only_changed_months():
+    """Check facts are split into year/month partitions and unchanged ones are not rewritten."""
+    class MetadataS3Client(FakeS3Client):
+        def put_object(self, Bucket, Key, Body, Metadata=None):
+            self.objects[Key] = (Body, Metadata or {})
+
+        def head_object(self, Bucket, Key):
+            if Key not in self.objects:
+                raise process.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+            return {"Metadata": self.objects[Key][1]}
+
+    client = MetadataS3Client()
+    fact = pd.DataFrame({"record_payment_id": [1, 2, 3], "created_date": [20250830, 20250901, 20250915]})
+
+    written = process.put_partitioned_in_processed(client, "fact_payment", fact)
+    assert written == ["fact-payment/year=2025/month=08/part-0.parquet", "fact-payment/year=2025/month=09/part-0.parquet"]
+    stored = pq.ParquetFile(io.BytesIO(client.objects[written[1]][0]))
+    assert stored.metadata.num_rows == 2
+    assert stored.metadata.row_group(0).column(0).statistics.max == 3
+
+    fact.loc[3] = [4, 20250920]
+    assert process.put_partitioned_in_processed(client, "fact_payment", fact) == [written[1]]
+
+
+def test_put_partitioned_in_processed_keeps_rows_without_a_created_date():
+    """Check fact rows with no created_date are written to their own null partition."""
+    client = FakeS3Client()
+    fact = pd.DataFrame({"record_payment_id": [1, 2, 3], "created_date": [20250901, None, None]})
+
+    written = process.put_partitioned_in_processed(client, "fact_payment", fact)
+
+    assert written == [
+        "fact-payment/year=2025/month=09/part-0.parquet",
+        "fact-payment/year=__null__/month=__null__/part-0.parquet",
+    ]
+    stored = pd.read_parquet(io.BytesIO(client.objects[written[1]]))
+    assert stored["record_payment_id"].tolist() == [2, 3]
+
+
+def test_chunked_facts_match_full_build_and_upload_in_parts(monkeypatch):
+    """Check chunked mode writes the same fact as the in-memory build, part by part."""
+    class MultipartIngestS3Client(FakeIngestS3Client):
+        def create_multipart_upload(self, Bucket, Key):
+            self.parts = {}
+            return {"UploadId": "upload"}
+
+        def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+            self.parts[PartNumber] = Body
+            return {"ETag": f'"{PartNumber}"'}
+
+        def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+            self.objects[Key] = b"".join(self.parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    header = "payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date"
+    rows = [
+        f"{i},2025-09-{i:02d} 10:00:00,2025-09-{i:02d} 10:00:00,{i},1,{i}.50,1,1,True,2025-10-{i:02d}"
+        for i in range(1, 6)
+    ]
+    client = MultipartIngestS3Client({
+        "payment/2025-09-11 12:00.csv": "\n".join([header] + rows[:3]),
+        "payment/2025-09-11 12:20.csv": "\n".join([header] + rows[3:]),
+    })
+    monkeypatch.setattr(process, "FACT_CHUNK_ROWS", 2)
+    monkeypatch.setattr(process.multipart, "MULTIPART_CHUNK_SIZE", 1)
+
+    bounds = []
+    written = process.put_fact_in_chunks(client, "fact_payment", bounds)
+    dim_date = process.make_chunked_dim_date(client, ["dim_date", "fact_payment"], bounds, pd.DataFrame({"date_id": [20250901]}))
+
+    chunked = pd.read_parquet(io.BytesIO(client.objects["fact-payment.parquet"]))
+    full = process.apply_schema(
+        process.make_fact("fact_payment", process.get_from_ingest(client, "payment")),
+        process.OUTPUT_SCHEMAS["fact_payment"]
+    ).reset_index(drop=True)
+
+    assert written == "fact-payment.parquet"
+    assert len(client.parts) > 1
+    assert chunked["record_payment_id"].tolist() == [1, 2, 3, 4, 5]
+    pd.testing.assert_frame_equal(chunked, pd.read_parquet(io.BytesIO(full.to_parquet(index=False))))
+    assert dim_date["date_id"].iloc[-1] == 20251005
+
+
+def test_chunked_fact_that_fits_in_one_part_is_not_uploaded_again_unchanged():
+    """Check a chunked fact smaller than a part goes through the content hash check."""
+    client = FakeIngestS3Client(dict(PARITY_FILES))
+
+    assert process.put_fact_in_chunks(client, "fact_payment", []) == "fact-payment.parquet"
+    assert "content-hash" in client.metadata["fact-payment.parquet"]
+    assert process.put_fact_in_chunks(client, "fact_payment", []) is None
+
+
+def test_plan_builders_picks_outputs_reading_updated_tables():
+    """Check only outputs that read an updated table are rebuilt."""
+    assert process.plan_builders(["address"]) == ["dim_counterparty", "dim_location"]
+    assert process.plan_builders(["sales_order"]) == ["dim_date", "fact_sales_order"]
+
+
+def test_run_builders_runs_independent_tasks_together_and_waits_for_dependencies():
+    """Check independent builders overlap and a dependent one starts after them."""
+    barrier = threading.Barrier(2, timeout=5)
+    finished = []
+
+    def independent(name):
+        def run():
+            barrier.wait()
+            finished.append(name)
+            return [f"{name}.parquet"]
+        return run
+
+    def dependent():
+        assert sorted(finished) == ["fact-a", "fact-b"]
+        return []
+
+    keys = process.run_builders(
+        {"dim_date": dependent, "fact-a": independent("fact-a"), "fact-b": independent("fact-b")},
+        {"dim_date": ["fact-a", "fact-b"]},
+        max_workers=3
+    )
+
+    assert keys == ["fact-a.parquet", "fact-b.parquet"]
+
+
+PARITY_FILES = {
+    "address/2025-09-11 12:00.csv": "\n".join([
+        "address_id,address_line_1,address_line_2,district,city,postal_code,country,phone",
+        "7,Old Road,,Leeds Central,Leeds,LS1,UK,0113",
+        "3,High Street,Flat 2,,York,YO1,UK,01904",
+    ]),
+    "address/2025-09-11 12:20.csv": "\n".join([
+        "address_id,address_line_1,address_line_2,district,city,postal_code,country,phone",
+        "7,New Road,,Leeds Central,Leeds,LS2,UK,0113",
+    ]),
+    "counterparty/2025-09-11 12:00.csv": "\n".join([
+        "counterparty_id,counterparty_legal_name,legal_address_id",
+        "2,Globex,7", "1,Acme,3", "3,Initech,99",
+    ]),
+    "currency/2025-09-11 12:00.csv": "currency_id,currency_code\n1,GBP\n2,USD\n1,EUR",
+    "department/2025-09-11 12:00.csv": "department_id,department_name,location\n1,Sales,Leeds\n2,Finance,York",
+    "design/2025-09-11 12:00.csv": "design_id,design_name,file_location,file_name\n4,Steel,/usr,steel.json",
+    "payment_type/2025-09-11 12:00.csv": "payment_type_id,payment_type_name\n1,SALES_RECEIPT",
+    "staff/2025-09-11 12:00.csv": "\n".join([
+        "staff_id,first_name,last_name,department_id,email_address",
+        "5,Ann,Lee,2,ann@example.com", "6,Bo,Kim,,bo@example.com",
+    ]),
+    "transaction/2025-09-11 12:00.csv": "\n".join([
+        "transaction_id,transaction_type,sales_order_id,purchase_order_id",
+        "1,SALE,1,", "2,PURCHASE,,1",
+    ]),
+    "payment/2025-09-11 12:00.csv": "\n".join([
+        "payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date",
+        "1,2025-09-01 10:15:30.5,2025-09-01 10:15:30.5,1,1,10.50,1,1,False,2025-09-30",
+        "1,2025-09-01 10:15:30.5,2025-09-02 08:00:00,1,1,10.50,1,1,True,2025-09-30",
+        "2,2025-09-03 23:59:59.999,2025-09-03 23:59:59.999,,2,,2,1,,",
+    ]),
+    "purchase_order/2025-09-11 12:00.csv": "\n".join([
+        "purchase_order_id,created_at,last_updated,staff_id,counterparty_id,item_code,item_quantity,item_unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id",
+        "1,2025-08-30 09:00:00,2025-08-30 09:00:00,5,1,ABC,3,2.25,1,2025-10-01,2025-10-15,3",
+    ]),
+    "sales_order/2025-09-11 12:00.csv": "\n".join([
+        "sales_order_id,created_at,last_updated,design_id,staff_id,counterparty_id,units_sold,unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id",
+        "1,2025-09-05 14:30:00,2025-09-05 14:30:00,4,5,2,100,3.10,2,2025-11-02,,7",
+    ]),
+}
+
+
+@pytest.mark.parametrize("name", list(process.BUILDER_INPUTS))
+def test_arrow_backend_matches_pandas_backend(monkeypatch, name):
+    """Check the arrow backend writes the same rows and columns as pandas for every output."""
+    monkeypatch.setattr(process, "get_parquet", lambda client, table: None)
+
+    written = {}
+    for backend in ("pandas", "arrow"):
+        client = FakeIngestS3Client(PARITY_FILES)
+        loader = process.TableLoader(client, process.BUILDER_INPUTS[name], backend=backend)
+        tasks, _ = process.make_tasks(client, loader, [name])
+        [key] = tasks[name]()
+        written[backend] = pq.read_table(io.BytesIO(client.objects[key]))
+
+    assert written["arrow"].column_names == written["pandas"].column_names
+    assert written["arrow"].to_pylist() == written["pandas"].to_pylist()
+    assert len(written["arrow"]) > 0
+
+
+def test_unchanged_outputs_are_not_uploaded_or_sent_to_the_warehouse(monkeypatch):
+    """Check a rebuild that serializes to the same bytes skips the upload and the warehouse."""
+    client = FakeIngestS3Client(dict(PARITY_FILES))
+    lambda_client = FakeLambdaClient()
+    monkeypatch.setattr(process, "boto3", MagicMock())
+    process.boto3.client.side_effect = lambda service: client if service == "s3" else lambda_client
+
+    process.lambda_handler({"updates": ["currency", "address"]}, None)
+    [(_, first)] = lambda_client.invocations
+    assert sorted(first["Records"]) == ["dim-counterparty.parquet", "dim-currency.parquet", "dim-location.parquet"]
+
+    # Only last_updated would differ in the source, the dimension is the same
+    client.files["currency/2025-09-11 12:20.csv"] = "currency_id,currency_code\n2,USD"
+    client.files["address/2025-09-11 12:40.csv"] = PARITY_FILES["address/2025-09-11 12:00.csv"].replace("Old Road", "Mill Lane")
+    lambda_client.invocations.clear()
+    process.lambda_handler({"updates": ["currency", "address"]}, None)
+    assert lambda_client.invocations[0][1]["Records"] == ["dim-counterparty.parquet", "dim-location.parquet"]
+
+    lambda_client.invocations.clear()
+    process.lambda_handler({"updates": ["currency"]}, None)
+    assert lambda_client.invocations == []
+
+
+def test_telemetry_records_builders_and_s3_calls(monkeypatch):
+    """Check each builder, ingest read and processed write is timed with its rows and bytes."""
+    telemetry = process.telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY", "local")
+    telemetry.drain()
+    client = FakeIngestS3Client(dict(PARITY_FILES))
+    monkeypatch.setattr(process, "boto3", MagicMock())
+    process.boto3.client.side_effect = lambda service: client if service == "s3" else MagicMock()
+
+    process.lambda_handler({"updates": ["currency", "address"]}, None)
+    records = telemetry.drain()
+    spans = {(span["Operation"], span.get("Table")): span for span in records}
+
+    # One read per address ingest file
+    reads = [span for span in records if (span["Operation"], span.get("Table")) == ("s3_get", "address")]
+    assert sum(span["rows"] for span in reads) == 3
+    assert sum(span["bytes"] for span in reads) == sum(len(body) for key, body in PARITY_FILES.items() if key.startswith("address/"))
+    assert spans[("s3_put", "dim_currency")]["rows"] == 2
+    assert spans[("s3_put", "dim_currency")]["bytes"] == len(client.objects["dim-currency.parquet"])
+    assert {table for operation, table in spans if operation == "builder"} == {"dim_counterparty", "dim_currency", "dim_location"}
+    assert spans[("invocation", None)]["files"] == 3
+    assert all(span["duration_ms"] >= 0 for span in spans.values())
+
+
+def test_telemetry_is_a_no_op_when_off(monkeypatch):
+    """Check the default hands out the shared null span and records nothing."""
+    telemetry = process.telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY", "off")
+    telemetry.drain()
+
+    with telemetry.span("process", "builder", "dim_currency") as span:
+        span.add("rows", 10)
+        telemetry.add("retries")
+
+    assert span is telemetry.NULL_SPAN
+    assert telemetry.drain() == []
@@ -1,10 +1,21 @@
+import io
 import pandas as pd
 import pytest
+import socket
 from unittest.mock import MagicMock
 
+import src.process_lambda as process
 import src.warehousing_lambda as warehouse
 
 
+@pytest.fixture(autouse=True)
+def clear_warm_caches():
+    """Keep cached secrets, clients and connections from leaking between tests."""
+    warehouse.clear_caches()
+    yield
+    warehouse.clear_caches()
+
+
 def test_get_rds_secret_returns_dict(monkeypatch):
     """Check secret is returned from mocked boto3 secrets manager."""
     fake_secret = {
@@ -116,3 +127,322 @@ def test_lambda_handler_manual_trigger(monkeypatch):
 
     result = warehouse.lambda_handler({}, None)
     assert result["statusCode"] == 200
+
+
+def fact_payment_parquet():
+    source = process.apply_schema(pd.DataFrame({
+        "payment_id": [1, 2],
+        "created_at": ["2025-09-01 10:15:30.5", "2025-09-03 23:59:59"],
+        "last_updated": ["2025-09-02 08:00:00", "2025-09-03 23:59:59"],
+        "transaction_id": [1, None],
+        "counterparty_id": [1, 2],
+        "payment_amount": ["10.50", "3.00"],
+        "currency_id": [1, 2],
+        "payment_type_id": [1, 1],
+        "paid": [True, False],
+        "payment_date": ["2025-09-30", None]
+    }), process.SOURCE_SCHEMAS["payment"])
+    return process.to_parquet_bytes(process.make_fact("fact_payment", source))
+
+
+@pytest.mark.parametrize("key", [
+    "fact-payment.parquet",
+    "deltas/fact-payment/20250911T120000000000Z.parquet",
+    "fact-payment/year=2025/month=09/part-0.parquet"
+])
+def test_to_sql_can_create_fact_tables_read_back_from_parquet(monkeypatch, key):
+    """Check awswrangler maps every column of a real fact, time of day columns included, to a Postgres type."""
+    fact = pd.read_parquet(io.BytesIO(fact_payment_parquet()))
+    created = []
+
+    def fake_to_sql(df, dtype=None, **kwargs):
+        created.append(warehouse.wr._data_types.database_types_from_pandas(
+            df=df, index=False, dtype=dtype, varchar_lengths_default="TEXT", varchar_lengths=None,
+            converter_func=warehouse.wr._data_types.pyarrow2postgresql
+        ))
+
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", lambda path: fact)
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: MagicMock())
+    monkeypatch.setattr(warehouse.wr.postgresql, "read_sql_query", lambda **kwargs: pd.DataFrame({"present": [False]}))
+    monkeypatch.setattr(warehouse.wr.postgresql, "to_sql", fake_to_sql)
+    monkeypatch.setattr(warehouse, "get_client", lambda service: MagicMock())
+
+    warehouse.load_parquet_to_warehouse(key)
+
+    assert created[0]["created_time"] == "TIME"
+    assert created[0]["last_updated_time"] == "TIME"
+    assert created[0]["payment_amount"].startswith("DECIMAL")
+
+
+def test_get_warehouse_connection_reused_while_alive(monkeypatch):
+    """Check warm invocations reuse the warehouse connection until it stops answering."""
+    opened = []
+
+    def fake_connect():
+        conn = MagicMock()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", fake_connect)
+
+    first = warehouse.get_warehouse_connection()
+    assert warehouse.get_warehouse_connection() is first
+
+    first.cursor.return_value.execute.side_effect = Exception("server closed the connection")
+    assert warehouse.get_warehouse_connection() is not first
+    assert len(opened) == 2
+
+
+def test_load_fact_delta_upserts_on_record_id(monkeypatch):
+    """Check a fact delta is upserted into its existing table on the record id, then deleted."""
+    fake_df = pd.DataFrame({"record_payment_id": [3], "payment_id": [1]})
+    connection = MagicMock()
+    s3_client = MagicMock()
+    calls = []
+
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", lambda path: fake_df)
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: connection)
+    monkeypatch.setattr(warehouse.wr.postgresql, "read_sql_query", lambda **kwargs: pd.DataFrame({"present": [True]}))
+    monkeypatch.setattr(warehouse.wr.postgresql, "to_sql", lambda **kwargs: calls.append(kwargs))
+    monkeypatch.setattr(warehouse, "get_client", lambda service: s3_client)
+
+    warehouse.load_parquet_to_warehouse("deltas/fact-payment/20250911T120000000000Z.parquet")
+
+    assert calls[0]["table"] == "payment"
+    assert calls[0]["mode"] == "upsert"
+    assert calls[0]["upsert_conflict_columns"] == ["record_payment_id"]
+    assert "record_payment_id" in connection.cursor().execute.call_args.args[0]
+    s3_client.delete_object.assert_called_once_with(
+        Bucket=warehouse.PROCESSED_BUCKET, Key="deltas/fact-payment/20250911T120000000000Z.parquet"
+    )
+
+
+def test_failed_delta_load_keeps_the_delta(monkeypatch):
+    """Check a delta whose upsert fails stays in the bucket to be loaded again."""
+    fake_df = pd.DataFrame({"record_payment_id": [3], "payment_id": [1]})
+    s3_client = MagicMock()
+
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", lambda path: fake_df)
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: MagicMock())
+    monkeypatch.setattr(warehouse.wr.postgresql, "read_sql_query", lambda **kwargs: pd.DataFrame({"present": [True]}))
+    monkeypatch.setattr(warehouse.wr.postgresql, "to_sql", MagicMock(side_effect=Exception("connection reset")))
+    monkeypatch.setattr(warehouse, "get_client", lambda service: s3_client)
+
+    with pytest.raises(Exception, match="connection reset"):
+        warehouse.load_parquet_to_warehouse("deltas/fact-payment/20250911T120000000000Z.parquet")
+
+    s3_client.delete_object.assert_not_called()
+
+
+@pytest.mark.parametrize("copy_load", [False, True])
+def test_delta_loaded_by_an_earlier_event_is_skipped(monkeypatch, copy_load):
+    """Check a delta another load already deleted does not stop the rest of the event."""
+    gone = "deltas/fact-payment/20250911T120000000000Z.parquet"
+    fake_df = pd.DataFrame({"record_payment_id": [3], "payment_id": [1]})
+    buffer = io.BytesIO()
+    fake_df.to_parquet(buffer, index=False)
+    s3_client = MagicMock()
+
+    def get_object(Bucket, Key):
+        if Key == gone:
+            raise warehouse.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(buffer.getvalue())}
+
+    def read_parquet(path):
+        if path.endswith(gone):
+            raise warehouse.wr.exceptions.NoFilesFound(f"No files found on {path}")
+        return fake_df
+
+    s3_client.get_object.side_effect = get_object
+    loaded = []
+    monkeypatch.setattr(warehouse, "get_client", lambda service: s3_client)
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", read_parquet)
+    monkeypatch.setattr(warehouse, "COPY_LOAD", copy_load)
+    monkeypatch.setattr(warehouse, "copy_to_warehouse", lambda connection, parquet, schema, table_name, **kwargs: loaded.append(table_name))
+    monkeypatch.setattr(warehouse, "upsert_to_warehouse", lambda connection, data, table_name, key: loaded.append(table_name))
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: MagicMock())
+    monkeypatch.setattr(warehouse, "preview_all_tables", lambda *a, **k: True)
+
+    event = {"Records": [
+        {"s3": {"object": {"key": gone}}},
+        {"s3": {"object": {"key": "deltas/fact-payment/20250911T121500000000Z.parquet"}}},
+    ]}
+    result = warehouse.lambda_handler(event, None)
+
+    assert result["statusCode"] == 200
+    assert loaded == ["payment"]
+
+
+def test_load_partition_replaces_only_its_month(monkeypatch):
+    """Check an S3 event for a fact partition deletes and reloads just that month."""
+    fake_df = pd.DataFrame({"record_payment_id": [1], "created_date": [20250911]})
+    connection = MagicMock()
+    calls = []
+
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", lambda path: fake_df)
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: connection)
+    monkeypatch.setattr(warehouse.wr.postgresql, "read_sql_query", lambda **kwargs: pd.DataFrame({"present": [True]}))
+    monkeypatch.setattr(warehouse.wr.postgresql, "to_sql", lambda **kwargs: calls.append(kwargs))
+    monkeypatch.setattr(warehouse, "preview_all_tables", lambda *a, **k: True)
+
+    event = {"Records": [{"s3": {"object": {"key": "fact-payment/year%3D2025/month%3D09/part-0.parquet"}}}]}
+    result = warehouse.lambda_handler(event, None)
+
+    assert result["statusCode"] == 200
+    assert connection.cursor().execute.call_args.args[1] == (20250900, 20250999)
+    assert calls[0]["table"] == "payment"
+    assert calls[0]["mode"] == "append"
+
+
+@pytest.mark.parametrize("copy_load", [False, True])
+def test_load_null_partition_replaces_only_rows_without_a_date(monkeypatch, copy_load):
+    """Check the partition of rows without a created_date replaces just those rows."""
+    fake_df = pd.DataFrame({"record_payment_id": [2], "created_date": pd.array([None], dtype="Int32")})
+    parquet_client(monkeypatch, fake_df)
+    _, statements = copy_connection(monkeypatch, exists=True)
+    monkeypatch.setattr(warehouse, "COPY_LOAD", copy_load)
+    monkeypatch.setattr(warehouse, "preview_all_tables", lambda *a, **k: True)
+
+    event = {"Records": [{"s3": {"object": {"key": "fact-payment/year%3D__null__/month%3D__null__/part-0.parquet"}}}]}
+    result = warehouse.lambda_handler(event, None)
+
+    assert result["statusCode"] == 200
+    assert statements[0][:2] == ('DELETE FROM public."payment" WHERE "created_date" IS NULL', ())
+    if copy_load:
+        assert statements[1][0].startswith('COPY public."payment"')
+    else:
+        assert warehouse.wr.postgresql.to_sql.call_args.kwargs["mode"] == "append"
+
+
+def test_load_parquet_to_warehouse_reports_spans(monkeypatch):
+    """Check the read and the load are reported as separate spans with their row count."""
+    telemetry = warehouse.telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY", "local")
+    telemetry.drain()
+    fake_df = pd.DataFrame({"staff_id": [1, 2]})
+
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", lambda path: fake_df)
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: MagicMock())
+    monkeypatch.setattr(warehouse.wr.postgresql, "to_sql", lambda **kwargs: True)
+
+    warehouse.load_parquet_to_warehouse("dim-staff.parquet")
+
+    spans = telemetry.drain()
+    assert [(span["Operation"], span["Table"], span["rows"]) for span in spans] == [("s3_get", "staff", 2), ("load", "staff", 2)]
+
+
+class FakeCopyCursor:
+    """Records statements and reads COPY streams the way pg8000 does."""
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, args=(), stream=None):
+        copied = b"".join(stream).decode() if stream is not None else None
+        self.statements.append((sql, args, copied))
+
+    def close(self):
+        pass
+
+
+def parquet_client(monkeypatch, data):
+    # get_object serves data as a Parquet file, the COPY loader reads it without wrangler
+    buffer = io.BytesIO()
+    data.to_parquet(buffer, index=False)
+    client = MagicMock()
+    client.get_object.return_value = {"Body": io.BytesIO(buffer.getvalue())}
+    monkeypatch.setattr(warehouse, "get_client", lambda service: client)
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", lambda path: data)
+    return client
+
+
+def copy_connection(monkeypatch, exists):
+    statements = []
+    connection = MagicMock()
+    connection.cursor.side_effect = lambda: FakeCopyCursor(statements)
+    monkeypatch.setattr(warehouse, "COPY_LOAD", True)
+    monkeypatch.setattr(warehouse, "connect_to_warehouse", lambda: connection)
+    monkeypatch.setattr(warehouse.wr.postgresql, "read_sql_query", lambda **kwargs: pd.DataFrame({"present": [exists]}))
+    monkeypatch.setattr(warehouse.wr.postgresql, "to_sql", MagicMock())
+    return connection, statements
+
+
+def test_copy_load_streams_csv_into_a_new_table(monkeypatch):
+    """Check COPY_LOAD recreates the table with to_sql's types and copies every row as CSV."""
+    fake_df = pd.DataFrame({
+        "staff_id": pd.array([1, 2], dtype="Int32"),
+        "first_name": pd.array(["Ann", None], dtype="string"),
+        "last_name": ["", "Lee, Jr"],
+        "department_name": pd.Categorical(["Sales", "Sales"])
+    })
+    monkeypatch.setattr(warehouse, "COPY_BATCH_ROWS", 1)
+    parquet_client(monkeypatch, fake_df)
+    connection, statements = copy_connection(monkeypatch, exists=True)
+
+    warehouse.load_parquet_to_warehouse("dim-staff.parquet")
+
+    assert [sql.split(" (")[0] for sql, _, _ in statements] == [
+        'DROP TABLE IF EXISTS public."staff"',
+        'CREATE TABLE public."staff"',
+        'COPY public."staff"'
+    ]
+    assert '"staff_id" INTEGER, "first_name" TEXT' in statements[1][0]
+    assert statements[2][2] == '1,"Ann","","Sales"\n2,,"Lee, Jr","Sales"\n'
+    connection.commit.assert_called_once()
+    warehouse.wr.postgresql.to_sql.assert_not_called()
+
+
+def test_copy_load_upserts_deltas_through_a_staging_table(monkeypatch):
+    """Check a delta is copied into a temporary table and merged on its record id."""
+    fake_df = pd.DataFrame({"record_payment_id": [3], "payment_id": [1]})
+    client = parquet_client(monkeypatch, fake_df)
+    connection, statements = copy_connection(monkeypatch, exists=True)
+
+    warehouse.load_parquet_to_warehouse("deltas/fact-payment/20250911T120000000000Z.parquet")
+
+    assert statements[1][0] == 'CREATE TEMP TABLE "payment_staging" (LIKE public."payment") ON COMMIT DROP'
+    assert statements[2][0].startswith('COPY "payment_staging"')
+    assert statements[3][0].endswith('ON CONFLICT ("record_payment_id") DO UPDATE SET '
+                                     '"record_payment_id" = EXCLUDED."record_payment_id", "payment_id" = EXCLUDED."payment_id"')
+    connection.commit.assert_called_once()
+    client.delete_object.assert_called_once_with(
+        Bucket=warehouse.PROCESSED_BUCKET, Key="deltas/fact-payment/20250911T120000000000Z.parquet"
+    )
+
+
+def test_copy_load_falls_back_to_to_sql_for_unsupported_types(monkeypatch):
+    """Check a file with a column COPY has no type for is still loaded through to_sql."""
+    fake_df = pd.DataFrame({"staff_id": [1], "tags": [[1, 2]]})
+    parquet_client(monkeypatch, fake_df)
+    _, statements = copy_connection(monkeypatch, exists=True)
+
+    warehouse.load_parquet_to_warehouse("dim-staff.parquet")
+
+    assert statements == []
+    assert warehouse.wr.postgresql.to_sql.call_args.kwargs["mode"] == "overwrite"
+
+
+def test_copy_load_reads_the_parquet_file_in_batches(monkeypatch):
+    """Check the COPY loader decodes the file itself, one record batch per COPY chunk."""
+    fake_df = pd.DataFrame({"staff_id": [1, 2, 3]})
+    parquet_client(monkeypatch, fake_df)
+    monkeypatch.setattr(warehouse, "COPY_BATCH_ROWS", 2)
+    monkeypatch.setattr(warehouse.wr.s3, "read_parquet", MagicMock())
+    chunks = []
+    monkeypatch.setattr(warehouse, "copy_rows", lambda cursor, parquet, schema, target: chunks.extend(warehouse.csv_batches(parquet, schema)))
+    copy_connection(monkeypatch, exists=True)
+
+    warehouse.load_parquet_to_warehouse("dim-staff.parquet")
+
+    assert chunks == [b"1\n2\n", b"3\n"]
+    warehouse.wr.s3.read_parquet.assert_not_called()
+
+
+def test_copy_load_sends_without_nagle_delay():
+    """Check the warehouse socket is switched to TCP_NODELAY before a COPY."""
+    connection = MagicMock()
+    connection._usock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        warehouse.send_without_delay(connection)
+        assert connection._usock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        connection._usock.close()
@@ -0,0 +1,86 @@
+import argparse
+from io import BytesIO
+import json
+import logging
+from pathlib import Path
+import sys
+import time
+from unittest.mock import patch
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import process_lambda as process
+from pipeline_benchmark import PeakMemorySampler
+from schema_memory import load_ingest_bucket
+
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+
+def run_transform(s3, backend, workers):
+    # Every output from scratch, written to the in-memory processed bucket
+    builds = list(process.BUILDER_INPUTS)
+    loader = process.TableLoader(s3, [table for name in builds for table in process.BUILDER_INPUTS[name]], backend)
+    tasks, dependencies = process.make_tasks(s3, loader, builds)
+    with (
+        patch.object(process, 'get_parquet', lambda client, table: None),
+        patch.object(process, 'get_content_hash', lambda client, key: None)
+    ):
+        return process.run_builders(tasks, dependencies, max_workers=workers)
+
+
+def read_outputs(s3, keys):
+    return {key: pq.read_table(BytesIO(s3.body(process.PROCESSED_BUCKET, key))) for key in keys}
+
+
+def compare(scale, seed, repeats, workers):
+    s3 = load_ingest_bucket(scale, seed)
+
+    results = []
+    outputs = {}
+    for backend in ('pandas', 'arrow'):
+        timings = []
+        peak = 0
+        for _ in range(repeats):
+            with PeakMemorySampler() as memory:
+                start = time.perf_counter()
+                keys = run_transform(s3, backend, workers)
+                timings.append(time.perf_counter() - start)
+            peak = max(peak, memory.peak)
+        outputs[backend] = read_outputs(s3, keys)
+        rows = sum(table.num_rows for table in outputs[backend].values())
+        results.append({
+            'backend': backend,
+            'outputs': len(keys),
+            'rows': rows,
+            'best_seconds': round(min(timings), 3),
+            'rows_per_second': round(rows / min(timings), 1),
+            'peak_rss_mb': round(peak / 1024 ** 2, 1)
+        })
+
+    # The comparison only counts if both backends wrote the same tables
+    identical = all(
+        outputs['arrow'][key].to_pylist() == table.to_pylist() for key, table in outputs['pandas'].items()
+    )
+    for result in results:
+        result['identical_output'] = identical
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the pandas and arrow transform backends')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=process.BUILDER_WORKERS)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = compare(args.scale, args.seed, args.repeats, args.workers)
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
@@ -0,0 +1,378 @@
+import argparse
+from datetime import datetime, timedelta
+from io import StringIO
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pg8000
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Row counts of the source database today, --scale multiplies the ones that grow
+BASE_ROWS = {
+    'address': 30,
+    'counterparty': 20,
+    'currency': 3,
+    'department': 8,
+    'design': 300,
+    'payment_type': 4,
+    'staff': 20,
+    'purchase_order': 3000,
+    'sales_order': 10000
+}
+
+FIXED_TABLES = ['currency', 'department', 'payment_type']
+
+# Same layout as the totesys source, every table has created_at/last_updated
+TABLE_DDL = {
+    'address': """
+        address_id int PRIMARY KEY,
+        address_line_1 varchar NOT NULL,
+        address_line_2 varchar,
+        district varchar,
+        city varchar NOT NULL,
+        postal_code varchar NOT NULL,
+        country varchar NOT NULL,
+        phone varchar NOT NULL""",
+    'counterparty': """
+        counterparty_id int PRIMARY KEY,
+        counterparty_legal_name varchar NOT NULL,
+        legal_address_id int NOT NULL,
+        commercial_contact varchar,
+        delivery_contact varchar""",
+    'currency': """
+        currency_id int PRIMARY KEY,
+        currency_code varchar(3) NOT NULL""",
+    'department': """
+        department_id int PRIMARY KEY,
+        department_name varchar NOT NULL,
+        location varchar,
+        manager varchar""",
+    'design': """
+        design_id int PRIMARY KEY,
+        design_name varchar NOT NULL,
+        file_location varchar NOT NULL,
+        file_name varchar NOT NULL""",
+    'payment_type': """
+        payment_type_id int PRIMARY KEY,
+        payment_type_name varchar NOT NULL""",
+    'staff': """
+        staff_id int PRIMARY KEY,
+        first_name varchar NOT NULL,
+        last_name varchar NOT NULL,
+        department_id int NOT NULL,
+        email_address varchar NOT NULL""",
+    'purchase_order': """
+        purchase_order_id int PRIMARY KEY,
+        staff_id int NOT NULL,
+        counterparty_id int NOT NULL,
+        item_code varchar NOT NULL,
+        item_quantity int NOT NULL,
+        item_unit_price numeric NOT NULL,
+        currency_id int NOT NULL,
+        agreed_delivery_date varchar NOT NULL,
+        agreed_payment_date varchar NOT NULL,
+        agreed_delivery_location_id int NOT NULL""",
+    'sales_order': """
+        sales_order_id int PRIMARY KEY,
+        design_id int NOT NULL,
+        staff_id int NOT NULL,
+        counterparty_id int NOT NULL,
+        units_sold int NOT NULL,
+        unit_price numeric(10, 2) NOT NULL,
+        currency_id int NOT NULL,
+        agreed_delivery_date varchar NOT NULL,
+        agreed_payment_date varchar NOT NULL,
+        agreed_delivery_location_id int NOT NULL""",
+    'transaction': """
+        transaction_id int PRIMARY KEY,
+        transaction_type varchar NOT NULL,
+        sales_order_id int,
+        purchase_order_id int""",
+    'payment': """
+        payment_id int PRIMARY KEY,
+        transaction_id int NOT NULL,
+        counterparty_id int NOT NULL,
+        payment_amount numeric(10, 2) NOT NULL,
+        currency_id int NOT NULL,
+        payment_type_id int NOT NULL,
+        paid boolean NOT NULL,
+        payment_date varchar NOT NULL,
+        company_ac_number int NOT NULL,
+        counterparty_ac_number int NOT NULL"""
+}
+
+CITIES = ['Leeds', 'Wakefield', 'Manchester', 'London', 'Bristol', 'York', 'Hull', 'Sheffield']
+COUNTRIES = ['United Kingdom', 'Ireland', 'France', 'Germany', 'Spain']
+NAMES = ['Jeremie', 'Deron', 'Jeanette', 'Ana', 'Magdalena', 'Korey', 'Raphael', 'Oswaldo']
+SURNAMES = ['Franey', 'Beier', 'Erdman', 'Glover', 'Zieme', 'Kreiger', 'Rippin', 'Bednar']
+DESIGNS = ['Wooden', 'Granite', 'Bronze', 'Soft', 'Rubber', 'Steel', 'Plastic', 'Cotton']
+
+
+def connect_to_local_database(host, port, database, user, password):
+    return pg8000.connect(host=host, port=int(port), database=database, user=user, password=password)
+
+
+def timestamps(rng, n, start, end):
+    seconds = rng.integers(0, int((end - start).total_seconds()), size=n)
+    micros = rng.integers(0, 1_000_000, size=n)
+    return pd.to_datetime(start) + pd.to_timedelta(seconds, unit='s') + pd.to_timedelta(micros, unit='us')
+
+
+def date_strings(rng, created, max_days):
+    offsets = pd.to_timedelta(rng.integers(1, max_days, size=len(created)), unit='D')
+    return (pd.DatetimeIndex(created) + offsets).strftime('%Y-%m-%d')
+
+
+def with_timestamps(df, rng, start, end):
+    created = timestamps(rng, len(df), start, end)
+    df['created_at'] = created
+    df['last_updated'] = created
+    return df
+
+
+def make_reference_tables(rng, counts, start, end):
+    tables = {}
+    n = counts['address']
+    tables['address'] = pd.DataFrame({
+        'address_id': np.arange(1, n + 1),
+        'address_line_1': [f'{i} {SURNAMES[i % len(SURNAMES)]} Street' for i in range(n)],
+        'address_line_2': np.where(rng.random(n) < 0.5, None, 'Unit 2'),
+        'district': np.where(rng.random(n) < 0.5, None, 'Avon'),
+        'city': rng.choice(CITIES, n),
+        'postal_code': [f'{i:05d}' for i in range(n)],
+        'country': rng.choice(COUNTRIES, n),
+        'phone': [f'07{i:09d}' for i in range(n)]
+    })
+    n = counts['counterparty']
+    tables['counterparty'] = pd.DataFrame({
+        'counterparty_id': np.arange(1, n + 1),
+        'counterparty_legal_name': [f'{SURNAMES[i % len(SURNAMES)]} Partners {i}' for i in range(n)],
+        'legal_address_id': rng.integers(1, counts['address'] + 1, n),
+        'commercial_contact': rng.choice(NAMES, n),
+        'delivery_contact': rng.choice(NAMES, n)
+    })
+    tables['currency'] = pd.DataFrame({
+        'currency_id': [1, 2, 3],
+        'currency_code': ['GBP', 'USD', 'EUR']
+    })
+    n = counts['department']
+    tables['department'] = pd.DataFrame({
+        'department_id': np.arange(1, n + 1),
+        'department_name': [f'Department {i}' for i in range(1, n + 1)],
+        'location': rng.choice(CITIES, n),
+        'manager': rng.choice(NAMES, n)
+    })
+    n = counts['design']
+    tables['design'] = pd.DataFrame({
+        'design_id': np.arange(1, n + 1),
+        'design_name': rng.choice(DESIGNS, n),
+        'file_location': '/usr/designs',
+        'file_name': [f'design-{i}.json' for i in range(1, n + 1)]
+    })
+    tables['payment_type'] = pd.DataFrame({
+        'payment_type_id': [1, 2, 3, 4],
+        'payment_type_name': ['SALES_RECEIPT', 'SALES_REFUND', 'PURCHASE_PAYMENT', 'PURCHASE_REFUND']
+    })
+    n = counts['staff']
+    first_names = rng.choice(NAMES, n)
+    last_names = rng.choice(SURNAMES, n)
+    tables['staff'] = pd.DataFrame({
+        'staff_id': np.arange(1, n + 1),
+        'first_name': first_names,
+        'last_name': last_names,
+        'department_id': rng.integers(1, counts['department'] + 1, n),
+        'email_address': [f'{f}.{l}{i}@terrifictotes.com'.lower() for i, (f, l) in enumerate(zip(first_names, last_names))]
+    })
+    return {table: with_timestamps(df, rng, start, end) for table, df in tables.items()}
+
+
+def make_order_tables(rng, counts, n_purchases, n_sales, first_ids, start, end):
+    # first_ids holds the next free id of purchase_order, sales_order, transaction and payment
+    purchase_ids = np.arange(first_ids['purchase_order'], first_ids['purchase_order'] + n_purchases)
+    created = timestamps(rng, n_purchases, start, end)
+    purchase_order = pd.DataFrame({
+        'purchase_order_id': purchase_ids,
+        'created_at': created,
+        'last_updated': created,
+        'staff_id': rng.integers(1, counts['staff'] + 1, n_purchases),
+        'counterparty_id': rng.integers(1, counts['counterparty'] + 1, n_purchases),
+        'item_code': [f'ITEM{i % 997:04d}' for i in purchase_ids],
+        'item_quantity': rng.integers(1, 1000, n_purchases),
+        'item_unit_price': rng.integers(100, 100000, n_purchases) / 100,
+        'currency_id': rng.integers(1, 4, n_purchases),
+        'agreed_delivery_date': date_strings(rng, created, 30),
+        'agreed_payment_date': date_strings(rng, created, 60),
+        'agreed_delivery_location_id': rng.integers(1, counts['address'] + 1, n_purchases)
+    })
+
+    sales_ids = np.arange(first_ids['sales_order'], first_ids['sales_order'] + n_sales)
+    created = timestamps(rng, n_sales, start, end)
+    sales_order = pd.DataFrame({
+        'sales_order_id': sales_ids,
+        'created_at': created,
+        'last_updated': created,
+        'design_id': rng.integers(1, counts['design'] + 1, n_sales),
+        'staff_id': rng.integers(1, counts['staff'] + 1, n_sales),
+        'counterparty_id': rng.integers(1, counts['counterparty'] + 1, n_sales),
+        'units_sold': rng.integers(1, 100000, n_sales),
+        'unit_price': rng.integers(200, 400, n_sales) / 100,
+        'currency_id': rng.integers(1, 4, n_sales),
+        'agreed_delivery_date': date_strings(rng, created, 30),
+        'agreed_payment_date': date_strings(rng, created, 60),
+        'agreed_delivery_location_id': rng.integers(1, counts['address'] + 1, n_sales)
+    })
+
+    # One transaction and one payment per order, like the source
+    n_transactions = n_purchases + n_sales
+    transaction_ids = np.arange(first_ids['transaction'], first_ids['transaction'] + n_transactions)
+    order_created = pd.concat([purchase_order['created_at'], sales_order['created_at']], ignore_index=True)
+    transaction = pd.DataFrame({
+        'transaction_id': transaction_ids,
+        'transaction_type': ['PURCHASE'] * n_purchases + ['SALE'] * n_sales,
+        'sales_order_id': pd.array([None] * n_purchases + list(sales_ids), dtype='Int64'),
+        'purchase_order_id': pd.array(list(purchase_ids) + [None] * n_sales, dtype='Int64'),
+        'created_at': order_created,
+        'last_updated': order_created
+    })
+
+    payment_ids = np.arange(first_ids['payment'], first_ids['payment'] + n_transactions)
+    order_counterparties = pd.concat(
+        [purchase_order['counterparty_id'], sales_order['counterparty_id']], ignore_index=True
+    )
+    payment = pd.DataFrame({
+        'payment_id': payment_ids,
+        'created_at': order_created,
+        'last_updated': order_created,
+        'transaction_id': transaction_ids,
+        'counterparty_id': order_counterparties,
+        'payment_amount': rng.integers(100, 1000000, n_transactions) / 100,
+        'currency_id': rng.integers(1, 4, n_transactions),
+        'payment_type_id': rng.integers(1, 5, n_transactions),
+        'paid': rng.random(n_transactions) < 0.5,
+        'payment_date': date_strings(rng, order_created, 60),
+        'company_ac_number': rng.integers(10000000, 99999999, n_transactions),
+        'counterparty_ac_number': rng.integers(10000000, 99999999, n_transactions)
+    })
+    return {
+        'purchase_order': purchase_order,
+        'sales_order': sales_order,
+        'transaction': transaction,
+        'payment': payment
+    }
+
+
+def scaled_counts(scale):
+    return {
+        table: rows if table in FIXED_TABLES else max(1, int(rows * scale))
+        for table, rows in BASE_ROWS.items()
+    }
+
+
+def copy_into(connection, table, df):
+    buffer = StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    connection.run(f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)", stream=buffer)
+
+
+def create_source_database(connection, scale=1.0, seed=0, days=365):
+    counts = scaled_counts(scale)
+    rng = np.random.default_rng(seed)
+    end = datetime.now()
+    start = end - timedelta(days=days)
+
+    for table, columns in TABLE_DDL.items():
+        connection.run(f'DROP TABLE IF EXISTS {table}')
+        connection.run(
+            f'CREATE TABLE {table} ({columns}, '
+            f'created_at timestamp NOT NULL DEFAULT now(), last_updated timestamp NOT NULL DEFAULT now())'
+        )
+        # The index the incremental extraction pages on
+        connection.run(f'CREATE INDEX {table}_last_updated_idx ON {table} (last_updated, {table}_id)')
+
+    tables = make_reference_tables(rng, counts, start, end)
+    first_ids = {'purchase_order': 1, 'sales_order': 1, 'transaction': 1, 'payment': 1}
+    tables.update(make_order_tables(
+        rng, counts, counts['purchase_order'], counts['sales_order'], first_ids, start, end
+    ))
+
+    for table, df in tables.items():
+        logger.info(f'Loading {len(df)} rows into {table}')
+        copy_into(connection, table, df)
+    connection.commit()
+    return {table: len(df) for table, df in tables.items()}
+
+
+def apply_updates(connection, update_rate=0.01, insert_rate=0.01, seed=1):
+    # Simulates one scheduler tick of source activity: a share of every table
+    # is touched and new orders arrive with their transactions and payments
+    rng = np.random.default_rng(seed)
+    now = datetime.now()
+    counts = {
+        table: connection.run(f'SELECT count(*) FROM {table}')[0][0]
+        for table in TABLE_DDL.keys()
+    }
+    first_ids = {
+        table: connection.run(f'SELECT coalesce(max({table}_id), 0) + 1 FROM {table}')[0][0]
+        for table in ['purchase_order', 'sales_order', 'transaction', 'payment']
+    }
+
+    for table in TABLE_DDL.keys():
+        connection.run(
+            f'UPDATE {table} SET last_updated = now() '
+            f'WHERE {table}_id IN (SELECT {table}_id FROM {table} TABLESAMPLE BERNOULLI (:percent))',
+            percent=update_rate * 100
+        )
+
+    new_orders = make_order_tables(
+        rng,
+        counts,
+        int(counts['purchase_order'] * insert_rate),
+        int(counts['sales_order'] * insert_rate),
+        first_ids,
+        now - timedelta(minutes=20),
+        now
+    )
+    for table, df in new_orders.items():
+        copy_into(connection, table, df)
+        # Stamped like the updates, after the watermark the last tick advanced to
+        connection.run(
+            f'UPDATE {table} SET last_updated = now() WHERE {table}_id >= :first_id',
+            first_id=first_ids[table]
+        )
+    connection.commit()
+    return {table: len(df) for table, df in new_orders.items()}
+
+
+def parse_connection_args(parser):
+    parser.add_argument('--host', default=os.environ.get('BENCH_SOURCE_HOST', 'localhost'))
+    parser.add_argument('--port', default=os.environ.get('BENCH_SOURCE_PORT', '5432'))
+    parser.add_argument('--database', default=os.environ.get('BENCH_SOURCE_DATABASE', 'totesys'))
+    parser.add_argument('--user', default=os.environ.get('BENCH_SOURCE_USER', 'postgres'))
+    parser.add_argument('--password', default=os.environ.get('BENCH_SOURCE_PASSWORD', 'postgres'))
+
+
+if __name__ == '__main__':
+    logging.getLogger().addHandler(logging.StreamHandler())
+    parser = argparse.ArgumentParser(description='Fill a local Postgres with synthetic source tables')
+    parse_connection_args(parser)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiple of the current source volume')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--days', type=int, default=365, help='history covered by created_at')
+    parser.add_argument('--update-rate', type=float, help='only apply one tick of updates at this rate')
+    parser.add_argument('--insert-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    conn = connect_to_local_database(args.host, args.port, args.database, args.user, args.password)
+    if args.update_rate is None:
+        rows = create_source_database(conn, args.scale, args.seed, args.days)
+    else:
+        rows = apply_updates(conn, args.update_rate, args.insert_rate, args.seed)
+    conn.close()
+    for table, count in rows.items():
+        print(f'{table}: {count} rows')
@@ -0,0 +1,102 @@
+import argparse
+from contextlib import ExitStack
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+from unittest.mock import patch
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import process_lambda as process
+import warehousing_lambda as warehouse
+import generate_source_data as generator
+from backend_benchmark import run_transform
+from pipeline_benchmark import local_wrangler
+from schema_memory import load_ingest_bucket
+
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+
+def warehouse_rows(connection, table_name):
+    return connection.run(f'SELECT count(*) FROM public."{table_name}"')[0][0]
+
+
+def load_all(s3, keys, connection, copy_load):
+    # Every output is loaded into an emptied warehouse, once per loader
+    results = []
+    warehouse.COPY_LOAD = copy_load
+    for key in sorted(keys):
+        table_name = key.split('.')[0].replace('dim-', '').replace('fact-', '').replace('-', '_')
+        connection.run(f'DROP TABLE IF EXISTS public."{table_name}"')
+        connection.commit()
+        start = time.perf_counter()
+        try:
+            warehouse.load_parquet_to_warehouse(key)
+            error = None
+        except Exception as e:
+            connection.rollback()
+            error = str(e).splitlines()[0]
+        seconds = time.perf_counter() - start
+        rows = None if error else warehouse_rows(connection, table_name)
+        results.append({
+            'loader': 'copy' if copy_load else 'to_sql',
+            'table': table_name,
+            'rows': rows,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds, 1) if rows else None,
+            'error': error
+        })
+    return results
+
+
+def benchmark(args):
+    connection_args = dict(
+        host=args.host, port=args.port, database=args.warehouse_database, user=args.user, password=args.password
+    )
+    s3 = load_ingest_bucket(args.scale, args.seed)
+    keys = run_transform(s3, 'pandas', process.BUILDER_WORKERS)
+    connection = generator.connect_to_local_database(**connection_args)
+
+    results = []
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(warehouse.wr.s3, 'read_parquet', local_wrangler(s3)['read_parquet']))
+        stack.enter_context(patch.object(warehouse, 'get_warehouse_connection', lambda: connection))
+        # The COPY loader reads the Parquet file itself rather than through wrangler
+        stack.enter_context(patch.object(warehouse, 'get_client', lambda service: s3))
+        for copy_load in (False, True):
+            results.extend(load_all(s3, keys, connection, copy_load))
+    connection.close()
+    return results
+
+
+def summarise(results):
+    # Throughput over the files each loader managed to load
+    frame = pd.DataFrame(results)
+    loaded = frame[frame['error'].isna()]
+    totals = loaded.groupby('loader', sort=False).agg(files=('table', 'size'), rows=('rows', 'sum'), seconds=('seconds', 'sum'))
+    totals['rows_per_second'] = (totals['rows'] / totals['seconds']).round(1)
+    return totals.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare to_sql and COPY loads of every output into a local Postgres')
+    generator.parse_connection_args(parser)
+    parser.add_argument('--warehouse-database', default=os.environ.get('BENCH_WAREHOUSE_DATABASE', 'warehouse'))
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    print(pd.DataFrame(results).to_string(index=False))
+    print()
+    print(summarise(results).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
@@ -0,0 +1,234 @@
+import argparse
+from datetime import datetime, timedelta
+import gc
+import json
+import logging
+from pathlib import Path
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import ingestion_lambda as ingestion
+import process_lambda as process
+import generate_source_data as generator
+from pipeline_benchmark import LocalS3, PeakMemorySampler
+
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+BASELINE_FILE = Path(__file__).resolve().parent / 'baselines' / 'micro_benchmark.json'
+DEFAULT_ROWS = [10_000, 1_000_000]
+INGEST_FILES = 8
+
+# Cases are gated on their best time over at least MIN_REPEATS runs. A case
+# is only slower once it passes the relative tolerance by more than the larger
+# of MIN_SECONDS and NOISE_SIGMAS standard deviations of its run-to-run times,
+# as recorded with the baseline or measured now. Memory differences below
+# MIN_PEAK_MB are ignored whatever the tolerance.
+MIN_REPEATS = 5
+MIN_SECONDS = 0.02
+NOISE_SIGMAS = 3
+MIN_PEAK_MB = 16
+
+
+class FrameLoader:
+    """Hands the builders prepared tables, like a TableLoader that already fetched them."""
+    def __init__(self, tables, backend='pandas'):
+        self.tables = tables
+        self.backend = backend
+
+    def get(self, table_name):
+        return self.tables[table_name]
+
+
+def make_sources(rows, seed):
+    # Every growing table gets the same number of rows, the lookup tables stay fixed
+    rng = np.random.default_rng(seed)
+    end = datetime(2025, 9, 11)
+    start = end - timedelta(days=365)
+    counts = {table: count if table in generator.FIXED_TABLES else rows for table, count in generator.BASE_ROWS.items()}
+
+    tables = generator.make_reference_tables(rng, counts, start, end)
+    first_ids = {'purchase_order': 1, 'sales_order': 1, 'transaction': 1, 'payment': 1}
+    tables.update(generator.make_order_tables(rng, counts, rows // 2, rows - rows // 2, first_ids, start, end))
+    return {table: tables[table][columns] for table, columns in ingestion.TABLE_LIST.items()}
+
+
+def typed_sources(raw):
+    frames = {table: process.apply_schema(data, process.SOURCE_SCHEMAS[table]) for table, data in raw.items()}
+    tables = {
+        table: process.cast_table(
+            pa.Table.from_pandas(data, preserve_index=False),
+            process.arrow_schema(process.SOURCE_SCHEMAS[table])
+        )
+        for table, data in frames.items()
+    }
+    return frames, tables
+
+
+def load_ingest_files(raw, table):
+    s3 = LocalS3()
+    for number, part in enumerate(np.array_split(np.arange(len(raw[table])), INGEST_FILES)):
+        body = raw[table].iloc[part].to_csv(index=False)
+        s3.put_object(ingestion.INGEST_BUCKET, f'{table}/2025-09-11 12:{number:02d}.csv', body)
+    return s3
+
+
+def make_cases(raw):
+    frames, tables = typed_sources(raw)
+    loader, arrow_loader = FrameLoader(frames), FrameLoader(tables, 'arrow')
+    s3 = load_ingest_files(raw, 'payment')
+
+    cases = {
+        'get_from_ingest[payment]': lambda: process.get_from_ingest(s3, 'payment'),
+        'get_arrow_from_ingest[payment]': lambda: process.get_arrow_from_ingest(s3, 'payment'),
+        'make_dim_dates': lambda: process.make_dim_dates(frames['payment'], frames['purchase_order'], frames['sales_order'])
+    }
+    for name, builder in process.DIMENSION_BUILDERS.items():
+        cases[builder.__name__] = lambda builder=builder: builder(None, loader)
+        cases[f'make_arrow_dimension[{name}]'] = lambda name=name: process.make_arrow_dimension(name, arrow_loader)
+    for name, spec in process.FACT_SPECS.items():
+        source = spec['source']
+        cases[f'make_fact[{name}]'] = lambda name=name, source=source: process.make_fact(name, frames[source])
+        cases[f'make_arrow_fact[{name}]'] = lambda name=name, source=source: process.make_arrow_fact(name, tables[source])
+        cases[f'make_fact_delta[{name}]'] = lambda name=name, source=source: process.make_fact_delta(name, frames[source])
+    return cases
+
+
+class ArrowMemorySampler(PeakMemorySampler):
+    """Samples the bytes held in Arrow's memory pool, which tracemalloc does not see."""
+    def current_rss(self):
+        return pa.total_allocated_bytes()
+
+
+def measure(case, repeats):
+    # RSS keeps memory the allocator already freed, so it hides what a case
+    # allocates after a bigger one ran. Peak memory comes from one more run
+    # instead, tracing Python and numpy allocations and sampling Arrow's pool.
+    timings = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        case()
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    arrow_before = pa.total_allocated_bytes()
+    # Tracing stops only after the sampler thread has joined, stopping it
+    # while another thread allocates can crash older 3.12 releases
+    tracemalloc.start()
+    with ArrowMemorySampler(interval=0.002) as arrow:
+        case()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak = traced_peak + max(arrow.peak - arrow_before, 0)
+    return timings, peak / 1024 ** 2
+
+
+def run(rows_list, repeats, seed, only=None):
+    results = []
+    repeats = max(repeats, MIN_REPEATS)
+    for rows in rows_list:
+        cases = make_cases(make_sources(rows, seed))
+        for name, case in cases.items():
+            if only and only not in name:
+                continue
+            timings, peak_mb = measure(case, repeats)
+            results.append({
+                'case': name,
+                'rows': rows,
+                'seconds': round(min(timings), 4),
+                'median_seconds': round(statistics.median(timings), 4),
+                'noise_seconds': round(statistics.stdev(timings), 4),
+                'peak_mb': round(peak_mb, 1)
+            })
+            print(f'{name} at {rows} rows: {min(timings):.4f} s, {peak_mb:.1f} MB', file=sys.stderr)
+    return results
+
+
+def baseline_key(result):
+    return f'{result["case"]}@{result["rows"]}'
+
+
+def load_baselines():
+    if not BASELINE_FILE.exists():
+        return {}
+    return json.loads(BASELINE_FILE.read_text())['results']
+
+
+def save_baselines(results):
+    # Merged into what is there, so one scale can be re-recorded on its own
+    baselines = load_baselines()
+    baselines.update({
+        baseline_key(result): {
+            'seconds': result['seconds'],
+            'noise_seconds': result['noise_seconds'],
+            'peak_mb': result['peak_mb']
+        }
+        for result in results
+    })
+    BASELINE_FILE.parent.mkdir(exist_ok=True)
+    BASELINE_FILE.write_text(json.dumps({
+        'recorded_with': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'pyarrow': pa.__version__,
+            'machine': platform.machine()
+        },
+        'results': dict(sorted(baselines.items()))
+    }, indent=2) + '\n')
+
+
+def check(results, baselines, time_tolerance, memory_tolerance):
+    for result in results:
+        baseline = baselines.get(baseline_key(result))
+        if baseline is None:
+            result['status'] = 'new'
+            continue
+        result['baseline_seconds'] = baseline['seconds']
+        result['baseline_peak_mb'] = baseline['peak_mb']
+        noise = max(MIN_SECONDS, NOISE_SIGMAS * max(baseline.get('noise_seconds', 0), result['noise_seconds']))
+        slower = result['seconds'] > baseline['seconds'] * (1 + time_tolerance) + noise
+        bigger = (
+            result['peak_mb'] > baseline['peak_mb'] * (1 + memory_tolerance)
+            and result['peak_mb'] - baseline['peak_mb'] > MIN_PEAK_MB
+        )
+        result['status'] = ' '.join(name for name, failed in (('SLOWER', slower), ('BIGGER', bigger)) if failed) or 'ok'
+    return [result for result in results if result['status'] not in ('ok', 'new')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the make_* builders and get_from_ingest against stored baselines')
+    parser.add_argument('--rows', default=','.join(str(rows) for rows in DEFAULT_ROWS),
+                        help='comma separated row counts, e.g. 10000,1000000,10000000')
+    parser.add_argument('--repeats', type=int, default=MIN_REPEATS, help=f'timed runs per case, at least {MIN_REPEATS}')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='only run cases whose name contains this')
+    parser.add_argument('--time-tolerance', type=float, default=0.5, help='allowed slowdown, 0.5 is 50%%')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='allowed growth of peak memory')
+    parser.add_argument('--update', action='store_true', help='record the results as the new baselines')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run([int(rows) for rows in args.rows.split(',')], args.repeats, args.seed, args.only)
+    if args.update:
+        save_baselines(results)
+        regressions = []
+    else:
+        regressions = check(results, load_baselines(), args.time_tolerance, args.memory_tolerance)
+
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if regressions:
+        print(f'\n{len(regressions)} cases exceeded their baseline', file=sys.stderr)
+        sys.exit(1)
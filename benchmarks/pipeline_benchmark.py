@@ -0,0 +1,403 @@
+import argparse
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+import json
+import logging
+import os
+from pathlib import Path
+import resource
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+import boto3
+from botocore.exceptions import ClientError
+import pandas as pd
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import ingestion_lambda as ingestion
+import process_lambda as process
+import telemetry
+import warehousing_lambda as warehouse
+import generate_source_data as generator
+
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+
+class LocalS3:
+    """In-memory stand-in for the S3 calls made by the three lambdas."""
+    def __init__(self):
+        self.buckets = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.uploads = {}
+        self.metadata = {}
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def _bucket(self, name):
+        return self.buckets.setdefault(name, {})
+
+    def _missing(self, operation, code='NoSuchKey'):
+        return ClientError({'Error': {'Code': code}}, operation)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        body = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        with self.lock:
+            bucket = self._bucket(Bucket)
+            current = bucket.get(Key)
+            if IfNoneMatch == '*' and current is not None:
+                raise self._missing('PutObject', 'PreconditionFailed')
+            if IfMatch is not None and (current is None or current[1] != IfMatch):
+                raise self._missing('PutObject', 'PreconditionFailed')
+            etag = f'"{time.monotonic_ns()}"'
+            bucket[Key] = (body, etag)
+            self.metadata[(Bucket, Key)] = Metadata or {}
+            self.bytes_written += len(body)
+            self.writes.append((Bucket, Key))
+        return {'ETag': etag}
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            if Key not in self._bucket(Bucket):
+                raise self._missing('GetObject')
+            body, etag = self._bucket(Bucket)[Key]
+            self.bytes_read += len(body)
+        return {'Body': BytesIO(body), 'ETag': etag, 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self._bucket(Bucket):
+            raise self._missing('HeadObject', '404')
+        body, etag = self._bucket(Bucket)[Key]
+        return {'ETag': etag, 'ContentLength': len(body), 'Metadata': self.metadata.get((Bucket, Key), {})}
+
+    def list_objects(self, Bucket, Prefix='', Marker='', **kwargs):
+        keys = sorted(key for key in self._bucket(Bucket) if key.startswith(Prefix) and key > Marker)
+        response = {'Contents': [{'Key': key, 'Size': len(self._bucket(Bucket)[key][0])} for key in keys[:1000]]}
+        response['IsTruncated'] = len(keys) > 1000
+        if not response['Contents']:
+            del response['Contents']
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, **kwargs):
+        response = self.list_objects(Bucket, Prefix, ContinuationToken or StartAfter)
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = response['Contents'][-1]['Key']
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = f'{Key}-{time.monotonic_ns()}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        body = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return self.put_object(Bucket, Key, body)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self._bucket(Bucket).pop(Key, None)
+            self.metadata.pop((Bucket, Key), None)
+
+    def body(self, bucket, key):
+        return self._bucket(bucket)[key][0]
+
+
+class FakeLambda:
+    """Records invocations so the harness can run the next stage itself."""
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        # Same arguments as boto3 accepts, so a misnamed one fails here too
+        self.invocations.append((FunctionName, json.loads(Payload)))
+        return {'StatusCode': 202}
+
+
+class PeakMemorySampler:
+    """Samples resident memory on a thread, ru_maxrss cannot be reset between stages."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def current_rss(self):
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current_rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+class TickClock(datetime):
+    """The ingestion lambda's clock, moved on a minute per tick.
+
+    Ingest keys are named to the minute, so ticks run within the same minute
+    would otherwise overwrite each other's files.
+    """
+    offset = timedelta(0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(tz) + cls.offset
+
+    @classmethod
+    def fromisoformat(cls, text):
+        # Watermarks stay plain datetimes, which pg8000 sends as timestamps
+        return datetime.fromisoformat(text)
+
+
+# Each warehouse table against the source table it holds one row per id of
+WAREHOUSE_SOURCES = {
+    'payment': ('payment', 'payment_id'),
+    'purchase_order': ('purchase_order', 'purchase_order_id'),
+    'sales_order': ('sales_order', 'sales_order_id'),
+    'transaction': ('transaction', 'transaction_id'),
+    'staff': ('staff', 'staff_id'),
+    'counterparty': ('counterparty', 'counterparty_id'),
+    'design': ('design', 'design_id'),
+    'location': ('address', 'location_id'),
+    'payment_type': ('payment_type', 'payment_type_id'),
+}
+
+
+def check_warehouse(source_args, warehouse_args):
+    # Facts keep a row per version of a source row, so ids are counted
+    source = generator.connect_to_local_database(**source_args)
+    target = generator.connect_to_local_database(**warehouse_args)
+    mismatches = {}
+    for table, (source_table, id_column) in WAREHOUSE_SOURCES.items():
+        expected = source.run(f'SELECT count(*) FROM {source_table}')[0][0]
+        loaded = target.run(f'SELECT count(DISTINCT "{id_column}") FROM public."{table}"')[0][0]
+        if loaded != expected:
+            mismatches[table] = {'source': expected, 'warehouse': loaded}
+    source.close()
+    target.close()
+    if mismatches:
+        raise AssertionError(f'Warehouse does not match the source: {mismatches}')
+
+
+def split_s3_path(path):
+    bucket, _, key = path.removeprefix('s3://').partition('/')
+    return bucket, key
+
+
+def local_wrangler(s3):
+    # awswrangler talks to S3 through its own sessions, so its calls are
+    # redirected to the same in-memory buckets the boto3 stand-in uses
+    def to_csv(df, path, index=False, **kwargs):
+        buffer = StringIO()
+        df.to_csv(buffer, index=index)
+        s3.put_object(*split_s3_path(path), buffer.getvalue())
+
+    def to_parquet(df, path, index=False, compression='snappy', dtype=None, **kwargs):
+        s3.put_object(*split_s3_path(path), df.to_parquet(index=index, compression=compression))
+
+    def read_parquet(path, **kwargs):
+        bucket, key = split_s3_path(path)
+        return pd.read_parquet(BytesIO(s3.get_object(bucket, key)['Body'].read()))
+
+    return {'to_csv': to_csv, 'to_parquet': to_parquet, 'read_parquet': read_parquet}
+
+
+def count_rows(s3, bucket, keys):
+    rows = 0
+    for key in keys:
+        body = s3.body(bucket, key)
+        if key.endswith('.parquet'):
+            rows += pq.ParquetFile(BytesIO(body)).metadata.num_rows
+        elif key.endswith('.csv'):
+            rows += len(pd.read_csv(BytesIO(body)))
+    return rows
+
+
+def run_stage(name, s3, bucket, stage):
+    # Processed files are overwritten in place, so new files come from the write log
+    writes_before = len(s3.writes)
+    read_before, written_before = s3.bytes_read, s3.bytes_written
+
+    with PeakMemorySampler() as memory:
+        start = time.perf_counter()
+        stage()
+        wall = time.perf_counter() - start
+
+    new_keys = {key for written_bucket, key in s3.writes[writes_before:] if written_bucket == bucket}
+    rows = count_rows(s3, bucket, new_keys)
+    return {
+        'stage': name,
+        'wall_seconds': round(wall, 3),
+        'rows': rows,
+        'rows_per_second': round(rows / wall, 1) if wall > 0 else None,
+        'bytes_read': s3.bytes_read - read_before,
+        'bytes_written': s3.bytes_written - written_before,
+        'peak_rss_mb': round(memory.peak / 1024 ** 2, 1)
+    }
+
+
+def run_pipeline_tick(s3, lambdas):
+    results = []
+    lambdas.invocations.clear()
+    results.append(run_stage(
+        'ingest', s3, ingestion.INGEST_BUCKET, lambda: ingestion.lambda_handler({}, {})
+    ))
+
+    process_events = [payload for name, payload in lambdas.invocations if name == 'process_lambda']
+    lambdas.invocations.clear()
+    if process_events:
+        results.append(run_stage(
+            'process', s3, 'nc-crigglestone-processed-bucket',
+            lambda: process.lambda_handler(process_events[0], {})
+        ))
+
+    warehouse_events = [payload for name, payload in lambdas.invocations if name == 'warehousing_lambda']
+    if warehouse_events:
+        # The warehouse stage writes nothing to the processed bucket, so its rows are the files
+        # it loads, counted before it deletes the deltas among them
+        loaded = count_rows(s3, 'nc-crigglestone-processed-bucket', warehouse_events[0]['Records'])
+        result = run_stage(
+            'warehouse', s3, 'nc-crigglestone-lambda-bucket',
+            lambda: warehouse.lambda_handler(warehouse_events[0], {})
+        )
+        result['rows'] = loaded
+        result['rows_per_second'] = round(result['rows'] / result['wall_seconds'], 1) if result['wall_seconds'] else None
+        results.append(result)
+    return results
+
+
+def benchmark(args):
+    source_args = dict(
+        host=args.host, port=args.port, database=args.database, user=args.user, password=args.password
+    )
+    warehouse_args = dict(source_args, database=args.warehouse_database)
+
+    if not args.skip_generate:
+        conn = generator.connect_to_local_database(**source_args)
+        generator.create_source_database(conn, args.scale, args.seed)
+        conn.close()
+
+    s3 = LocalS3()
+    lambdas = FakeLambda()
+    wrangler = local_wrangler(s3)
+
+    def fake_boto3_client(service_name, *args, **kwargs):
+        return lambdas if service_name == 'lambda' else s3
+
+    ingestion.clear_caches()
+    warehouse.clear_caches()
+    ingestion.INGEST_CONCURRENCY = args.concurrency
+    ingestion.INGEST_FORMAT = args.ingest_format
+    ingestion.STREAM_EXTRACT = args.stream
+    ingestion.INGEST_MANIFEST = process.INGEST_MANIFEST = args.manifest
+    warehouse.COPY_LOAD = args.copy_load
+    if args.telemetry:
+        telemetry.TELEMETRY = 'local'
+        telemetry.drain()
+
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(boto3, 'client', fake_boto3_client))
+        for name, function in wrangler.items():
+            stack.enter_context(patch.object(ingestion.wr.s3, name, function))
+        stack.enter_context(patch.object(
+            ingestion, 'connect_to_original_database',
+            lambda: generator.connect_to_local_database(**source_args)
+        ))
+        stack.enter_context(patch.object(ingestion, 'datetime', TickClock))
+        stack.enter_context(patch.object(
+            warehouse, 'connect_to_warehouse',
+            lambda: generator.connect_to_local_database(**warehouse_args)
+        ))
+
+        results = []
+        spans = []
+        for tick in range(args.ticks):
+            if tick > 0:
+                conn = generator.connect_to_local_database(**source_args)
+                generator.apply_updates(conn, args.update_rate, args.insert_rate, seed=args.seed + tick)
+                conn.close()
+            TickClock.offset = timedelta(minutes=tick)
+            for result in run_pipeline_tick(s3, lambdas):
+                result['tick'] = tick
+                results.append(result)
+            for record in telemetry.drain():
+                record.pop('_aws')
+                spans.append({'tick': tick, **record})
+        check_warehouse(source_args, warehouse_args)
+
+    ingestion.clear_caches()
+    warehouse.clear_caches()
+    return results, spans
+
+
+def print_report(results):
+    columns = ['tick', 'stage', 'wall_seconds', 'rows', 'rows_per_second', 'bytes_read', 'bytes_written', 'peak_rss_mb']
+    print(pd.DataFrame(results)[columns].to_string(index=False))
+
+
+def print_span_report(spans):
+    # Spans of the same operation are summed, e.g. every builder of a tick
+    totals = pd.DataFrame(spans).groupby(['tick', 'Stage', 'Operation'], sort=False).agg(
+        spans=('duration_ms', 'size'),
+        **{metric: (metric, 'sum') for metric in ('duration_ms', 'rows', 'bytes', 'retries', 'skipped') if any(metric in span for span in spans)}
+    )
+    print()
+    print(totals.reset_index().to_string(index=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run ingest -> process -> warehouse against local stand-ins')
+    generator.parse_connection_args(parser)
+    parser.add_argument('--warehouse-database', default=os.environ.get('BENCH_WAREHOUSE_DATABASE', 'warehouse'))
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ticks', type=int, default=2, help='scheduler runs, updates are applied between them')
+    parser.add_argument('--update-rate', type=float, default=0.01)
+    parser.add_argument('--insert-rate', type=float, default=0.01)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--ingest-format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--stream', action='store_true', help='use the streaming cursor extraction')
+    parser.add_argument('--manifest', action='store_true', help='discover ingest files through the manifests')
+    parser.add_argument('--copy-load', action='store_true', help='load the warehouse with COPY instead of to_sql')
+    parser.add_argument('--skip-generate', action='store_true', help='reuse the existing source tables')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--telemetry', help='collect the lambdas\' telemetry spans and write them as JSON lines to this file')
+    args = parser.parse_args()
+
+    results, spans = benchmark(args)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.telemetry:
+        print_span_report(spans)
+        with open(args.telemetry, 'w') as output:
+            output.writelines(json.dumps(span) + '\n' for span in spans)
@@ -0,0 +1,111 @@
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+from pathlib import Path
+import sys
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import ingestion_lambda as ingestion
+import process_lambda as process
+import generate_source_data as generator
+from pipeline_benchmark import LocalS3
+
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+
+def load_ingest_bucket(scale, seed):
+    # One CSV per table laid out like the ingest bucket, with the columns ingestion extracts
+    counts = generator.scaled_counts(scale)
+    rng = np.random.default_rng(seed)
+    end = datetime.now()
+    start = end - timedelta(days=365)
+
+    tables = generator.make_reference_tables(rng, counts, start, end)
+    first_ids = {'purchase_order': 1, 'sales_order': 1, 'transaction': 1, 'payment': 1}
+    tables.update(generator.make_order_tables(
+        rng, counts, counts['purchase_order'], counts['sales_order'], first_ids, start, end
+    ))
+
+    s3 = LocalS3()
+    for table, columns in ingestion.TABLE_LIST.items():
+        body = tables[table][columns].to_csv(index=False)
+        s3.put_object(ingestion.INGEST_BUCKET, f'{table}/{end:%Y-%m-%d %H:%M}.csv', body)
+    return s3
+
+
+def build_outputs(s3):
+    builds = list(process.BUILDER_INPUTS)
+    loader = process.TableLoader(s3, [table for name in builds for table in process.BUILDER_INPUTS[name]])
+    sources = {table: loader.get(table) for table in process.STARTING_TABLES}
+
+    # The loader hands out its tables again for the builders
+    loader = process.TableLoader(s3, [table for name in builds for table in process.BUILDER_INPUTS[name]])
+    outputs = {name: builder(s3, loader) for name, builder in process.DIMENSION_BUILDERS.items()}
+    outputs['dim_date'] = process.make_dim_dates(
+        loader.get('payment'), loader.get('purchase_order'), loader.get('sales_order')
+    )
+    for name, spec in process.FACT_SPECS.items():
+        outputs[name] = process.make_fact(name, loader.get(spec['source']))
+    return sources, outputs
+
+
+def megabytes(data):
+    return data.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def compare(scale, seed):
+    s3 = load_ingest_bucket(scale, seed)
+
+    with patch.object(process, 'SOURCE_SCHEMAS', {}):
+        inferred_sources, inferred_outputs = build_outputs(s3)
+    declared_sources, declared_outputs = build_outputs(s3)
+    declared_outputs = {
+        name: process.apply_schema(data, process.OUTPUT_SCHEMAS[name]) for name, data in declared_outputs.items()
+    }
+
+    results = []
+    for kind, inferred, declared in (
+        ('source', inferred_sources, declared_sources),
+        ('output', inferred_outputs, declared_outputs)
+    ):
+        for table in inferred:
+            before, after = megabytes(inferred[table]), megabytes(declared[table])
+            results.append({
+                'kind': kind,
+                'table': table,
+                'rows': len(declared[table]),
+                'inferred_mb': round(before, 3),
+                'declared_mb': round(after, 3),
+                'saved_percent': round(100 * (1 - after / before), 1) if before else None
+            })
+    return results
+
+
+def print_report(results):
+    report = pd.DataFrame(results)
+    print(report.to_string(index=False))
+    totals = report.groupby('kind')[['inferred_mb', 'declared_mb']].sum()
+    totals['saved_percent'] = (100 * (1 - totals['declared_mb'] / totals['inferred_mb'])).round(1)
+    print()
+    print(totals.round(3).to_string())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare in-memory size of inferred and declared dtypes')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = compare(args.scale, args.seed)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
@@ -1,10 +1,17 @@
 import awswrangler as wr
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
 import logging
+import multipart
+import os
+import pandas as pd
 import pg8000
+import telemetry
+import threading
+import time
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -118,15 +125,121 @@ TABLE_LIST = {
     ]
 }
 
+# Athena/Glue types of every column in TABLE_LIST, written into Parquet ingest files
+COLUMN_TYPES = {
+    'address_id': 'bigint',
+    'address_line_1': 'string',
+    'address_line_2': 'string',
+    'district': 'string',
+    'city': 'string',
+    'postal_code': 'string',
+    'country': 'string',
+    'phone': 'string',
+    'counterparty_id': 'bigint',
+    'counterparty_legal_name': 'string',
+    'legal_address_id': 'bigint',
+    'currency_id': 'bigint',
+    'currency_code': 'string',
+    'department_id': 'bigint',
+    'department_name': 'string',
+    'location': 'string',
+    'design_id': 'bigint',
+    'design_name': 'string',
+    'file_location': 'string',
+    'file_name': 'string',
+    'payment_id': 'bigint',
+    'created_at': 'timestamp',
+    'last_updated': 'timestamp',
+    'transaction_id': 'bigint',
+    'payment_amount': 'double',
+    'payment_type_id': 'bigint',
+    'paid': 'boolean',
+    'payment_date': 'string',
+    'payment_type_name': 'string',
+    'purchase_order_id': 'bigint',
+    'staff_id': 'bigint',
+    'item_code': 'string',
+    'item_quantity': 'bigint',
+    'item_unit_price': 'double',
+    'agreed_delivery_date': 'string',
+    'agreed_payment_date': 'string',
+    'agreed_delivery_location_id': 'bigint',
+    'sales_order_id': 'bigint',
+    'units_sold': 'bigint',
+    'unit_price': 'double',
+    'first_name': 'string',
+    'last_name': 'string',
+    'email_address': 'string',
+    'transaction_type': 'string'
+}
+
 DATA_UPDATES = {table: "0000-00-00 00:00:00.0" for table in TABLE_LIST.keys()}
 
+# Number of tables extracted at once, each worker holding its own connection.
+# 1 keeps the original serial run over a single connection.
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', '1'))
+
+# Rows fetched per keyset page when pulling a table's changes
+EXTRACT_PAGE_SIZE = int(os.environ.get('EXTRACT_PAGE_SIZE', '50000'))
+
+# Streaming mode reads changes through a server-side cursor and uploads them
+# in parts, so memory holds one batch and one part instead of the whole delta
+STREAM_EXTRACT = os.environ.get('STREAM_EXTRACT', 'false').lower() == 'true'
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '10000'))
+
+INGEST_BUCKET = 'nc-crigglestone-ingest-bucket'
+LAMBDA_BUCKET = 'nc-crigglestone-lambda-bucket'
+
+# One watermark object per table, committed as soon as that table is in S3
+CHECKPOINT_PREFIX = 'update_tracking/'
+
+# Each table keeps an append-only JSON lines manifest of the files written
+# to it, so the process lambda can find new files without listing the prefix
+INGEST_MANIFEST = os.environ.get('INGEST_MANIFEST', 'false').lower() == 'true'
+MANIFEST_PREFIX = 'manifests/'
+
+# 'csv' keeps the original plain CSV files, 'parquet' writes zstd-compressed
+# Parquet typed from COLUMN_TYPES. The process lambda reads both.
+INGEST_FORMAT = os.environ.get('INGEST_FORMAT', 'csv')
+
+# 'poll' compares last_updated against update_tracking.json, 'cdc' reads row
+# changes from a wal2json logical replication slot, the slot being the checkpoint
+INGEST_MODE = os.environ.get('INGEST_MODE', 'poll')
+CDC_SLOT_NAME = os.environ.get('CDC_SLOT_NAME', 'crigglestone_ingest')
+CDC_BATCH_CHANGES = int(os.environ.get('CDC_BATCH_CHANGES', '10000'))
+
+# Secrets, clients and connections live at module level so warm invocations
+# of the same Lambda container reuse them instead of setting them up again
+SECRET_TTL = int(os.environ.get('SECRET_TTL', '900'))
+CONNECTION_TTL = int(os.environ.get('CONNECTION_TTL', '900'))
+
+_secret_cache = {}
+_client_cache = {}
+_idle_connections = []
+_cache_lock = threading.Lock()
+
+def clear_caches():
+    with _cache_lock:
+        _secret_cache.clear()
+        _client_cache.clear()
+        while _idle_connections:
+            close_quietly(_idle_connections.pop()[0])
+
+def get_client(service_name, **kwargs):
+    key = (service_name, tuple(sorted(kwargs.items())))
+    with _cache_lock:
+        if key not in _client_cache:
+            _client_cache[key] = boto3.client(service_name=service_name, **kwargs)
+        return _client_cache[key]
+
 def get_secret() -> dict:
+    cached = _secret_cache.get('crigglestone')
+    if cached is not None and time.monotonic() < cached[1]:
+        return cached[0]
+
     secret_name = "Project"
     region_name = "eu-west-2"
-    client = boto3.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    client = get_client('secretsmanager', region_name=region_name)
     try:
         get_secret_value_response = client.get_secret_value(
             SecretId=secret_name
@@ -135,6 +248,7 @@ def get_secret() -> dict:
         raise e    
     secret = get_secret_value_response['SecretString']
     secret_dict = json.loads('{'+secret+'}')
+    _secret_cache['crigglestone'] = (secret_dict['crigglestone'], time.monotonic() + SECRET_TTL)
     return secret_dict['crigglestone']
 
 def connect_to_original_database():
@@ -154,25 +268,523 @@ def connect_to_original_database():
         logger.error(f'Database connection failed due to {e}')
         raise
 
-def check_original_update(table_name, connection):
-    logger.info('Getting latest update')
-    query = f'SELECT last_updated::text AS last_updated FROM {table_name} ORDER BY last_updated DESC LIMIT 1'
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+def is_connection_alive(connection):
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.info(f'Dropping stale database connection: {e}')
+        return False
+
+def get_connection():
+    # Reuse a connection left idle by an earlier warm invocation if it is
+    # young enough and still answers, otherwise open a new one
+    while True:
+        with _cache_lock:
+            if not _idle_connections:
+                break
+            connection, opened_at = _idle_connections.pop()
+        if time.monotonic() - opened_at < CONNECTION_TTL and is_connection_alive(connection):
+            return connection, opened_at
+        close_quietly(connection)
+
+    try:
+        connection = connect_to_original_database()
+    except Exception:
+        # The cached secret may have been rotated, fetch it again and retry once
+        _secret_cache.clear()
+        telemetry.add('retries')
+        connection = connect_to_original_database()
+    return connection, time.monotonic()
+
+def release_connection(connection, opened_at):
+    try:
+        connection.rollback()
+    except Exception:
+        close_quietly(connection)
+        return
+    with _cache_lock:
+        _idle_connections.append((connection, opened_at))
+
+def check_all_original_updates(connection, tables=None):
+    logger.info('Getting latest updates for all tables')
+    tables = tables or list(TABLE_LIST.keys())
+    query = ' UNION ALL '.join(
+        f"SELECT '{table}' AS table_name, max(last_updated)::text AS last_updated FROM {table}"
+        for table in tables
+    )
     df = wr.postgresql.read_sql_query(sql=query, con=connection)
-    logger.info(f'Table {table_name} last updated at {df['last_updated'].iloc[0]}')
-    return df['last_updated'].iloc[0] if not df.empty else "0000-00-00 00:00:00.0"
+    latest = {table: "0000-00-00 00:00:00.0" for table in tables}
+    for table, date in zip(df['table_name'], df['last_updated']):
+        if isinstance(date, str):
+            latest[table] = date
+    return latest
+
+def parse_watermark(watermark):
+    # update_tracking.json stores Postgres' text form, "0000-00-00 ..." means never ingested
+    if watermark is None or watermark.startswith('0000'):
+        return datetime.min
+    return datetime.fromisoformat(watermark)
+
+def iter_original_update_pages(table_name, connection, cutoff, page_size=None, after=None):
+    # Pages are ordered on (last_updated, primary key) and compared as typed values,
+    # so an index on those columns serves both the filter and the sort.
+    # Yields each page with the keyset position to resume from after it.
+    page_size = page_size or EXTRACT_PAGE_SIZE
+    columns = TABLE_LIST[table_name]
+    primary_key = columns[0]
+    select_columns = columns if 'last_updated' in columns else columns + ['last_updated']
 
-def get_original_updates(table_name, connection, cutoff):
+    select = f"SELECT {', '.join(select_columns)} FROM {table_name}"
+    order = f"ORDER BY last_updated, {primary_key} LIMIT %s"
+    first_page_query = f"{select} WHERE last_updated > %s {order}"
+    next_page_query = f"{select} WHERE (last_updated, {primary_key}) > (%s, %s) {order}"
+
+    if after is None:
+        query, params = first_page_query, [parse_watermark(cutoff), page_size]
+    else:
+        query, params = next_page_query, [*after, page_size]
+
+    while True:
+        df = wr.postgresql.read_sql_query(sql=query, con=connection, params=params)
+        if df.empty:
+            return
+
+        last_row = df.iloc[-1]
+        after = (pd.Timestamp(last_row['last_updated']).to_pydatetime(), int(last_row[primary_key]))
+        yield df[columns], after
+
+        if len(df) < page_size:
+            return
+        query, params = next_page_query, [*after, page_size]
+
+def get_original_updates_since(table_name, connection, cutoff, page_size=None):
     logger.info('Getting updated data')
-    query = f"SELECT {', '.join(TABLE_LIST[table_name])} FROM {table_name} WHERE last_updated::text > '{cutoff}'"
-    df = wr.postgresql.read_sql_query(sql=query, con=connection)
-    logger.info('Data fetched')
-    return df
+    pages = [page for page, _ in iter_original_update_pages(table_name, connection, cutoff, page_size)]
+    logger.info(f'Data fetched in {len(pages)} pages')
+    if not pages:
+        return pd.DataFrame(columns=TABLE_LIST[table_name])
+    return pd.concat(pages, ignore_index=True)
+
+def iter_original_update_batches(table_name, connection, cutoff, batch_size=None):
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    columns = TABLE_LIST[table_name]
+    cursor_name = f'{table_name}_updates'
+    cursor = connection.cursor()
+
+    try:
+        # DECLARE runs inside the transaction pg8000 opens, the rows stay on the server until fetched
+        cursor.execute(
+            f"DECLARE {cursor_name} NO SCROLL CURSOR FOR "
+            f"SELECT {', '.join(columns)} FROM {table_name} "
+            f"WHERE last_updated > %s ORDER BY last_updated, {columns[0]}",
+            [parse_watermark(cutoff)]
+        )
+        while True:
+            cursor.execute(f"FETCH FORWARD {batch_size} FROM {cursor_name}")
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield pd.DataFrame(rows, columns=columns)
+    finally:
+        cursor.close()
+        connection.rollback()
+
+def stream_to_s3(client, table, batches, date):
+    logger.info('Streaming data into S3')
+    key = f"{table}/{date}.csv"
+    sink = multipart.MultipartSink(client, INGEST_BUCKET, key)
+    rows = 0
+
+    try:
+        for batch in batches:
+            sink.write(batch.to_csv(index=False, header=rows == 0).encode('utf-8'))
+            rows += len(batch)
+
+        if rows == 0:
+            sink.write(pd.DataFrame(columns=TABLE_LIST[table]).to_csv(index=False).encode('utf-8'))
+        sink.close()
+    except Exception:
+        sink.abort()
+        raise
+
+    logger.info(f'Table {table} streamed into S3 ({rows} rows, {max(len(sink.parts), 1)} parts)')
+    return key, rows
+
+def get_table_types(table):
+    return {column: COLUMN_TYPES[column] for column in TABLE_LIST[table]}
 
 def put_in_s3(table, data, date):
     logger.info('Putting data into S3')
-    path = f"s3://nc-crigglestone-ingest-bucket/{table}/{date}.csv"
-    wr.s3.to_csv(df=data, path=path, index=False)
+    with telemetry.span('ingest', 's3_put', table) as span:
+        span.add('rows', len(data))
+        if INGEST_FORMAT == 'parquet':
+            key = f"{table}/{date}.parquet"
+            path = f"s3://{INGEST_BUCKET}/{key}"
+            wr.s3.to_parquet(
+                df=data,
+                path=path,
+                index=False,
+                compression='zstd',
+                dtype=get_table_types(table)
+            )
+        else:
+            key = f"{table}/{date}.csv"
+            path = f"s3://{INGEST_BUCKET}/{key}"
+            wr.s3.to_csv(df=data, path=path, index=False)
+        # awswrangler does not say how much it wrote, so the size is looked up,
+        # only when there is a span to report it in
+        if telemetry.enabled():
+            span.add('bytes', get_client('s3').head_object(Bucket=INGEST_BUCKET, Key=key)['ContentLength'])
     logger.info(f'Table {table} updated into S3')
+    return key
+
+def get_manifest(client, table):
+    try:
+        response = client.get_object(
+            Bucket=INGEST_BUCKET,
+            Key=f'{MANIFEST_PREFIX}{table}.jsonl'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None, None
+        raise
+    lines = response['Body'].read().decode('utf-8').splitlines()
+    return [json.loads(line) for line in lines if line], response['ETag']
+
+def seed_manifest(client, table):
+    # Files written before the manifest existed are listed once, in key
+    # order and without row stats, so the manifest still covers every file
+    entries = []
+    token = {}
+    while True:
+        response = client.list_objects_v2(Bucket=INGEST_BUCKET, Prefix=f'{table}/', **token)
+        for file in response.get('Contents', []):
+            entries.append({
+                'seq': len(entries) + 1,
+                'key': file['Key'],
+                'rows': None,
+                'bytes': file['Size'],
+                'min_last_updated': None,
+                'max_last_updated': None,
+                'checksum': file.get('ETag', '').strip('"') or None
+            })
+        if not response.get('IsTruncated'):
+            return entries
+        token = {'ContinuationToken': response['NextContinuationToken']}
+
+def append_manifest_entry(client, table, entry):
+    # Read, append and write back conditionally, rereading if another run
+    # appended in between so no entry is lost
+    while True:
+        entries, etag = get_manifest(client, table)
+        if entries is None:
+            entries = [seeded for seeded in seed_manifest(client, table) if seeded['key'] != entry['key']]
+        entry = dict(entry, seq=len(entries) + 1)
+        body = ''.join(json.dumps(line) + '\n' for line in entries + [entry])
+        if conditional_put(client, INGEST_BUCKET, f'{MANIFEST_PREFIX}{table}.jsonl', body, etag) is not None:
+            return entry
+        logger.info(f'Manifest for {table} changed underneath, retrying')
+        telemetry.add('retries')
+
+def last_updated_range(data, cutoff, date):
+    # Tables without a last_updated column fall back to the extracted window
+    if data is not None and 'last_updated' in data.columns and not data.empty:
+        return str(data['last_updated'].min()), str(data['last_updated'].max())
+    return cutoff, date
+
+def record_ingest_file(client, table, key, rows, updated_range):
+    head = client.head_object(Bucket=INGEST_BUCKET, Key=key)
+    entry = append_manifest_entry(client, table, {
+        'key': key,
+        'rows': rows,
+        'bytes': head['ContentLength'],
+        'min_last_updated': updated_range[0],
+        'max_last_updated': updated_range[1],
+        'checksum': head['ETag'].strip('"')
+    })
+    logger.info(f'Recorded {key} as manifest entry {entry["seq"]}')
+    return entry
+
+def get_table_checkpoint(client, table):
+    try:
+        response = client.get_object(
+            Bucket=LAMBDA_BUCKET,
+            Key=f'{CHECKPOINT_PREFIX}{table}.json'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None, None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+def get_table_checkpoints(client):
+    # Returns {table: (checkpoint, etag)}, etag being None until the table's
+    # first checkpoint, whose watermark then comes from update_tracking.json
+    with ThreadPoolExecutor(max_workers=len(TABLE_LIST)) as executor:
+        checkpoints = dict(zip(
+            TABLE_LIST.keys(),
+            executor.map(lambda table: get_table_checkpoint(client, table), TABLE_LIST.keys())
+        ))
+
+    if any(etag is None for _, etag in checkpoints.values()):
+        legacy = get_updates_table(client)
+        for table, (checkpoint, etag) in checkpoints.items():
+            if etag is None:
+                date = legacy.get(table, DATA_UPDATES[table])
+                checkpoints[table] = ({'last_updated': date, 'pending': False}, None)
+    return checkpoints
+
+def conditional_put(client, bucket, key, body, etag):
+    # Only succeeds if nobody wrote the object since it was read
+    condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+    try:
+        response = client.put_object(Bucket=bucket, Key=key, Body=body, **condition)
+        return response['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412'):
+            return None
+        raise
+
+def put_table_checkpoint(client, table, checkpoint, etag):
+    return conditional_put(
+        client, LAMBDA_BUCKET, f'{CHECKPOINT_PREFIX}{table}.json', json.dumps(checkpoint), etag
+    )
+
+def commit_table_checkpoint(client, table, date, etag):
+    # pending marks files the process lambda has not been told about yet, so a
+    # retry after a crash still passes them on. When an overlapping run got
+    # there first, the newer of the two watermarks is kept and None returned,
+    # as the checkpoint is that run's to report.
+    while True:
+        new_etag = put_table_checkpoint(client, table, {'last_updated': date, 'pending': True}, etag)
+        if new_etag is not None:
+            logger.info(f'Checkpoint for {table} committed at {date}')
+            return new_etag
+
+        telemetry.add('retries')
+        current, etag = get_table_checkpoint(client, table)
+        if current is not None and parse_watermark(current['last_updated']) >= parse_watermark(date):
+            logger.info(f"Checkpoint for {table} already at {current['last_updated']} from another run")
+            return None
+
+def mark_checkpoints_processed(client, reported):
+    # Only clears the checkpoints this run reported, as it left them. A flag an
+    # overlapping run set since then fails the ETag check and stays for that run.
+    for table, (checkpoint, etag) in reported.items():
+        if etag is None or not checkpoint.get('pending'):
+            continue
+        if put_table_checkpoint(client, table, dict(checkpoint, pending=False), etag) is None:
+            # Another run moved it on and will pass it to the process lambda itself
+            logger.info(f'Checkpoint for {table} changed while marking it processed')
+
+def ingest_table(table, connection, cutoff, current_time, date=None):
+    logger.info(f'Starting table {table}')
+    if date is None:
+        date = check_all_original_updates(connection, [table])[table]
+
+    if parse_watermark(date) > parse_watermark(cutoff):
+        with telemetry.span('ingest', 'extract', table) as span:
+            data = None
+            if STREAM_EXTRACT:
+                batches = iter_original_update_batches(table, connection, cutoff)
+                key, rows = stream_to_s3(get_client('s3'), table, batches, current_time)
+            else:
+                data = get_original_updates_since(table, connection, cutoff)
+                key, rows = put_in_s3(table, data, current_time), len(data)
+            span.add('rows', rows)
+            if INGEST_MANIFEST:
+                record_ingest_file(get_client('s3'), table, key, rows, last_updated_range(data, cutoff, date))
+        return date
+
+    logger.info(f"Table {table} does not have updates")
+    return None
+
+def ingest_tables_serially(last_updated, current_time, latest=None, connection=None, commit=None):
+    # latest maps each table to ingest onto its probed date, or None to probe it here
+    latest = latest if latest is not None else dict.fromkeys(TABLE_LIST.keys())
+    pooled = None
+    if connection is None:
+        pooled = get_connection()
+        connection = pooled[0]
+    new_dates = {}
+
+    try:
+        for table, latest_date in latest.items():
+            date = ingest_table(table, connection, last_updated[table], current_time, latest_date)
+            if date is not None:
+                new_dates[table] = date
+                if commit is not None:
+                    commit(table, date)
+    finally:
+        if pooled is not None:
+            release_connection(*pooled)
+    return new_dates
+
+def ingest_tables_concurrently(last_updated, current_time, latest=None, max_workers=None, commit=None):
+    latest = latest if latest is not None else dict.fromkeys(TABLE_LIST.keys())
+    max_workers = max_workers or INGEST_CONCURRENCY
+    logger.info(f'Ingesting tables with {max_workers} workers')
+
+    # pg8000 connections are not thread safe, so every worker holds its own
+    worker_state = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def worker(table):
+        if not hasattr(worker_state, 'connection'):
+            worker_state.connection = get_connection()
+            with connections_lock:
+                connections.append(worker_state.connection)
+        connection = worker_state.connection[0]
+        date = ingest_table(table, connection, last_updated[table], current_time, latest[table])
+        if date is not None and commit is not None:
+            commit(table, date)
+        return table, date
+
+    new_dates = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for table, date in executor.map(worker, latest.keys()):
+                if date is not None:
+                    new_dates[table] = date
+    finally:
+        for connection, opened_at in connections:
+            release_connection(connection, opened_at)
+    return new_dates
+
+def ensure_replication_slot(connection, slot_name=None):
+    slot_name = slot_name or CDC_SLOT_NAME
+    cursor = connection.cursor()
+    cursor.execute('SELECT slot_name FROM pg_replication_slots WHERE slot_name = %s', [slot_name])
+    if not cursor.fetchall():
+        logger.info(f'Creating replication slot {slot_name}')
+        cursor.execute("SELECT pg_create_logical_replication_slot(%s, 'wal2json')", [slot_name])
+    cursor.close()
+    connection.commit()
+
+def peek_replicated_changes(connection, slot_name=None, max_changes=None):
+    # Peeking leaves the slot where it is, it only moves once the batch is in S3
+    slot_name = slot_name or CDC_SLOT_NAME
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT lsn::text, data FROM pg_logical_slot_peek_changes(%s, NULL, %s, "
+        "'format-version', '2', 'include-transaction', 'true', 'add-tables', %s)",
+        [
+            slot_name,
+            max_changes or CDC_BATCH_CHANGES,
+            ','.join(f'public.{table}' for table in TABLE_LIST.keys())
+        ]
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    return [(lsn, json.loads(data)) for lsn, data in rows]
+
+def changes_to_frames(changes):
+    # Returns the inserted/updated rows per table and the last commit LSN.
+    # Deletes are skipped, the transform keeps the last version of each row anyway.
+    rows = {}
+    commit_lsn = None
+    for lsn, change in changes:
+        action = change['action']
+        if action == 'C':
+            commit_lsn = lsn
+        elif action in ('I', 'U') and change['table'] in TABLE_LIST:
+            values = {column['name']: column['value'] for column in change['columns']}
+            rows.setdefault(change['table'], []).append(values)
+        elif action == 'D':
+            logger.info(f"Skipping delete on {change['table']}")
+
+    frames = {
+        table: pd.DataFrame(table_rows).reindex(columns=TABLE_LIST[table])
+        for table, table_rows in rows.items()
+    }
+    return frames, commit_lsn
+
+def advance_replication_slot(connection, lsn, slot_name=None):
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_replication_slot_advance(%s, %s::pg_lsn)', [slot_name or CDC_SLOT_NAME, lsn])
+    cursor.close()
+    connection.commit()
+
+def ingest_replicated_changes(current_time, connection=None, slot_name=None, max_changes=None):
+    pooled = None
+    if connection is None:
+        pooled = get_connection()
+        connection = pooled[0]
+    updated = []
+
+    try:
+        ensure_replication_slot(connection, slot_name)
+        batch = 0
+        while True:
+            changes = peek_replicated_changes(connection, slot_name, max_changes)
+            frames, commit_lsn = changes_to_frames(changes)
+            if commit_lsn is None:
+                break
+
+            for table, data in frames.items():
+                with telemetry.span('ingest', 'extract', table) as span:
+                    span.add('rows', len(data))
+                    key = put_in_s3(table, data, f'{current_time}-{batch:04d}')
+                if INGEST_MANIFEST:
+                    updated_range = last_updated_range(data, None, None)
+                    record_ingest_file(get_client('s3'), table, key, len(data), updated_range)
+                if table not in updated:
+                    updated.append(table)
+
+            advance_replication_slot(connection, commit_lsn, slot_name)
+            logger.info(f'Replication slot advanced to {commit_lsn}')
+            batch += 1
+    finally:
+        if pooled is not None:
+            release_connection(*pooled)
+    return updated
+
+def ingest_polled_updates(s3_client, current_time):
+    # A retry after a timeout only extracts the tables whose checkpoint was not
+    # committed, and passes on the ones it committed but never reported
+    checkpoints = get_table_checkpoints(s3_client)
+    last_updated = {table: checkpoint['last_updated'] for table, (checkpoint, _) in checkpoints.items()}
+    pending = [table for table, (checkpoint, _) in checkpoints.items() if checkpoint.get('pending')]
+    reported = {table: checkpoints[table] for table in pending}
+
+    def commit(table, date):
+        etag = commit_table_checkpoint(s3_client, table, date, checkpoints[table][1])
+        reported[table] = ({'last_updated': date, 'pending': True}, etag)
+
+    connection, opened_at = get_connection()
+    try:
+        latest = check_all_original_updates(connection)
+        changed = {
+            table: date for table, date in latest.items()
+            if parse_watermark(date) > parse_watermark(last_updated[table])
+        }
+        for table in latest.keys():
+            if table not in changed:
+                logger.info(f"Table {table} does not have updates")
+
+        concurrent = INGEST_CONCURRENCY > 1 and len(changed) > 1
+        if not concurrent:
+            new_dates = ingest_tables_serially(last_updated, current_time, changed, connection, commit)
+    finally:
+        # Released before a concurrent run so one of its workers can pick it up
+        release_connection(connection, opened_at)
+
+    if concurrent:
+        new_dates = ingest_tables_concurrently(last_updated, current_time, changed, commit=commit)
+
+    # {table: (checkpoint, etag)} of every table to report, in the order reported
+    return {table: reported[table] for table in pending + [table for table in new_dates if table not in pending]}
 
 def get_updates_table(client):
     lambda_bucket = 'nc-crigglestone-lambda-bucket'
@@ -203,44 +815,31 @@ def get_updates_table(client):
 def lambda_handler(event, context):
     logger.info("Lambda ingestion job started")
 
-    connection = connect_to_original_database()
-    s3_client = boto3.client('s3')
+    with telemetry.span('ingest', 'invocation') as span:
+        s3_client = get_client('s3')
 
-    last_updated = get_updates_table(s3_client)
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M")
-    logger.info(f"Creating files at time {current_time}")
-    updated_list = []
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M")
+        logger.info(f"Creating files at time {current_time}")
 
-    for table in TABLE_LIST.keys():
-        logger.info(f'Starting table {table}')
-        date = check_original_update(table, connection)
-
-        if date > last_updated[table]:
-
-            data = get_original_updates(table, connection, last_updated[table])
-            put_in_s3(table, data, current_time)
-            last_updated[table] = date
-            updated_list.append(table)
+        if INGEST_MODE == 'cdc':
+            updated_list = ingest_replicated_changes(current_time)
         else:
-            logger.info(f"Table {table} does not have updates")
-    
-    logger.info('Updating records')
-    s3_client.put_object(
-        Bucket='nc-crigglestone-lambda-bucket',
-        Key='update_tracking.json',
-        Body=json.dumps(last_updated)
-    )
+            reported = ingest_polled_updates(s3_client, current_time)
+            updated_list = list(reported)
+        span.add('files', len(updated_list))
 
-    if len(updated_list) > 0:
-        logger.info('Calling process_lambda')
+        if len(updated_list) > 0:
+            logger.info('Calling process_lambda')
 
-        lambda_client = boto3.client('lambda')
-        lambda_client.invoke(
-            FunctionName='process_lambda',
-            InvocationType='Event',
-            Payload=json.dumps({'updates': updated_list})
-        )
-    else:
-        logger.info('No updates, ending here')
+            lambda_client = get_client('lambda')
+            lambda_client.invoke(
+                FunctionName='process_lambda',
+                InvocationType='Event',
+                Payload=json.dumps({'updates': updated_list})
+            )
+            if INGEST_MODE != 'cdc':
+                mark_checkpoints_processed(s3_client, reported)
+        else:
+            logger.info('No updates, ending here')
 
     logger.info('Lambda ingestion completed')
\ No newline at end of file
@@ -0,0 +1,81 @@
+from io import BytesIO
+import telemetry
+
+
+# Shared by the ingest and process lambdas, packaged next to each handler
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024  # S3 parts other than the last must be at least 5 MiB
+
+
+class MultipartSink:
+    """Write-only file that uploads each full part to S3 as it goes.
+
+    Anything that fits in one part is sent with a single put instead, through
+    put when one is given, e.g. to skip an upload whose content is unchanged.
+    """
+    def __init__(self, client, bucket, key, put=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.put = put
+        self.chunk_size = MULTIPART_CHUNK_SIZE
+        self.buffer = BytesIO()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.position += len(data)
+        if self.buffer.tell() >= self.chunk_size:
+            self.upload_part()
+        return len(data)
+
+    def tell(self):
+        # Parquet records offsets from here, so it counts uploaded bytes too
+        return self.position
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )['UploadId']
+        telemetry.add('bytes', self.buffer.tell())
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=len(self.parts) + 1,
+            Body=self.buffer.getvalue()
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': len(self.parts) + 1})
+        self.buffer = BytesIO()
+
+    def close(self):
+        # False when put skipped the upload, True once the object is written
+        if self.closed:
+            return True
+        self.closed = True
+        if self.upload_id is None:
+            if self.put is not None:
+                return self.put(self.buffer.getvalue())
+            telemetry.add('bytes', self.buffer.tell())
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=self.buffer.getvalue())
+            return True
+        if self.buffer.tell() > 0:
+            self.upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+        return True
+
+    def abort(self):
+        self.closed = True
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
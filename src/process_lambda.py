@@ -1,9 +1,22 @@
 import boto3
 from botocore.exceptions import ClientError
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import logging
 from io import StringIO, BytesIO
+import hashlib
 import json
+import multipart
+import os
+import telemetry
+import threading
 
 
 logger = logging.getLogger()
@@ -24,46 +37,722 @@ STARTING_TABLES = [
     'transaction'
 ]
 
+PROCESSED_BUCKET = 'nc-crigglestone-processed-bucket'
+
+# Incremental mode keeps a deduplicated snapshot of every source table in the
+# processed bucket and only merges the ingest files written since the last run
+INCREMENTAL_TRANSFORM = os.environ.get('INCREMENTAL_TRANSFORM', 'false').lower() == 'true'
+SNAPSHOT_PREFIX = 'snapshots/'
+
+# Read each table's ingest manifest instead of listing its prefix. The
+# manifest is in write order, which is also the order duplicates resolve in.
+INGEST_MANIFEST = os.environ.get('INGEST_MANIFEST', 'false').lower() == 'true'
+MANIFEST_PREFIX = 'manifests/'
+
+# Declared in-memory types of every source table and output, so ids are not
+# float64 once a NaN appears and repeated strings are not Python objects.
+# Source types are applied as ingest files are read, output types before writing.
+STRING = 'string[pyarrow]'
+DECIMAL = pd.ArrowDtype(pa.decimal128(12, 2))
+TIME = pd.ArrowDtype(pa.time64('us'))
+TIMESTAMP = 'datetime64[ns]'
+
+SOURCE_SCHEMAS = {
+    'address': {
+        'address_id': 'int32',
+        'address_line_1': STRING,
+        'address_line_2': STRING,
+        'district': 'category',
+        'city': 'category',
+        'postal_code': STRING,
+        'country': 'category',
+        'phone': STRING
+    },
+    'counterparty': {
+        'counterparty_id': 'int32',
+        'counterparty_legal_name': STRING,
+        'legal_address_id': 'Int32'
+    },
+    'currency': {
+        'currency_id': 'int32',
+        'currency_code': 'category'
+    },
+    'department': {
+        'department_id': 'int32',
+        'department_name': 'category',
+        'location': 'category'
+    },
+    'design': {
+        'design_id': 'int32',
+        'design_name': 'category',
+        'file_location': 'category',
+        'file_name': STRING
+    },
+    'payment': {
+        'payment_id': 'int32',
+        'created_at': TIMESTAMP,
+        'last_updated': TIMESTAMP,
+        'transaction_id': 'Int32',
+        'counterparty_id': 'Int32',
+        'payment_amount': DECIMAL,
+        'currency_id': 'Int32',
+        'payment_type_id': 'Int32',
+        'paid': 'boolean',
+        'payment_date': STRING
+    },
+    'payment_type': {
+        'payment_type_id': 'int32',
+        'payment_type_name': 'category'
+    },
+    'purchase_order': {
+        'purchase_order_id': 'int32',
+        'created_at': TIMESTAMP,
+        'last_updated': TIMESTAMP,
+        'staff_id': 'Int32',
+        'counterparty_id': 'Int32',
+        'item_code': 'category',
+        'item_quantity': 'Int32',
+        'item_unit_price': DECIMAL,
+        'currency_id': 'Int32',
+        'agreed_delivery_date': STRING,
+        'agreed_payment_date': STRING,
+        'agreed_delivery_location_id': 'Int32'
+    },
+    'sales_order': {
+        'sales_order_id': 'int32',
+        'created_at': TIMESTAMP,
+        'last_updated': TIMESTAMP,
+        'design_id': 'Int32',
+        'staff_id': 'Int32',
+        'counterparty_id': 'Int32',
+        'units_sold': 'Int32',
+        'unit_price': DECIMAL,
+        'currency_id': 'Int32',
+        'agreed_delivery_date': STRING,
+        'agreed_payment_date': STRING,
+        'agreed_delivery_location_id': 'Int32'
+    },
+    'staff': {
+        'staff_id': 'int32',
+        'first_name': STRING,
+        'last_name': STRING,
+        'department_id': 'Int32',
+        'email_address': STRING
+    },
+    'transaction': {
+        'transaction_id': 'int32',
+        'transaction_type': 'category',
+        'sales_order_id': 'Int32',
+        'purchase_order_id': 'Int32'
+    }
+}
+
+# Categoricals become plain strings on the way out, for the warehouse tables
+FACT_KEYS = {
+    'created_date': 'Int32',
+    'created_time': TIME,
+    'last_updated_date': 'Int32',
+    'last_updated_time': TIME
+}
+OUTPUT_SCHEMAS = {
+    'dim_counterparty': {
+        'counterparty_id': 'int32',
+        'counterparty_legal_name': STRING,
+        'counterparty_legal_address_line_1': STRING,
+        'counterparty_legal_address_line_2': STRING,
+        'counterparty_legal_district': STRING,
+        'counterparty_legal_city': STRING,
+        'counterparty_legal_postal_code': STRING,
+        'counterparty_legal_country': STRING,
+        'counterparty_legal_phone_number': STRING
+    },
+    'dim_currency': {'currency_id': 'int32', 'currency_code': STRING},
+    'dim_design': {'design_id': 'int32', 'design_name': STRING, 'file_location': STRING, 'file_name': STRING},
+    'dim_location': {
+        'location_id': 'int32',
+        'address_line_1': STRING,
+        'address_line_2': STRING,
+        'district': STRING,
+        'city': STRING,
+        'postal_code': STRING,
+        'country': STRING,
+        'phone': STRING
+    },
+    'dim_payment_type': {'payment_type_id': 'int32', 'payment_type_name': STRING},
+    'dim_staff': {
+        'staff_id': 'int32',
+        'first_name': STRING,
+        'last_name': STRING,
+        'department_name': STRING,
+        'location': STRING,
+        'email_address': STRING
+    },
+    'dim_transaction': {
+        'transaction_id': 'int32',
+        'transaction_type': STRING,
+        'sales_order_id': 'Int32',
+        'purchase_order_id': 'Int32'
+    },
+    'dim_date': {
+        'date_id': 'int32',
+        'year': 'int16',
+        'month': 'int8',
+        'day': 'int8',
+        'day_of_week': 'int8',
+        'day_name': STRING,
+        'month_name': STRING,
+        'quarter': 'int8'
+    },
+    'fact_payment': {
+        'record_payment_id': 'int32',
+        'payment_id': 'int32',
+        **FACT_KEYS,
+        'transaction_id': 'Int32',
+        'counterparty_id': 'Int32',
+        'payment_amount': DECIMAL,
+        'currency_id': 'Int32',
+        'payment_type_id': 'Int32',
+        'paid': 'boolean',
+        'payment_date': 'Int32'
+    },
+    'fact_purchase_order': {
+        'purchase_record_id': 'int32',
+        'purchase_order_id': 'int32',
+        **FACT_KEYS,
+        'staff_id': 'Int32',
+        'counterparty_id': 'Int32',
+        'item_code': STRING,
+        'item_quantity': 'Int32',
+        'item_unit_price': DECIMAL,
+        'currency_id': 'Int32',
+        'agreed_delivery_date': 'Int32',
+        'agreed_payment_date': 'Int32',
+        'agreed_delivery_location_id': 'Int32'
+    },
+    'fact_sales_order': {
+        'sales_record_id': 'int32',
+        'sales_order_id': 'int32',
+        **FACT_KEYS,
+        'sales_staff_id': 'Int32',
+        'counterparty_id': 'Int32',
+        'units_sold': 'Int32',
+        'unit_price': DECIMAL,
+        'currency_id': 'Int32',
+        'design_id': 'Int32',
+        'agreed_payment_date': 'Int32',
+        'agreed_delivery_date': 'Int32',
+        'agreed_delivery_location_id': 'Int32'
+    }
+}
+
+# Ingest files downloaded and parsed at once
+INGEST_FETCH_WORKERS = int(os.environ.get('INGEST_FETCH_WORKERS', '8'))
+
+# Source tables read by each output table. An output is rebuilt when any of
+# them changed, and builders run BUILDER_WORKERS at a time.
+BUILDER_INPUTS = {
+    'dim_counterparty': ['counterparty', 'address'],
+    'dim_currency': ['currency'],
+    'dim_design': ['design'],
+    'dim_location': ['address'],
+    'dim_payment_type': ['payment_type'],
+    'dim_staff': ['staff', 'department'],
+    'dim_transaction': ['transaction'],
+    'dim_date': ['payment', 'purchase_order', 'sales_order'],
+    'fact_payment': ['payment'],
+    'fact_purchase_order': ['purchase_order'],
+    'fact_sales_order': ['sales_order']
+}
+BUILDER_WORKERS = int(os.environ.get('BUILDER_WORKERS', '4'))
+
+# Incremental facts give each (source id, last_updated) version a record id
+# that never changes, and write only new or changed rows under deltas/ for the
+# warehouse to upsert. The ids issued so far are kept under fact_state/. Each
+# run's delta gets its own timestamped key, which the warehouse deletes once
+# it is loaded, so a delta still waiting is sent again instead of overwritten.
+INCREMENTAL_FACTS = os.environ.get('INCREMENTAL_FACTS', 'false').lower() == 'true'
+FACT_STATE_PREFIX = 'fact_state/'
+DELTA_PREFIX = 'deltas/'
+
+# Parquet tuning for everything written to the processed bucket. With
+# PARTITIONED_FACTS full fact tables are split into Hive style year/month
+# partitions of their created date, and only partitions whose contents
+# changed are rewritten and passed on to the warehouse. Rows without a
+# created date go to a year=__null__/month=__null__ partition of their own.
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'zstd')
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '131072'))
+PARTITIONED_FACTS = os.environ.get('PARTITIONED_FACTS', 'false').lower() == 'true'
+PARTITION_COLUMN = 'created_date'
+NULL_PARTITION = '__null__'
+
+# Chunked mode streams fact sources through make_fact FACT_CHUNK_ROWS rows at
+# a time and writes each fact as a multipart upload, so peak memory follows
+# the chunk size instead of the table's history
+CHUNKED_FACTS = os.environ.get('CHUNKED_FACTS', 'false').lower() == 'true'
+FACT_CHUNK_ROWS = int(os.environ.get('FACT_CHUNK_ROWS', '50000'))
+
+# Fact sources keep every ingested version of a row, the rest are
+# deduplicated on their id
+FACT_SOURCES = ['payment', 'purchase_order', 'sales_order']
+
+# Engine the dimensions, dim_date and full facts are built with. 'arrow'
+# reads ingest files straight into Arrow tables and builds every output with
+# pyarrow's multithreaded CSV reader, compute and join kernels, then hands the
+# tables to put_in_processed without a round trip through pandas.
+TRANSFORM_BACKEND = os.environ.get('TRANSFORM_BACKEND', 'pandas')
+ARROW_TYPES = {
+    'int8': pa.int8(),
+    'int16': pa.int16(),
+    'int32': pa.int32(),
+    'Int32': pa.int32(),
+    'boolean': pa.bool_(),
+    'category': pa.string(),
+    STRING: pa.string(),
+    TIMESTAMP: pa.timestamp('ns')
+}
+
+
+def to_decimal(values, decimal_type):
+    # Rounded half to even to the declared scale instead of cut off, then cast
+    # safely, so a value too large for the precision fails rather than wraps
+    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        values = pc.cast(values, pa.float64())
+    if not pa.types.is_integer(values.type):
+        values = pc.round(values, ndigits=decimal_type.scale, round_mode='half_to_even')
+    return pc.cast(values, decimal_type)
+
+
+def apply_schema(data, schema):
+    converted = {}
+    for column, dtype in schema.items():
+        if column not in data.columns or data[column].dtype == dtype:
+            continue
+        if dtype == TIMESTAMP:
+            converted[column] = pd.to_datetime(data[column], format='ISO8601').astype(TIMESTAMP)
+        elif isinstance(dtype, pd.ArrowDtype) and pa.types.is_decimal(dtype.pyarrow_dtype):
+            decimals = to_decimal(pa.array(data[column], from_pandas=True), dtype.pyarrow_dtype)
+            converted[column] = pd.Series(pd.arrays.ArrowExtensionArray(decimals), index=data.index)
+        else:
+            converted[column] = data[column].astype(dtype)
+    return data.assign(**converted) if converted else data
+
+
+def arrow_schema(schema):
+    return {
+        column: dtype.pyarrow_dtype if isinstance(dtype, pd.ArrowDtype) else ARROW_TYPES[dtype]
+        for column, dtype in schema.items()
+    }
+
+
+def cast_table(table, types):
+    # The Arrow counterpart of apply_schema, for columns the table has
+    for column, arrow_type in types.items():
+        index = table.schema.get_field_index(column)
+        if index >= 0 and table.schema.field(index).type != arrow_type:
+            cast = to_decimal if pa.types.is_decimal(arrow_type) else pc.cast
+            table = table.set_column(index, column, cast(table[column], arrow_type))
+    return table
+
 
 def fetch_file_from_ingest(client, key):
+    table_name = key.split('/')[0]
+    with telemetry.span('process', 's3_get', table_name) as span:
+        data = client.get_object(
+            Bucket='nc-crigglestone-ingest-bucket',
+            Key=key
+        )
+        body = data['Body'].read()
+        span.add('bytes', len(body))
+        schema = SOURCE_SCHEMAS.get(table_name, {})
+        if key.endswith('.parquet'):
+            # Parquet ingest files carry their column types, nothing to decode or infer
+            frame = apply_schema(pd.read_parquet(BytesIO(body)), schema)
+        else:
+            # Strings go straight to their declared type, numbers and timestamps are cast after parsing
+            strings = {column: dtype for column, dtype in schema.items() if dtype in (STRING, 'category')}
+            frame = apply_schema(pd.read_csv(StringIO(body.decode('utf-8')), dtype=strings), schema)
+        span.add('rows', len(frame))
+    return frame
+
+
+def get_manifest_keys(client, table_name, after=None):
+    try:
+        data = client.get_object(
+            Bucket='nc-crigglestone-ingest-bucket',
+            Key=f'{MANIFEST_PREFIX}{table_name}.jsonl'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            logger.info(f'No manifest for {table_name}, listing its files')
+            return None
+        raise
+    lines = data['Body'].read().decode('utf-8').splitlines()
+    entries = sorted((json.loads(line) for line in lines if line), key=lambda entry: entry['seq'])
+    keys = [entry['key'] for entry in entries]
+    if after in keys:
+        return keys[keys.index(after) + 1:]
+    if after:
+        return [key for key in keys if key > after]
+    return keys
+
+
+def get_keys_for_table(client, table_name, after=None):
+    logger.info(f'Getting keys')
+    if INGEST_MANIFEST:
+        keys = get_manifest_keys(client, table_name, after)
+        if keys is not None:
+            return keys
+
+    keys = []
+    # Keys are timestamped, so listing after a key only returns newer files.
+    # S3 returns at most 1000 keys per call, the rest is paged with the marker.
+    while True:
+        marker = {'Marker': after} if after else {}
+        files = client.list_objects(
+            Bucket='nc-crigglestone-ingest-bucket',
+            Prefix=f'{table_name}/',
+            **marker
+        )
+        keys += [file['Key'] for file in files.get('Contents', [])]
+        if not files.get('IsTruncated'):
+            break
+        after = keys[-1]
+
+    if not keys:
+        logger.warning(f'Files for table {table_name} not found')
+    return keys
+
+
+def empty_source(table_name):
+    # A table with nothing ingested yet reads as no rows of its declared types
+    return pd.DataFrame({
+        column: pd.Series(dtype=dtype) for column, dtype in SOURCE_SCHEMAS.get(table_name, {}).items()
+    })
+
+
+def fetch_files_from_ingest(client, table_name, keys):
+    if not keys:
+        return empty_source(table_name)
+    # map keeps the key order, which drop_duplicates(keep='last') relies on
+    with ThreadPoolExecutor(max_workers=INGEST_FETCH_WORKERS) as executor:
+        frames = list(executor.map(lambda key: fetch_file_from_ingest(client, key), keys))
+    # Categoricals with different categories concatenate to plain strings
+    return apply_schema(pd.concat(frames, axis=0), SOURCE_SCHEMAS.get(table_name, {}))
+
+
+def iter_file_from_ingest(client, key, chunk_rows=None):
     data = client.get_object(
         Bucket='nc-crigglestone-ingest-bucket',
         Key=key
     )
-    csv_string = StringIO(data['Body'].read().decode('utf-8'))
-    return pd.read_csv(csv_string)
+    chunk_rows = chunk_rows or FACT_CHUNK_ROWS
+    schema = SOURCE_SCHEMAS.get(key.split('/')[0], {})
+    if key.endswith('.parquet'):
+        parquet = pq.ParquetFile(BytesIO(data['Body'].read()))
+        for batch in parquet.iter_batches(batch_size=chunk_rows):
+            yield apply_schema(batch.to_pandas(), schema)
+        return
+    # CSV is parsed straight off the response stream
+    strings = {column: dtype for column, dtype in schema.items() if dtype in (STRING, 'category')}
+    for chunk in pd.read_csv(data['Body'], dtype=strings, chunksize=chunk_rows):
+        yield apply_schema(chunk, schema)
+
+
+def iter_source_chunks(client, table_name, chunk_rows=None):
+    # Every ingested version in write order, like the full transform reads them
+    for key in get_keys_for_table(client, table_name):
+        yield from iter_file_from_ingest(client, key, chunk_rows)
+
+
+def get_snapshot(client, table_name):
+    try:
+        data = client.get_object(
+            Bucket=PROCESSED_BUCKET,
+            Key=f'{SNAPSHOT_PREFIX}{table_name}.parquet'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            logger.info(f'No snapshot for {table_name} yet')
+            return None, None
+        raise
+    table = pq.read_table(BytesIO(data['Body'].read()))
+    last_key = table.schema.metadata.get(b'last_key', b'').decode('utf-8')
+    return table.to_pandas(), last_key
+
+
+def put_snapshot(client, table_name, data, last_key):
+    # The last merged ingest key is stored in the file itself, so the data and
+    # the position it covers can never disagree
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'last_key': last_key.encode('utf-8')})
+    buffer = BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    client.put_object(
+        Bucket=PROCESSED_BUCKET,
+        Key=f'{SNAPSHOT_PREFIX}{table_name}.parquet',
+        Body=buffer.getvalue()
+    )
 
 
-def get_keys_for_table(client, table_name):
-    logger.info(f'Getting keys')
-    files = client.list_objects(
-        Bucket='nc-crigglestone-ingest-bucket',
-        Prefix=f'{table_name}/'
-    )
-    if 'Contents' not in files:
-        logger.warning(f'Files for table {table_name} not found')
-    return [file['Key'] for file in files['Contents']]
+def align_dtypes(data, like):
+    # CSV and Parquet ingest files can type the same column differently
+    for column, dtype in like.dtypes.items():
+        # Casting to the snapshot's categories would turn new values into NaN
+        if isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if column in data.columns and data[column].dtype != dtype:
+            try:
+                data[column] = data[column].astype(dtype)
+            except (TypeError, ValueError):
+                pass
+    return data
+
+
+def get_snapshot_from_ingest(client, table_name):
+    logger.info(f'Updating snapshot for {table_name}')
+    snapshot, last_key = get_snapshot(client, table_name)
+    keys = get_keys_for_table(client, table_name, last_key)
+    if not keys:
+        logger.info(f'Snapshot for {table_name} is up to date')
+        return empty_source(table_name) if snapshot is None else snapshot
+
+    new_data = fetch_files_from_ingest(client, table_name, keys)
+    if snapshot is not None:
+        new_data = pd.concat([snapshot, align_dtypes(new_data, snapshot)], axis=0)
+        new_data = apply_schema(new_data, SOURCE_SCHEMAS.get(table_name, {}))
+    # Fact sources keep every version like a full read does, so their
+    # snapshot only ever grows
+    if table_name not in FACT_SOURCES:
+        new_data.drop_duplicates(subset=[f'{table_name}_id'], keep='last', inplace=True)
+    new_data.reset_index(drop=True, inplace=True)
+
+    put_snapshot(client, table_name, new_data, keys[-1])
+    logger.info(f'Merged {len(keys)} new files into snapshot for {table_name}')
+    return new_data
 
 
 def get_from_ingest(client, table_name):
+    if INCREMENTAL_TRANSFORM:
+        return get_snapshot_from_ingest(client, table_name)
+
     logger.info(f'Getting data for {table_name} from ingest bucket')
     keys = get_keys_for_table(client, table_name)
+    return fetch_files_from_ingest(client, table_name, keys)
 
-    raw_data = fetch_file_from_ingest(client, keys.pop(0))
-    for key in keys:
-        new_data = fetch_file_from_ingest(client, key)
-        raw_data = pd.concat([raw_data, new_data], axis=0)
-    return raw_data
+
+def fetch_arrow_file_from_ingest(client, key):
+    table_name = key.split('/')[0]
+    with telemetry.span('process', 's3_get', table_name) as span:
+        data = client.get_object(
+            Bucket='nc-crigglestone-ingest-bucket',
+            Key=key
+        )
+        body = data['Body'].read()
+        span.add('bytes', len(body))
+        types = arrow_schema(SOURCE_SCHEMAS.get(table_name, {}))
+        if key.endswith('.parquet'):
+            table = cast_table(pq.read_table(BytesIO(body)), types)
+        else:
+            # Parsed straight into the declared types, empty strings are nulls like in
+            # pandas. Money is parsed as float like pandas does and rounded by cast_table.
+            parsed = {column: pa.float64() if pa.types.is_decimal(arrow_type) else arrow_type for column, arrow_type in types.items()}
+            options = pacsv.ConvertOptions(column_types=parsed, strings_can_be_null=True)
+            table = cast_table(pacsv.read_csv(BytesIO(body), convert_options=options), types)
+        span.add('rows', table.num_rows)
+    return table
+
+
+def get_arrow_from_ingest(client, table_name):
+    types = arrow_schema(SOURCE_SCHEMAS.get(table_name, {}))
+    if INCREMENTAL_TRANSFORM:
+        # Snapshots are merged in pandas, the builders still run on Arrow
+        snapshot = get_snapshot_from_ingest(client, table_name)
+        return cast_table(pa.Table.from_pandas(snapshot, preserve_index=False), types)
+
+    logger.info(f'Getting Arrow data for {table_name} from ingest bucket')
+    keys = get_keys_for_table(client, table_name)
+    if not keys:
+        return pa.table({column: pa.array([], type=arrow_type) for column, arrow_type in types.items()})
+    with ThreadPoolExecutor(max_workers=INGEST_FETCH_WORKERS) as executor:
+        tables = list(executor.map(lambda key: fetch_arrow_file_from_ingest(client, key), keys))
+    return cast_table(pa.concat_tables(tables, promote_options='permissive'), types)
+
+
+def drop_duplicates_arrow(table, key):
+    # Keeps the last row of each id in table order, like keep='last'
+    rows = pa.table({key: table[key], 'row': np.arange(table.num_rows)})
+    last = rows.group_by(key, use_threads=False).aggregate([('row', 'max')])['row_max']
+    return table.take(np.sort(last.to_numpy()))
+
+
+class TableLoader:
+    """Loads each source table once per invocation and frees it after its last planned use."""
+    def __init__(self, client, uses=None, backend=None):
+        self.client = client
+        self.backend = backend or TRANSFORM_BACKEND
+        self.uses = Counter(uses or [])
+        self.tables = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, table_name):
+        # Builders running at once wait for a table another one is fetching
+        with self.lock:
+            table_lock = self.locks.setdefault(table_name, threading.Lock())
+
+        with table_lock:
+            if table_name in self.tables:
+                data = self.tables[table_name]
+            elif self.backend == 'arrow':
+                data = get_arrow_from_ingest(self.client, table_name)
+                if table_name not in FACT_SOURCES:
+                    data = drop_duplicates_arrow(data, f'{table_name}_id')
+                self.tables[table_name] = data
+            else:
+                data = get_from_ingest(self.client, table_name)
+                if table_name not in FACT_SOURCES:
+                    data = data.drop_duplicates(subset=[f'{table_name}_id'], keep='last')
+                self.tables[table_name] = data
+
+            # Unplanned reads (a builder called on its own) are not kept
+            self.uses[table_name] -= 1
+            if self.uses[table_name] <= 0:
+                logger.info(f'Releasing {table_name}')
+                del self.tables[table_name]
+        return data
+
+
+def plan_builders(updates):
+    return [name for name, inputs in BUILDER_INPUTS.items() if any(table in updates for table in inputs)]
+
+
+def run_builder(name, task):
+    with telemetry.span('process', 'builder', name) as span:
+        keys = task()
+        span.add('files', len(keys))
+    return keys
+
+
+def run_builders(tasks, dependencies=None, max_workers=None):
+    # Starts each task once the tasks it depends on have finished. Tasks
+    # upload their own output and return the keys, listed here in task order.
+    dependencies = dependencies or {}
+    pending = dict(tasks)
+    running = {}
+    written = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or BUILDER_WORKERS) as executor:
+        while pending or running:
+            for name in list(pending):
+                if all(needed in written for needed in dependencies.get(name, []) if needed in tasks):
+                    running[executor.submit(run_builder, name, pending.pop(name))] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                written[name] = future.result()
+                logger.info(f'{name} finished')
+
+    return [key for name in tasks for key in written[name]]
+
+
+def to_parquet_bytes(data):
+    # Statistics let readers skip row groups, dictionaries shrink repeated values
+    buffer = BytesIO()
+    pq.write_table(
+        data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False),
+        buffer,
+        row_group_size=PARQUET_ROW_GROUP_SIZE,
+        compression=PARQUET_COMPRESSION,
+        use_dictionary=True,
+        write_statistics=True
+    )
+    return buffer.getvalue()
 
 
 def put_in_processed(client, table_name, data):
     logger.info(f'Putting table {table_name} into processed bucket')
-    parqueted = data.to_parquet(index=False)
+    key = f'{table_name.replace('_', '-')}.parquet'
+    if table_name.startswith(DELTA_PREFIX):
+        key = f'{table_name.replace('_', '-')}/{datetime.now(timezone.utc):%Y%m%dT%H%M%S%fZ}.parquet'
+    schema = OUTPUT_SCHEMAS.get(table_name.removeprefix(DELTA_PREFIX), {})
+
+    with telemetry.span('process', 's3_put', table_name.removeprefix(DELTA_PREFIX)) as span:
+        span.add('rows', len(data))
+        # Dimensions are written in id order, so a row ingested again without
+        # changes, which moves it to the end of its source, leaves the file as it was
+        if isinstance(data, pa.Table):
+            data = cast_table(data, arrow_schema(schema))
+            if table_name.startswith('dim_'):
+                data = data.sort_by(data.column_names[0])
+        else:
+            data = apply_schema(data, schema)
+            if table_name.startswith('dim_'):
+                data = data.sort_values(data.columns[0], kind='stable', ignore_index=True)
+        body = to_parquet_bytes(data)
+
+        # Every delta is new rows for the warehouse, even one equal to the last
+        if table_name.startswith(DELTA_PREFIX):
+            client.put_object(
+                Bucket='nc-crigglestone-processed-bucket',
+                Key=key,
+                Body=body
+            )
+            span.add('bytes', len(body))
+            return key
+        if not put_if_changed(client, key, body):
+            logger.info(f'{table_name} is unchanged, not uploading it')
+            return None
+    return key
+
+
+def get_content_hash(client, key):
+    try:
+        response = client.head_object(Bucket=PROCESSED_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return response.get('Metadata', {}).get('content-hash')
+
+
+def put_if_changed(client, key, body):
+    # The hash of each upload is kept in the object's metadata, so an output
+    # that serializes to the same bytes costs a HEAD request instead of an
+    # upload and a reload in the warehouse
+    content_hash = hashlib.sha256(body).hexdigest()
+    if get_content_hash(client, key) == content_hash:
+        telemetry.add('skipped')
+        return False
     client.put_object(
-        Bucket='nc-crigglestone-processed-bucket',
-        Key=f'{table_name.replace('_', '-')}.parquet',
-        Body=parqueted
+        Bucket=PROCESSED_BUCKET,
+        Key=key,
+        Body=body,
+        Metadata={'content-hash': content_hash}
     )
+    telemetry.add('bytes', len(body))
+    return True
+
+
+def put_partitioned_in_processed(client, table_name, data):
+    logger.info(f'Putting table {table_name} into processed bucket by month')
+    prefix = table_name.replace('_', '-')
+    data = apply_schema(data, OUTPUT_SCHEMAS.get(table_name, {}))
+    year = data[PARTITION_COLUMN] // 10000
+    month = data[PARTITION_COLUMN] // 100 % 100
+
+    written = []
+    with telemetry.span('process', 's3_put', table_name) as span:
+        span.add('rows', len(data))
+        for (partition_year, partition_month), partition in data.groupby([year, month], sort=True, dropna=False):
+            if pd.isna(partition_year):
+                key = f'{prefix}/year={NULL_PARTITION}/month={NULL_PARTITION}/part-0.parquet'
+            else:
+                key = f'{prefix}/year={partition_year}/month={partition_month:02d}/part-0.parquet'
+            if put_if_changed(client, key, to_parquet_bytes(partition)):
+                written.append(key)
+
+    logger.info(f'Rewrote {len(written)} partitions of {table_name}')
+    return written
 
 
 def get_parquet(client, table_name):
@@ -88,13 +777,12 @@ def get_parquet(client, table_name):
             raise
 
 
-def make_dim_location(client):
+def make_dim_location(client, loader=None):
     logger.info('Creating dim_location')
+    loader = loader or TableLoader(client)
 
-    address = get_from_ingest(client, 'address')
-    address.drop_duplicates(subset=['address_id'], keep='last', inplace=True)
-
-    address.rename(columns={'address_id': 'location_id'}, inplace=True)
+    address = loader.get('address')
+    address = address.rename(columns={'address_id': 'location_id'})
 
     return address[[
         'location_id',
@@ -108,15 +796,12 @@ def make_dim_location(client):
     ]]
 
 
-def make_dim_counterparty(client):
+def make_dim_counterparty(client, loader=None):
     logger.info('Creating dim_counterparty')
+    loader = loader or TableLoader(client)
 
-    counterparty = get_from_ingest(client, 'counterparty')
-    counterparty.drop_duplicates(subset=['counterparty_id'], keep='last', inplace=True)
-
-    address = get_from_ingest(client, 'address')
-    address.drop_duplicates(subset=['address_id'], keep='last', inplace=True)
-    address.rename(columns={'address_id': 'legal_address_id'}, inplace=True)
+    counterparty = loader.get('counterparty')
+    address = loader.get('address').set_index('address_id')
 
     dim_counterparty = counterparty.join(address, on='legal_address_id', rsuffix='_address')
     dim_counterparty.rename(
@@ -144,42 +829,40 @@ def make_dim_counterparty(client):
     ]]
 
 
-def make_dim_currency(client):
+def make_dim_currency(client, loader=None):
     # TODO Add currency_name
     logger.info('Creating dim_currency')
+    loader = loader or TableLoader(client)
 
-    currency = get_from_ingest(client, 'currency')
-    currency.drop_duplicates(subset=['currency_id'], keep='last', inplace=True)
+    currency = loader.get('currency')
 
     return currency[['currency_id', 'currency_code']]
 
 
-def make_dim_design(client):
+def make_dim_design(client, loader=None):
     logger.info('Creating dim_design')
+    loader = loader or TableLoader(client)
 
-    design = get_from_ingest(client, 'design')
-    design.drop_duplicates(subset=['design_id'], keep='last', inplace=True)
+    design = loader.get('design')
 
     return design[['design_id', 'design_name', 'file_location', 'file_name']]
 
 
-def make_dim_payment_type(client):
+def make_dim_payment_type(client, loader=None):
     logger.info('Creating dim_paymet_design')
+    loader = loader or TableLoader(client)
 
-    payment_type = get_from_ingest(client, 'payment_type')
-    payment_type.drop_duplicates(subset=['payment_type_id'], keep='last', inplace=True)
+    payment_type = loader.get('payment_type')
 
     return payment_type[['payment_type_id', 'payment_type_name']]
 
 
-def make_dim_staff(client):
+def make_dim_staff(client, loader=None):
     logger.info('Creating dim_staff')
+    loader = loader or TableLoader(client)
 
-    staff = get_from_ingest(client, 'staff')
-    staff.drop_duplicates(subset=['staff_id'], keep='last', inplace=True)
-
-    department = get_from_ingest(client, 'department')
-    department.drop_duplicates(subset=['department_id'], keep='last', inplace=True)
+    staff = loader.get('staff')
+    department = loader.get('department').set_index('department_id')
 
     dim_staff = staff.join(department, on='department_id', rsuffix='department')
     return dim_staff[[
@@ -192,11 +875,11 @@ def make_dim_staff(client):
     ]]
 
 
-def make_dim_transaction(client):
+def make_dim_transaction(client, loader=None):
     logger.info('Creating dim_transaction')
+    loader = loader or TableLoader(client)
 
-    transact = get_from_ingest(client, 'transaction')
-    transact.drop_duplicates(subset=['transaction_id'], keep='last', inplace=True)
+    transact = loader.get('transaction')
 
     return transact[[
         'transaction_id',
@@ -206,233 +889,500 @@ def make_dim_transaction(client):
     ]]
 
 
-def make_dim_dates(payments, purchases, sales):
-    logger.info('Creating dim_date')
-
-    logger.info('Getting dates from payment')
-    payment_dates = payments[['created_at', 'last_updated', 'payment_date']]
-    payment_dates = pd.melt(payment_dates)['value']
-
-    logger.info('Getting dates from sales_order')
-    sales_dates = purchases[['created_at', 'last_updated', 'agreed_delivery_date', 'agreed_payment_date']]
-    sales_dates = pd.melt(sales_dates)['value']
-
-    logger.info('Getting dates from purchase_order')
-    purchase_dates = sales[['created_at', 'last_updated', 'agreed_delivery_date', 'agreed_payment_date']]
-    purchase_dates = pd.melt(purchase_dates)['value']
-
-    logger.info('Collating dates')
-    total_dates = pd.concat([payment_dates, sales_dates, purchase_dates], axis=0)
-    total_dates = pd.to_datetime(total_dates, format='mixed')
-    total_dates.sort_values(inplace=True)
-
-    logger.info('Creating dates')
-    dates = pd.DataFrame({
-        'year': total_dates.dt.year,
-        'month': total_dates.dt.month,
-        'day': total_dates.dt.day,
-        'day_of_week': total_dates.dt.day_of_week,
-        'day_name': total_dates.dt.day_name(),
-        'month_name': total_dates.dt.month_name(),
-        'quarter': total_dates.dt.quarter
+# The dimensions above for the arrow backend: the source table, an optional
+# left join as (table, column, its id column) and each output column with the
+# column it is taken from
+ARROW_DIMENSIONS = {
+    'dim_counterparty': {
+        'source': 'counterparty',
+        'join': ('address', 'legal_address_id', 'address_id'),
+        'columns': {
+            'counterparty_id': 'counterparty_id',
+            'counterparty_legal_name': 'counterparty_legal_name',
+            'counterparty_legal_address_line_1': 'address_line_1',
+            'counterparty_legal_address_line_2': 'address_line_2',
+            'counterparty_legal_district': 'district',
+            'counterparty_legal_city': 'city',
+            'counterparty_legal_postal_code': 'postal_code',
+            'counterparty_legal_country': 'country',
+            'counterparty_legal_phone_number': 'phone'
+        }
+    },
+    'dim_currency': {
+        'source': 'currency',
+        'columns': {'currency_id': 'currency_id', 'currency_code': 'currency_code'}
+    },
+    'dim_design': {
+        'source': 'design',
+        'columns': {
+            'design_id': 'design_id',
+            'design_name': 'design_name',
+            'file_location': 'file_location',
+            'file_name': 'file_name'
+        }
+    },
+    'dim_location': {
+        'source': 'address',
+        'columns': {
+            'location_id': 'address_id',
+            'address_line_1': 'address_line_1',
+            'address_line_2': 'address_line_2',
+            'district': 'district',
+            'city': 'city',
+            'postal_code': 'postal_code',
+            'country': 'country',
+            'phone': 'phone'
+        }
+    },
+    'dim_payment_type': {
+        'source': 'payment_type',
+        'columns': {'payment_type_id': 'payment_type_id', 'payment_type_name': 'payment_type_name'}
+    },
+    'dim_staff': {
+        'source': 'staff',
+        'join': ('department', 'department_id', 'department_id'),
+        'columns': {
+            'staff_id': 'staff_id',
+            'first_name': 'first_name',
+            'last_name': 'last_name',
+            'department_name': 'department_name',
+            'location': 'location',
+            'email_address': 'email_address'
+        }
+    },
+    'dim_transaction': {
+        'source': 'transaction',
+        'columns': {
+            'transaction_id': 'transaction_id',
+            'transaction_type': 'transaction_type',
+            'sales_order_id': 'sales_order_id',
+            'purchase_order_id': 'purchase_order_id'
+        }
+    }
+}
+
+
+def make_arrow_dimension(name, loader):
+    logger.info(f'Creating {name} with arrow')
+    spec = ARROW_DIMENSIONS[name]
+
+    table = loader.get(spec['source'])
+    if 'join' in spec:
+        right, column, right_column = spec['join']
+        # Hash joins do not keep row order, the row number puts it back
+        table = table.append_column('row', pa.array(np.arange(table.num_rows)))
+        table = table.join(
+            loader.get(right), keys=column, right_keys=right_column, join_type='left outer'
+        ).sort_by('row')
+    return table.select(list(spec['columns'].values())).rename_columns(list(spec['columns']))
+
+
+# Date columns of each fact source, the range dim_date has to cover
+DATE_COLUMNS = {
+    'payment': ['created_at', 'last_updated', 'payment_date'],
+    'purchase_order': ['created_at', 'last_updated', 'agreed_delivery_date', 'agreed_payment_date'],
+    'sales_order': ['created_at', 'last_updated', 'agreed_delivery_date', 'agreed_payment_date']
+}
+
+# Output columns of each fact in order, as (name, source column, kind). Kind
+# 'date' turns the source into a YYYYMMDD key, 'time' into its time of day.
+FACT_SPECS = {
+    'fact_payment': {
+        'source': 'payment',
+        'record_id': 'record_payment_id',
+        'columns': [
+            ('payment_id', 'payment_id', None),
+            ('created_date', 'created_at', 'date'),
+            ('created_time', 'created_at', 'time'),
+            ('last_updated_date', 'last_updated', 'date'),
+            ('last_updated_time', 'last_updated', 'time'),
+            ('transaction_id', 'transaction_id', None),
+            ('counterparty_id', 'counterparty_id', None),
+            ('payment_amount', 'payment_amount', None),
+            ('currency_id', 'currency_id', None),
+            ('payment_type_id', 'payment_type_id', None),
+            ('paid', 'paid', None),
+            ('payment_date', 'payment_date', 'date')
+        ]
+    },
+    'fact_purchase_order': {
+        'source': 'purchase_order',
+        'record_id': 'purchase_record_id',
+        'columns': [
+            ('purchase_order_id', 'purchase_order_id', None),
+            ('created_date', 'created_at', 'date'),
+            ('created_time', 'created_at', 'time'),
+            ('last_updated_date', 'last_updated', 'date'),
+            ('last_updated_time', 'last_updated', 'time'),
+            ('staff_id', 'staff_id', None),
+            ('counterparty_id', 'counterparty_id', None),
+            ('item_code', 'item_code', None),
+            ('item_quantity', 'item_quantity', None),
+            ('item_unit_price', 'item_unit_price', None),
+            ('currency_id', 'currency_id', None),
+            ('agreed_delivery_date', 'agreed_delivery_date', 'date'),
+            ('agreed_payment_date', 'agreed_payment_date', 'date'),
+            ('agreed_delivery_location_id', 'agreed_delivery_location_id', None)
+        ]
+    },
+    'fact_sales_order': {
+        'source': 'sales_order',
+        'record_id': 'sales_record_id',
+        'columns': [
+            ('sales_order_id', 'sales_order_id', None),
+            ('created_date', 'created_at', 'date'),
+            ('created_time', 'created_at', 'time'),
+            ('last_updated_date', 'last_updated', 'date'),
+            ('last_updated_time', 'last_updated', 'time'),
+            ('sales_staff_id', 'staff_id', None),
+            ('counterparty_id', 'counterparty_id', None),
+            ('units_sold', 'units_sold', None),
+            ('unit_price', 'unit_price', None),
+            ('currency_id', 'currency_id', None),
+            ('design_id', 'design_id', None),
+            ('agreed_payment_date', 'agreed_payment_date', 'date'),
+            ('agreed_delivery_date', 'agreed_delivery_date', 'date'),
+            ('agreed_delivery_location_id', 'agreed_delivery_location_id', None)
+        ]
+    }
+}
+
+
+def date_keys(values):
+    # YYYYMMDD, so a fact row's date key needs no lookup in dim_date
+    dates = pd.to_datetime(values, format='ISO8601')
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('Int64')
+
+
+def date_bounds(frame, columns):
+    # ISO strings and timestamps both order chronologically, so only the
+    # bounds of each column are parsed
+    bounds = []
+    if isinstance(frame, pa.Table):
+        for column in columns:
+            extremes = pc.min_max(arrow_timestamps(frame[column]))
+            if extremes['min'].is_valid:
+                bounds += [pd.Timestamp(extremes['min'].as_py()), pd.Timestamp(extremes['max'].as_py())]
+        return bounds
+    for column in columns:
+        values = frame[column].dropna()
+        if not values.empty:
+            bounds += [pd.Timestamp(str(values.min())), pd.Timestamp(str(values.max()))]
+    return bounds
+
+
+def make_calendar(bounds, existing=None):
+    if not bounds:
+        return None
+
+    start, end = min(bounds).normalize(), max(bounds).normalize()
+    if existing is not None and not existing.empty:
+        current = pd.to_datetime(existing['date_id'].astype(str), format='%Y%m%d', errors='coerce')
+        if current.isna().any():
+            # Calendars written before date_id became YYYYMMDD number their days 1..N
+            logger.info('dim_date does not have YYYYMMDD keys, rebuilding it')
+            return make_calendar(bounds)
+        if current.min() <= start and end <= current.max():
+            logger.info('dim_date already covers every date')
+            return None
+        start, end = min(start, current.min()), max(end, current.max())
+
+    logger.info(f'Creating dates from {start.date()} to {end.date()}')
+    calendar = pd.date_range(start, end, freq='D')
+    return pd.DataFrame({
+        'date_id': calendar.year * 10000 + calendar.month * 100 + calendar.day,
+        'year': calendar.year,
+        'month': calendar.month,
+        'day': calendar.day,
+        'day_of_week': calendar.day_of_week,
+        'day_name': calendar.day_name(),
+        'month_name': calendar.month_name(),
+        'quarter': calendar.quarter
     })
-    dates.drop_duplicates(keep='first', inplace=True)
-    dates.insert(0, 'date_id', range(1, len(dates)+1))
 
-    return dates
 
+def make_dim_dates(payments, purchases, sales, existing=None):
+    logger.info('Creating dim_date')
 
-def make_fact_payment(payment: pd.DataFrame, date: pd.DataFrame):
-    payment['created_at'] = pd.to_datetime(payment['created_at'])
-    payment['last_updated'] = pd.to_datetime(payment['last_updated'])
-    payment['payment_date'] = pd.to_datetime(payment['payment_date']).dt.date
+    bounds = []
+    for frame, table in ((payments, 'payment'), (purchases, 'purchase_order'), (sales, 'sales_order')):
+        bounds += date_bounds(frame, DATE_COLUMNS[table])
+    return make_calendar(bounds, existing)
 
-    payment['created_date'] = payment['created_at'].dt.date
-    payment['created_time'] = payment['created_at'].dt.strftime('%H:%M:%S.%f')
 
-    payment['last_updated_date'] = payment['last_updated'].dt.date
-    payment['last_updated_time'] = payment['last_updated'].dt.strftime('%H:%M:%S.%f')
+def time_of_day(timestamps):
+    # Microseconds since midnight as a native Parquet TIME column
+    micros = (timestamps - timestamps.dt.floor('D')).to_numpy().astype('timedelta64[us]').astype('int64')
+    times = pa.array(micros, mask=timestamps.isna().to_numpy()).cast(pa.time64('us'))
+    return pd.Series(pd.arrays.ArrowExtensionArray(times), index=timestamps.index)
 
-    date['date'] = pd.to_datetime(date[['year', 'month', 'day']]).dt.date
-    dates = date[['date_id', 'date']]
-    dates.set_index('date', inplace=True)
 
-    created = payment.join(
-        dates.rename(columns={'date_id': 'c_date_id', 'date': 'created_date'}),
-        on='created_date',
-        rsuffix='_2'
-    )
-    updated = created.join(
-        dates.rename(columns={'date_id': 'u_date_id', 'date': 'last_updated_date'}),
-        on='last_updated_date',
-        rsuffix='_2'
-    )
-    paymented = updated.join(
-        dates.rename(columns={'date_id': 'p_date_id', 'date': 'payment_date'}),
-        on='payment_date',
-        rsuffix='_2'
-    )
+def make_fact(fact_name, source: pd.DataFrame):
+    logger.info(f'Creating {fact_name}')
+    spec = FACT_SPECS[fact_name]
 
-    processed_payment = paymented[[
-        'payment_id',
-        'c_date_id',
-        'created_time',
-        'u_date_id',
-        'last_updated_time',
-        'transaction_id',
-        'counterparty_id',
-        'payment_amount',
-        'currency_id',
-        'payment_type_id',
-        'paid',
-        'p_date_id'
-    ]]
-    processed_payment.rename(
-        columns={
-            'c_date_id': 'created_date',
-            'u_date_id': 'last_updated_date',
-            'p_date_id': 'payment_date'
-        },
-        inplace=True
-    )
-    processed_payment.insert(0, 'record_payment_id', range(1, len(processed_payment)+1))
-    
-    return processed_payment
+    # Each timestamp column is parsed once however many outputs it feeds,
+    # and the fact is assembled in one go rather than joined column by column
+    parsed = {}
+    columns = {spec['record_id']: range(1, len(source)+1)}
+    for output, column, kind in spec['columns']:
+        if kind is None:
+            columns[output] = source[column]
+            continue
+        if column not in parsed:
+            parsed[column] = pd.to_datetime(source[column], format='ISO8601')
+        columns[output] = date_keys(parsed[column]) if kind == 'date' else time_of_day(parsed[column])
 
+    return pd.DataFrame(columns, index=source.index)
 
-def make_fact_purchase_order(purchases: pd.DataFrame, date: pd.DataFrame):
-    purchases['created_at'] = pd.to_datetime(purchases['created_at'])
-    purchases['last_updated'] = pd.to_datetime(purchases['last_updated'])
-    purchases['agreed_delivery_date'] = pd.to_datetime(purchases['agreed_delivery_date']).dt.date
-    purchases['agreed_payment_date'] = pd.to_datetime(purchases['agreed_payment_date']).dt.date
 
-    purchases['created_date'] = purchases['created_at'].dt.date
-    purchases['created_time'] = purchases['created_at'].dt.strftime('%H:%M:%S.%f')
+def arrow_timestamps(values):
+    # Arrow parses ISO dates and timestamps alike when casting strings
+    return values if pa.types.is_timestamp(values.type) else pc.cast(values, pa.timestamp('ns'))
 
-    purchases['last_updated_date'] = purchases['last_updated'].dt.date
-    purchases['last_updated_time'] = purchases['last_updated'].dt.strftime('%H:%M:%S.%f')
 
-    date['date'] = pd.to_datetime(date[['year', 'month', 'day']]).dt.date
-    dates = date[['date_id', 'date']]
-    dates.set_index('date', inplace=True)
-
-    created = purchases.join(
-        dates.rename(columns={'date_id': 'c_date_id', 'date': 'created_date'}),
-        on='created_date',
-        rsuffix='_2'
-    )
-    updated = created.join(
-        dates.rename(columns={'date_id': 'u_date_id', 'date': 'last_updated_date'}),
-        on='last_updated_date',
-        rsuffix='_2'
-    )
-    delivered = updated.join(
-        dates.rename(columns={'date_id': 'd_date_id', 'date': 'agreed_delivery_date'}),
-        on='agreed_delivery_date',
-        rsuffix='_2'
-    )
-    paymented = delivered.join(
-        dates.rename(columns={'date_id': 'p_date_id', 'date': 'payment_date'}),
-        on='agreed_payment_date',
-        rsuffix='_2'
-    )
-
-    processed_purchases = paymented[[
-        'purchase_order_id',
-        'c_date_id',
-        'created_time',
-        'u_date_id',
-        'last_updated_time',
-        'staff_id',
-        'counterparty_id',
-        'item_code',
-        'item_quantity',
-        'item_unit_price',
-        'currency_id',
-        'd_date_id',
-        'p_date_id',
-        'agreed_delivery_location_id'
-    ]]
-    processed_purchases.rename(
-        columns={
-            'c_date_id': 'created_date',
-            'u_date_id': 'last_updated_date',
-            'd_date_id': 'agreed_delivery_date',
-            'p_date_id': 'agreed_payment_date'
-        },
-        inplace=True
+def arrow_date_keys(timestamps):
+    return pc.add(
+        pc.add(pc.multiply(pc.year(timestamps), 10000), pc.multiply(pc.month(timestamps), 100)),
+        pc.day(timestamps)
     )
-    processed_purchases.insert(0, 'purchase_record_id', range(1, len(processed_purchases)+1))
 
-    return processed_purchases
 
+def make_arrow_fact(fact_name, source: pa.Table):
+    logger.info(f'Creating {fact_name} with arrow')
+    spec = FACT_SPECS[fact_name]
+
+    parsed = {}
+    columns = {spec['record_id']: pa.array(np.arange(1, source.num_rows + 1, dtype='int32'))}
+    for output, column, kind in spec['columns']:
+        if kind is None:
+            columns[output] = source[column]
+            continue
+        if column not in parsed:
+            parsed[column] = arrow_timestamps(source[column])
+        if kind == 'date':
+            columns[output] = arrow_date_keys(parsed[column])
+        else:
+            columns[output] = pc.cast(parsed[column], pa.time64('us'))
 
-def make_fact_sales_order(sales: pd.DataFrame, date: pd.DataFrame):
-    sales['created_at'] = pd.to_datetime(sales['created_at'])
-    sales['last_updated'] = pd.to_datetime(sales['last_updated'])
-    sales['agreed_payment_date'] = pd.to_datetime(sales['agreed_payment_date']).dt.date
-    sales['agreed_delivery_date'] = pd.to_datetime(sales['agreed_delivery_date']).dt.date
+    return pa.table(columns)
 
-    sales['created_date'] = sales['created_at'].dt.date
-    sales['created_time'] = sales['created_at'].dt.strftime('%H:%M:%S.%f')
 
-    sales['last_updated_date'] = sales['last_updated'].dt.date
-    sales['last_updated_time'] = sales['last_updated'].dt.strftime('%H:%M:%S.%f')
+def get_fact_state(client, fact_name):
+    try:
+        data = client.get_object(
+            Bucket=PROCESSED_BUCKET,
+            Key=f'{FACT_STATE_PREFIX}{fact_name}.parquet'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            logger.info(f'No record ids issued for {fact_name} yet')
+            return None
+        raise
+    state = pd.read_parquet(BytesIO(data['Body'].read()))
+    state['last_updated'] = state['last_updated'].astype('datetime64[ns]')
+    return state
 
-    date['date'] = pd.to_datetime(date[['year', 'month', 'day']]).dt.date
-    dates = date[['date_id', 'date']]
-    dates.set_index('date', inplace=True)
 
-    created = sales.join(
-        dates.rename(columns={'date_id': 'c_date_id', 'date': 'created_date'}),
-        on='created_date',
-        rsuffix='_2'
-    )
-    updated = created.join(
-        dates.rename(columns={'date_id': 'u_date_id', 'date': 'last_updated_date'}),
-        on='last_updated_date',
-        rsuffix='_2'
-    )
-    delivered = updated.join(
-        dates.rename(columns={'date_id': 'd_date_id', 'date': 'agreed_delivery_date'}),
-        on='agreed_delivery_date',
-        rsuffix='_2'
-    )
-    paymented = delivered.join(
-        dates.rename(columns={'date_id': 'p_date_id', 'date': 'payment_date'}),
-        on='agreed_payment_date',
-        rsuffix='_2'
+def put_fact_state(client, fact_name, state):
+    client.put_object(
+        Bucket=PROCESSED_BUCKET,
+        Key=f'{FACT_STATE_PREFIX}{fact_name}.parquet',
+        Body=state.to_parquet(index=False, compression='zstd')
     )
 
-    processed_sales = paymented[[
-        'sales_order_id',
-        'c_date_id',
-        'created_time',
-        'u_date_id',
-        'last_updated_time',
-        'staff_id',
-        'counterparty_id',
-        'units_sold',
-        'unit_price',
-        'currency_id',
-        'design_id',
-        'p_date_id',
-        'd_date_id',
-        'agreed_delivery_location_id'
-    ]]
-    processed_sales.rename(
-        columns={
-            'c_date_id': 'created_date',
-            'u_date_id': 'last_updated_date',
-            'staff_id': 'sales_staff_id',
-            'p_date_id': 'agreed_payment_date',
-            'd_date_id': 'agreed_delivery_date'
-        },
-        inplace=True
-    )
-    processed_sales.insert(0, 'sales_record_id', range(1, len(processed_sales)+1))
 
-    return processed_sales
+def make_fact_delta(fact_name, source: pd.DataFrame, state=None):
+    spec = FACT_SPECS[fact_name]
+    record_id = spec['record_id']
+    fact = make_fact(fact_name, source).reset_index(drop=True)
+
+    versions = pd.DataFrame({
+        'id': fact[spec['columns'][0][0]].to_numpy(),
+        'last_updated': pd.to_datetime(source['last_updated'], format='ISO8601').to_numpy('datetime64[ns]'),
+        'row_hash': pd.util.hash_pandas_object(fact.drop(columns=record_id), index=False).to_numpy()
+    })
+    versions = versions.drop_duplicates(subset=['id', 'last_updated'], keep='last')
+    fact = fact.loc[versions.index].reset_index(drop=True)
+
+    if state is None:
+        state = pd.DataFrame({
+            'id': pd.Series(dtype=versions['id'].dtype),
+            'last_updated': pd.Series(dtype='datetime64[ns]'),
+            'record_id': pd.Series(dtype='int64'),
+            'row_hash': pd.Series(dtype='uint64')
+        })
+    merged = versions.merge(state, on=['id', 'last_updated'], how='left', suffixes=('', '_issued'))
+
+    # Versions seen before keep their id, new ones continue from the highest issued
+    new = merged['record_id'].isna()
+    next_id = int(state['record_id'].max()) + 1 if len(state) else 1
+    merged.loc[new, 'record_id'] = range(next_id, next_id + int(new.sum()))
+    merged['record_id'] = merged['record_id'].astype('int64')
+    changed = (new | (merged['row_hash'] != merged['row_hash_issued'])).to_numpy()
+
+    fact[record_id] = merged['record_id'].to_numpy()
+    delta = fact[changed].reset_index(drop=True)
+
+    kept = state.merge(versions[['id', 'last_updated']], on=['id', 'last_updated'], how='left', indicator=True)
+    kept = kept[kept['_merge'] == 'left_only'].drop(columns='_merge')
+    new_state = pd.concat([kept, merged[['id', 'last_updated', 'record_id', 'row_hash']]], axis=0, ignore_index=True)
+
+    logger.info(f'{fact_name} delta has {len(delta)} of {len(fact)} rows')
+    return delta, new_state
+
+
+def get_pending_deltas(client, fact_name):
+    # Deltas the warehouse has not loaded and deleted yet, oldest first
+    keys = []
+    after = None
+    while True:
+        marker = {'Marker': after} if after else {}
+        files = client.list_objects(
+            Bucket=PROCESSED_BUCKET,
+            Prefix=f'{DELTA_PREFIX}{fact_name.replace('_', '-')}/',
+            **marker
+        )
+        keys += [file['Key'] for file in files.get('Contents', [])]
+        if not files.get('IsTruncated'):
+            break
+        after = keys[-1]
+    return keys
+
+
+def put_fact_in_chunks(client, fact_name, bounds):
+    # Extends bounds with the dates seen, so dim_date needs no second pass
+    logger.info(f'Creating {fact_name} in chunks of {FACT_CHUNK_ROWS} rows')
+    spec = FACT_SPECS[fact_name]
+    key = f'{fact_name.replace('_', '-')}.parquet'
+    # A fact that fits in one part skips an unchanged upload like put_in_processed,
+    # larger ones are always uploaded
+    sink = multipart.MultipartSink(client, PROCESSED_BUCKET, key, put=lambda body: put_if_changed(client, key, body))
+    writer = None
+    rows = 0
+
+    try:
+        for chunk in iter_source_chunks(client, spec['source']):
+            bounds += date_bounds(chunk, DATE_COLUMNS[spec['source']])
+            fact = make_fact(fact_name, chunk)
+            fact[spec['record_id']] += rows
+            rows += len(fact)
+
+            table = pa.Table.from_pandas(apply_schema(fact, OUTPUT_SCHEMAS[fact_name]), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    pa.PythonFile(sink, mode='w'),
+                    table.schema,
+                    compression=PARQUET_COMPRESSION,
+                    use_dictionary=True,
+                    write_statistics=True
+                )
+            writer.write_table(table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+        if writer is None:
+            logger.warning(f'No source rows for {fact_name}')
+            sink.abort()
+            return None
+        writer.close()
+        uploaded = sink.close()
+    except Exception:
+        sink.abort()
+        raise
+
+    telemetry.add('rows', rows)
+    if not uploaded:
+        logger.info(f'{fact_name} is unchanged, not uploading it')
+        return None
+    logger.info(f'Wrote {rows} rows of {fact_name} in {max(len(sink.parts), 1)} parts')
+    return key
+
+
+def make_chunked_dim_date(client, builds, bounds, existing_dates=None):
+    # Runs after the chunked facts have filled bounds. Without a dim_date to
+    # extend, the sources of facts not rebuilt are scanned for their dates too.
+    if existing_dates is None:
+        for name, spec in FACT_SPECS.items():
+            if name not in builds:
+                for chunk in iter_source_chunks(client, spec['source']):
+                    bounds += date_bounds(chunk, DATE_COLUMNS[spec['source']])
+    return make_calendar(bounds, existing_dates)
+
+
+DIMENSION_BUILDERS = {
+    'dim_counterparty': make_dim_counterparty,
+    'dim_currency': make_dim_currency,
+    'dim_design': make_dim_design,
+    'dim_location': make_dim_location,
+    'dim_payment_type': make_dim_payment_type,
+    'dim_staff': make_dim_staff,
+    'dim_transaction': make_dim_transaction
+}
+
+
+def make_tasks(client, loader, builds):
+    # One task per planned output, each uploading what it built as soon as
+    # it is done. Returns the tasks and what each has to wait for.
+    tasks = {}
+    dependencies = {}
+    chunked = CHUNKED_FACTS and not INCREMENTAL_FACTS
+    arrow = loader.backend == 'arrow'
+    bounds = []
+
+    def written(key):
+        # put_in_processed returns None for an output that did not change
+        return [] if key is None else [key]
+
+    def dimension_task(name):
+        if arrow:
+            return lambda: written(put_in_processed(client, name, make_arrow_dimension(name, loader)))
+        return lambda: written(put_in_processed(client, name, DIMENSION_BUILDERS[name](client, loader)))
+
+    def dim_date_task():
+        # Only rewritten when the new rows fall outside the current calendar
+        existing = get_parquet(client, 'dim_date')
+        if chunked:
+            dim_date = make_chunked_dim_date(client, builds, bounds, existing)
+        else:
+            dim_date = make_dim_dates(
+                loader.get('payment'), loader.get('purchase_order'), loader.get('sales_order'), existing
+            )
+        return [] if dim_date is None else written(put_in_processed(client, 'dim_date', dim_date))
+
+    def fact_task(name):
+        def run():
+            if chunked:
+                return written(put_fact_in_chunks(client, name, bounds))
+
+            source_name = FACT_SPECS[name]['source']
+            source = loader.get(source_name)
+            if arrow and not (INCREMENTAL_FACTS or PARTITIONED_FACTS):
+                return written(put_in_processed(client, name, make_arrow_fact(name, source)))
+            if arrow:
+                # Record id tracking and partitioning work on pandas frames
+                source = apply_schema(source.to_pandas(), SOURCE_SCHEMAS[source_name])
+            if INCREMENTAL_FACTS:
+                delta, state = make_fact_delta(name, source, get_fact_state(client, name))
+                if not delta.empty:
+                    put_in_processed(client, f'{DELTA_PREFIX}{name}', delta)
+                # Issued ids are only recorded once the delta carrying them is stored
+                put_fact_state(client, name, state)
+                return get_pending_deltas(client, name)
+            if PARTITIONED_FACTS:
+                return put_partitioned_in_processed(client, name, make_fact(name, source))
+            return written(put_in_processed(client, name, make_fact(name, source)))
+        return run
+
+    for name in builds:
+        if name in DIMENSION_BUILDERS:
+            tasks[name] = dimension_task(name)
+        elif name in FACT_SPECS:
+            tasks[name] = fact_task(name)
+        elif name == 'dim_date':
+            tasks[name] = dim_date_task
+            if chunked:
+                # The chunked facts collect the dates dim_date covers
+                dependencies[name] = [fact for fact in builds if fact in FACT_SPECS]
+    return tasks, dependencies
 
 
 # {'updates': ['currency', 'payment']}}
@@ -440,54 +1390,29 @@ def lambda_handler(event, context):
     logger.info('Starting lambda')
 
     updates = event['updates']
-
-    dimensions = {}
-    facts = {}
-    
     s3_client = boto3.client('s3')
 
-    if 'counterparty' in updates:
-        dimensions['dim_counterparty'] = make_dim_counterparty(s3_client)
-    if 'currency' in updates:
-        dimensions['dim_currency'] = make_dim_currency(s3_client)
-    if 'design' in updates:
-        dimensions['dim_design'] = make_dim_design(s3_client)
-    if 'address' in updates:
-        dimensions['dim_location'] = make_dim_location(s3_client)
-    if 'payment_type' in updates:
-        dimensions['dim_payment_type'] = make_dim_payment_type(s3_client)
-    if 'staff' in updates or 'department' in updates:
-        dimensions['dim_staff'] = make_dim_staff(s3_client)
-    if 'transaction' in updates:
-        dimensions['dim_transaction'] = make_dim_transaction(s3_client)
-
-    if 'payment' in updates or 'purchase_order' in updates or 'sales_order' in updates:
-        payment = get_from_ingest(s3_client, 'payment')
-        purchase_order = get_from_ingest(s3_client, 'purchase_order')
-        sales_order = get_from_ingest(s3_client, 'sales_order')
-        dimensions['dim_date'] = make_dim_dates(payment, purchase_order, sales_order)
-        if 'payment' in updates:
-            facts['fact_payment'] = make_fact_payment(payment, dimensions['dim_date'])
-        if 'purchase_order' in updates:
-            facts['fact_purchase_order'] = make_fact_purchase_order(purchase_order, dimensions['dim_date'])
-        if 'sales_order' in updates:
-            facts['fact_sales_order'] = make_fact_sales_order(sales_order, dimensions['dim_date'])
-
-    for table in dimensions.keys():
-        put_in_processed(s3_client, table, dimensions[table])
-
-    for table in facts.keys():
-        put_in_processed(s3_client, table, facts[table])
-
-    new_files = list(dimensions.keys()) + list(facts.keys())
-    new_files = [file.replace("_", "-") + '.parquet' for file in new_files]
-    
+    with telemetry.span('process', 'invocation') as span:
+        # Every table the planned builders read, counted once per builder, so
+        # the loader can drop a table as soon as its last builder has run
+        builds = plan_builders(updates)
+        loader = TableLoader(s3_client, [table for name in builds for table in BUILDER_INPUTS[name]])
+
+        tasks, dependencies = make_tasks(s3_client, loader, builds)
+        new_files = run_builders(tasks, dependencies)
+        span.add('files', len(new_files))
+    if not new_files:
+        logger.info('No output changed, nothing for the warehouse to load')
+        return
+
     lambda_client = boto3.client('lambda')
     lambda_client.invoke(
         FunctionName='warehousing_lambda',
         InvocationType='Event',
-        Body=json.dumps({'Records': new_files})
+        Payload=json.dumps({'Records': new_files})
     )
+
+
 if __name__ == '__main__':
     logging.getLogger().addHandler(logging.StreamHandler())
     lambda_handler({}, {})
\ No newline at end of file
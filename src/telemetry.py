@@ -0,0 +1,134 @@
+from contextvars import ContextVar
+import json
+import os
+import resource
+import threading
+import time
+
+
+# Per-stage timings and counters shared by the three lambdas. Off by default,
+# when span() hands back a shared object that does nothing. TELEMETRY=emf
+# prints each finished span as a CloudWatch Embedded Metric Format line,
+# which CloudWatch turns into metrics from the lambda's log, and
+# TELEMETRY=local keeps them in records for tests and benchmarks.
+TELEMETRY = os.environ.get('TELEMETRY', 'off').lower()
+NAMESPACE = os.environ.get('TELEMETRY_NAMESPACE', 'Crigglestone/Pipeline')
+
+UNITS = {
+    'duration_ms': 'Milliseconds',
+    'rows': 'Count',
+    'bytes': 'Bytes',
+    'files': 'Count',
+    'retries': 'Count',
+    'skipped': 'Count',
+    'errors': 'Count',
+    'max_rss_mb': 'Megabytes'
+}
+
+records = []
+_records_lock = threading.Lock()
+
+# Innermost open span of the running thread, which add() counts into
+_current = ContextVar('telemetry_span', default=None)
+
+
+def max_rss_mb():
+    # Peak resident memory of the process so far, kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Span:
+    """Times one extraction, S3 call, builder or load and collects its counters."""
+    def __init__(self, stage, operation, table=None):
+        self.stage = stage
+        self.operation = operation
+        self.table = table
+        self.metrics = {}
+
+    def add(self, metric, value=1):
+        self.metrics[metric] = self.metrics.get(metric, 0) + value
+
+    def __enter__(self):
+        self.token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics['duration_ms'] = round((time.perf_counter() - self.start) * 1000, 3)
+        self.metrics['max_rss_mb'] = round(max_rss_mb(), 1)
+        if exc_type is not None:
+            self.add('errors')
+        _current.reset(self.token)
+        emit(self)
+
+
+class NullSpan:
+    """Stands in for a span while telemetry is off."""
+    def add(self, metric, value=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def enabled():
+    return TELEMETRY != 'off'
+
+
+def span(stage, operation, table=None):
+    if not enabled():
+        return NULL_SPAN
+    return Span(stage, operation, table)
+
+
+def add(metric, value=1):
+    # Counts into the span open around the caller, if there is one
+    active = _current.get()
+    if active is not None:
+        active.add(metric, value)
+
+
+def to_emf(finished):
+    dimensions = {'Stage': finished.stage, 'Operation': finished.operation}
+    dimension_sets = [['Stage', 'Operation']]
+    if finished.table is not None:
+        dimensions['Table'] = finished.table
+        dimension_sets.append(['Stage', 'Operation', 'Table'])
+    return {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': dimension_sets,
+                'Metrics': [
+                    {'Name': metric, 'Unit': UNITS.get(metric, 'None')} for metric in finished.metrics
+                ]
+            }]
+        },
+        **dimensions,
+        **finished.metrics
+    }
+
+
+def emit(finished):
+    document = to_emf(finished)
+    if TELEMETRY == 'local':
+        with _records_lock:
+            records.append(document)
+    else:
+        # One line per span, the lambda runtime sends stdout to CloudWatch Logs
+        print(json.dumps(document), flush=True)
+
+
+def drain():
+    # Hands over the spans kept so far and forgets them
+    with _records_lock:
+        drained = list(records)
+        records.clear()
+    return drained
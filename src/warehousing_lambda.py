@@ -2,28 +2,108 @@ import awswrangler as wr
 import  pg8000
 import boto3
 from botocore.exceptions import ClientError
+from io import BytesIO
 import json
 import logging
+import os
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import re
+import socket
+import telemetry
+import time
+from urllib.parse import unquote_plus
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 PROCESSED_BUCKET = "nc-crigglestone-processed-bucket"
 
+# Incremental fact deltas are upserted on their record id instead of
+# overwriting the table. Each is deleted once it is loaded, so any left under
+# deltas/ are still to be loaded.
+DELTA_PREFIX = "deltas/"
+UPSERT_KEYS = {
+    "payment": "record_payment_id",
+    "purchase_order": "purchase_record_id",
+    "sales_order": "sales_record_id"
+}
+
+# The facts' times of day are Parquet TIME columns, which awswrangler has no
+# Postgres type for, so to_sql is told to create them as TIME
+TIME_COLUMNS = ["created_time", "last_updated_time"]
+
+# Partitioned facts arrive one year/month of created_date at a time, each
+# replacing that month's rows. Rows without a created_date come in their own
+# year=__null__/month=__null__ partition.
+PARTITION_COLUMN = "created_date"
+NULL_PARTITION = "__null__"
+PARTITION_PATTERN = re.compile(r"/year=(\d{4}|__null__)/month=(\d{2}|__null__)/")
+
+# COPY_LOAD=true streams each file into Postgres with COPY ... FROM STDIN
+# instead of to_sql's batches of INSERTs. The Parquet file is decoded and
+# rendered as CSV COPY_BATCH_ROWS rows at a time, without going through
+# pandas. Files with a column COPY_TYPES does not cover still go through to_sql.
+COPY_LOAD = os.environ.get('COPY_LOAD', 'false').lower() == 'true'
+COPY_BATCH_ROWS = int(os.environ.get('COPY_BATCH_ROWS', '50000'))
+
+# The column types to_sql creates, plus TIME, which to_sql has no mapping for
+COPY_TYPES = [
+    (pa.types.is_int8, "SMALLINT"),
+    (pa.types.is_int16, "SMALLINT"),
+    (pa.types.is_uint8, "SMALLINT"),
+    (pa.types.is_int32, "INTEGER"),
+    (pa.types.is_uint16, "INTEGER"),
+    (pa.types.is_int64, "BIGINT"),
+    (pa.types.is_uint32, "BIGINT"),
+    (pa.types.is_float32, "FLOAT"),
+    (pa.types.is_float64, "FLOAT8"),
+    (pa.types.is_boolean, "BOOL"),
+    (pa.types.is_string, "TEXT"),
+    (pa.types.is_large_string, "TEXT"),
+    (pa.types.is_timestamp, "TIMESTAMP"),
+    (pa.types.is_date32, "DATE"),
+    (pa.types.is_time64, "TIME")
+]
+
+# Kept at module level so warm invocations reuse the secret, clients and
+# warehouse connection instead of setting them up again
+SECRET_TTL = int(os.environ.get('SECRET_TTL', '900'))
+CONNECTION_TTL = int(os.environ.get('CONNECTION_TTL', '900'))
+
+_secret_cache = {}
+_client_cache = {}
+_connection_cache = {}
+
+def clear_caches():
+    _secret_cache.clear()
+    _client_cache.clear()
+    connection = _connection_cache.pop('warehouse', None)
+    if connection is not None:
+        close_quietly(connection[0])
+
+def get_client(service_name, **kwargs):
+    key = (service_name, tuple(sorted(kwargs.items())))
+    if key not in _client_cache:
+        _client_cache[key] = boto3.client(service_name, **kwargs)
+    return _client_cache[key]
+
 def get_rds_secret() -> dict:
+    cached = _secret_cache.get('warehouse')
+    if cached is not None and time.monotonic() < cached[1]:
+        return cached[0]
 
     secret_name = "warehouse-db-credentials"
     region_name = "eu-west-2"
 
-    client = boto3.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    client = get_client('secretsmanager', region_name=region_name)
     try:
         get_secret_value_response = client.get_secret_value(
             SecretId=secret_name
         )
         secret = json.loads(get_secret_value_response['SecretString'])
+        _secret_cache['warehouse'] = (secret, time.monotonic() + SECRET_TTL)
         return secret
     except ClientError as e:
         raise e 
@@ -45,30 +125,277 @@ def connect_to_warehouse():
         logger.warning(f'Database connection failed due to {e}')
         raise
 
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+def is_connection_alive(connection):
+    try:
+        connection.rollback()
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.info(f'Dropping stale warehouse connection: {e}')
+        return False
+
+def get_warehouse_connection():
+    cached = _connection_cache.get('warehouse')
+    if cached is not None:
+        connection, opened_at = cached
+        if time.monotonic() - opened_at < CONNECTION_TTL and is_connection_alive(connection):
+            return connection
+        _connection_cache.pop('warehouse')
+        close_quietly(connection)
+
+    try:
+        connection = connect_to_warehouse()
+    except Exception:
+        # The cached secret may have been rotated, fetch it again and retry once
+        _secret_cache.clear()
+        connection = connect_to_warehouse()
+    _connection_cache['warehouse'] = (connection, time.monotonic())
+    return connection
+
+def table_exists(connection, table_name):
+    return wr.postgresql.read_sql_query(
+        sql="SELECT to_regclass(%s) IS NOT NULL AS present",
+        con=connection,
+        params=[f"public.{table_name}"]
+    )["present"].iloc[0]
+
+def sql_types(data):
+    return {column: "TIME" for column in TIME_COLUMNS if column in data.columns}
+
+def partition_filter(partition):
+    # The condition on PARTITION_COLUMN selecting the rows a partition file replaces
+    if partition.group(1) == NULL_PARTITION:
+        return f'"{PARTITION_COLUMN}" IS NULL', ()
+    first = int(partition.group(1)) * 10000 + int(partition.group(2)) * 100
+    return f'"{PARTITION_COLUMN}" BETWEEN %s AND %s', (first, first + 99)
+
+def replace_partition_in_warehouse(connection, data, table_name, partition):
+    # The delete only commits together with the insert, in to_sql's transaction
+    if table_exists(connection, table_name):
+        condition, params = partition_filter(partition)
+        cursor = connection.cursor()
+        cursor.execute(f'DELETE FROM public."{table_name}" WHERE {condition}', params)
+        cursor.close()
+    wr.postgresql.to_sql(
+        df=data, table=table_name, con=connection, schema="public", mode="append", chunksize=1000,
+        dtype=sql_types(data)
+    )
+
+def upsert_to_warehouse(connection, data, table_name, key_column):
+    exists = table_exists(connection, table_name)
+    if not exists:
+        wr.postgresql.to_sql(
+            df=data, table=table_name, con=connection, schema="public", mode="append", chunksize=1000,
+            dtype=sql_types(data)
+        )
+
+    # ON CONFLICT needs a unique index on the record id
+    cursor = connection.cursor()
+    cursor.execute(
+        f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_{key_column}_key" '
+        f'ON public."{table_name}" ("{key_column}")'
+    )
+    cursor.close()
+    connection.commit()
+
+    if exists:
+        wr.postgresql.to_sql(
+            df=data,
+            table=table_name,
+            con=connection,
+            schema="public",
+            mode="upsert",
+            upsert_conflict_columns=[key_column],
+            chunksize=1000,
+            dtype=sql_types(data)
+        )
+
+def copy_type(data_type):
+    if pa.types.is_decimal(data_type):
+        return f"DECIMAL({data_type.precision},{data_type.scale})"
+    for matches, column_type in COPY_TYPES:
+        if matches(data_type):
+            return column_type
+    return None
+
+def copy_schema(schema):
+    # None when a column cannot be written as CSV that Postgres reads back.
+    # CSV has no dictionary encoding, dictionaries are written as their values.
+    fields = [
+        pa.field(field.name, field.type.value_type if pa.types.is_dictionary(field.type) else field.type)
+        for field in schema
+    ]
+    if any(copy_type(field.type) is None for field in fields):
+        return None
+    return pa.schema(fields)
+
+def csv_batches(parquet, schema):
+    # Decoded and rendered a batch at a time, so neither a large fact's rows
+    # nor its CSV are held in memory whole. Nulls are left empty and strings
+    # quoted, which keeps empty strings apart from NULL in COPY's csv format.
+    options = pacsv.WriteOptions(include_header=False)
+    for batch in parquet.iter_batches(batch_size=COPY_BATCH_ROWS):
+        sink = pa.BufferOutputStream()
+        pacsv.write_csv(pa.Table.from_batches([batch]).cast(schema), sink, options)
+        yield sink.getvalue().to_pybytes()
+
+def copy_rows(cursor, parquet, schema, target):
+    columns = ", ".join(f'"{column}"' for column in schema.names)
+    cursor.execute(f"COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv)", stream=csv_batches(parquet, schema))
+
+def create_table(cursor, schema, table_name):
+    columns = ", ".join(f'"{field.name}" {copy_type(field.type)}' for field in schema)
+    cursor.execute(f'CREATE TABLE public."{table_name}" ({columns})')
+
+def send_without_delay(connection):
+    # pg8000 ends a COPY with a second small write, which Nagle's algorithm
+    # holds back until the server's delayed ACK, about 40 ms per file
+    sock = getattr(connection, "_usock", None)
+    if isinstance(sock, socket.socket) and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def copy_to_warehouse(connection, parquet, schema, table_name, key_column=None, partition=None):
+    """
+    Loads a file with COPY in a single transaction, overwriting the table, upserting
+    a delta on key_column or replacing the rows of a partition.
+    """
+    send_without_delay(connection)
+    target = f'public."{table_name}"'
+    exists = table_exists(connection, table_name)
+    cursor = connection.cursor()
+    try:
+        if key_column is not None and exists:
+            # COPY cannot upsert, the rows land in a staging table first
+            columns = ", ".join(f'"{column}"' for column in schema.names)
+            updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in schema.names)
+            cursor.execute(
+                f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_{key_column}_key" ON {target} ("{key_column}")'
+            )
+            cursor.execute(f'CREATE TEMP TABLE "{table_name}_staging" (LIKE {target}) ON COMMIT DROP')
+            copy_rows(cursor, parquet, schema, f'"{table_name}_staging"')
+            cursor.execute(
+                f'INSERT INTO {target} ({columns}) SELECT {columns} FROM "{table_name}_staging" '
+                f'ON CONFLICT ("{key_column}") DO UPDATE SET {updates}'
+            )
+        else:
+            if partition is not None and exists:
+                condition, params = partition_filter(partition)
+                cursor.execute(f'DELETE FROM {target} WHERE {condition}', params)
+            else:
+                # Overwrites drop the table like to_sql's overwrite mode
+                cursor.execute(f"DROP TABLE IF EXISTS {target}")
+                create_table(cursor, schema, table_name)
+            copy_rows(cursor, parquet, schema, target)
+            if key_column is not None:
+                cursor.execute(
+                    f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_{key_column}_key" ON {target} ("{key_column}")'
+                )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def copy_parquet_to_warehouse(key, table_name, delta, partition):
+    # False when the file has a column COPY cannot load, for to_sql to load instead
+    with telemetry.span("warehouse", "s3_get", table_name) as span:
+        # Only the compressed file is held in memory, copy_rows decodes it in batches
+        body = get_client("s3").get_object(Bucket=PROCESSED_BUCKET, Key=key)["Body"].read()
+        parquet = pq.ParquetFile(BytesIO(body))
+        rows = parquet.metadata.num_rows
+        span.add("bytes", len(body))
+        span.add("rows", rows)
+    schema = copy_schema(parquet.schema_arrow)
+    if schema is None:
+        logger.info(f"{table_name} has columns COPY cannot load, using to_sql")
+        return False
+
+    if rows == 0:
+        logger.info(f"No data found in {table_name}")
+    else:
+        connection = get_warehouse_connection()
+        try:
+            with telemetry.span("warehouse", "load", table_name) as span:
+                span.add("rows", rows)
+                copy_to_warehouse(
+                    connection,
+                    parquet,
+                    schema,
+                    table_name,
+                    key_column=UPSERT_KEYS[table_name] if delta else None,
+                    partition=partition
+                )
+        except Exception as e:
+            logger.error(f"Failed to copy {key} into {table_name}: {e}")
+            raise
+        logger.info(f"Copied {rows} rows into {table_name}")
+    if delta:
+        get_client("s3").delete_object(Bucket=PROCESSED_BUCKET, Key=key)
+    return True
+
 def load_parquet_to_warehouse(key):
-    table_name = key.replace("dim-", "").replace("fact-","").replace(".parquet", "")
+    delta = key.startswith(DELTA_PREFIX)
+    partition = PARTITION_PATTERN.search(key)
+    table_name = key.removeprefix(DELTA_PREFIX).split("/")[0]
+    table_name = table_name.replace("dim-", "").replace("fact-","").replace(".parquet", "")
     table_name = table_name.replace("-", "_")
 
     logger.info(f"Loading file {key} into table {table_name}")
-    
-    s3_path = f"s3://{PROCESSED_BUCKET}/{key}"
-    processed_data = wr.s3.read_parquet(s3_path)
+    try:
+        if COPY_LOAD and copy_parquet_to_warehouse(key, table_name, delta, partition):
+            return
+
+        s3_path = f"s3://{PROCESSED_BUCKET}/{key}"
+        with telemetry.span("warehouse", "s3_get", table_name) as span:
+            processed_data = wr.s3.read_parquet(s3_path)
+            span.add("rows", len(processed_data))
+    except (ClientError, wr.exceptions.NoFilesFound) as e:
+        # Pending deltas are sent with every process run, so a load still
+        # running from an earlier event may have loaded and deleted this one
+        missing = isinstance(e, wr.exceptions.NoFilesFound) or e.response["Error"]["Code"] in ("404", "NoSuchKey")
+        if delta and missing:
+            logger.info(f"{key} was already loaded")
+            return
+        raise
     if processed_data.empty:
             logger.info(f"No data found in {table_name}")
             return
 
-    connection = connect_to_warehouse()
+    connection = get_warehouse_connection()
     
     try:
-        # Load into Postgres in batches
-        wr.postgresql.to_sql(
-            df=processed_data,
-            table=table_name,
-            con=connection,
-            schema="public",        
-            mode="overwrite",     
-            chunksize=1000       
-        )
+        with telemetry.span("warehouse", "load", table_name) as span:
+            span.add("rows", len(processed_data))
+            if delta:
+                upsert_to_warehouse(connection, processed_data, table_name, UPSERT_KEYS[table_name])
+                logger.info(f"Upserted {len(processed_data)} rows into {table_name}")
+                get_client("s3").delete_object(Bucket=PROCESSED_BUCKET, Key=key)
+                return
+            if partition:
+                replace_partition_in_warehouse(connection, processed_data, table_name, partition)
+                logger.info(f"Replaced {partition.group(1)}-{partition.group(2)} of {table_name} with {len(processed_data)} rows")
+                return
+
+            # Load into Postgres in batches
+            wr.postgresql.to_sql(
+                df=processed_data,
+                table=table_name,
+                con=connection,
+                schema="public",        
+                mode="overwrite",     
+                chunksize=1000,
+                dtype=sql_types(processed_data)
+            )
 
         logger.info(f"Loaded {len(processed_data)} rows into {table_name}")
 
@@ -80,7 +407,7 @@ def preview_all_tables():
     """
     Logs the first 10 rows of every table in the 'public' schema of the warehouse.
     """
-    connection = connect_to_warehouse()
+    connection = get_warehouse_connection()
     
     try:
         # Get list of all tables in the public schema
@@ -117,23 +444,36 @@ def preview_all_tables():
     except Exception as e:
         logger.error(f"Failed to preview tables: {e}")
         raise
-    finally:
-        connection.close()
+
+def record_key(record):
+    # The process lambda sends plain keys, S3 notifications send URL encoded
+    # keys, which matters for the '=' in partition paths
+    if isinstance(record, dict):
+        return unquote_plus(record["s3"]["object"]["key"])
+    return record
 
 def lambda_handler(event, context):
     logger.info("Warehouse loader started")
     try:
-        if 'Records' in event:
-            for key in event['Records']:
-                load_parquet_to_warehouse(key)
-        else:
-            # If manually triggered, optionally scan bucket for files
-            s3_client = boto3.client("s3")
-            response = s3_client.list_objects_v2(Bucket=PROCESSED_BUCKET)
-            for obj in response.get('Contents', []):
-                load_parquet_to_warehouse(obj['Key'])
+        with telemetry.span("warehouse", "invocation") as span:
+            if 'Records' in event:
+                for record in event['Records']:
+                    load_parquet_to_warehouse(record_key(record))
+                    span.add("files")
+            else:
+                # If manually triggered, optionally scan bucket for files
+                s3_client = get_client("s3")
+                response = s3_client.list_objects_v2(Bucket=PROCESSED_BUCKET)
+                for obj in response.get('Contents', []):
+                    # Nested keys such as snapshots/ are process stage state, not
+                    # tables, apart from the partitions of partitioned facts and
+                    # deltas still to be loaded
+                    if '/' not in obj['Key'] or PARTITION_PATTERN.search(obj['Key']) or obj['Key'].startswith(DELTA_PREFIX):
+                        load_parquet_to_warehouse(obj['Key'])
+                        span.add("files")
 
-        preview_all_tables()
+            with telemetry.span("warehouse", "preview"):
+                preview_all_tables()
         return {"statusCode": 200, "body": "Load successful"}        
     
     except Exception as e:
@@ -97,6 +97,14 @@ data "aws_iam_policy_document" "s3_ingest_document" {
             "${aws_s3_bucket.ingest_bucket.arn}/*",
         ]
     }
+
+    # Seeds a table's manifest from the existing files, and lets a missing
+    # manifest come back as 404 rather than 403
+    statement {
+        actions = ["s3:ListBucket"]
+
+        resources = ["${aws_s3_bucket.ingest_bucket.arn}"]
+    }
 }
 
 data "aws_iam_policy_document" "s3_ingest_readonly_document" {
@@ -143,6 +151,13 @@ data "aws_iam_policy_document" "s3_process_document" {
 
         resources = ["${aws_s3_bucket.processed_bucket.arn}/*"]
     }
+
+    # Lets a missing snapshot come back as 404 rather than 403
+    statement {
+        actions = ["s3:ListBucket"]
+
+        resources = ["${aws_s3_bucket.processed_bucket.arn}"]
+    }
 }
 
 data "aws_iam_policy_document" "s3_process_readonly_document" {
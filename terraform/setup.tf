@@ -39,9 +39,23 @@ resource "aws_lambda_layer_version" "lambda_layer" {
 # --- INGESTION LAMBDA ---
 
 data "archive_file" "ingest_lambda_zip" {
-    source_file = local.ingest_lambda_script
     output_path = local.ingest_lambda_zip
     type = "zip"
+
+    source {
+        content  = file(local.ingest_lambda_script)
+        filename = "${local.ingest_lambda_file}.py"
+    }
+
+    source {
+        content  = file(local.telemetry_script)
+        filename = "telemetry.py"
+    }
+
+    source {
+        content  = file(local.multipart_script)
+        filename = "multipart.py"
+    }
 }
 
 resource "aws_s3_object" "ingestion_lambda" {
@@ -74,15 +88,35 @@ resource "aws_lambda_function" "ingestion" {
         log_group = aws_cloudwatch_log_group.ingestion_lambda_logs.name
     }
 
+    environment {
+        variables = {
+            INGEST_CONCURRENCY = var.ingest_concurrency
+        }
+    }
+
     timeout = 300
 }
 
 # --- PROCESS LAMBDA ---
 
 data "archive_file" "process_lambda_zip" {
-    source_file = local.process_lambda_script
     output_path = local.process_lambda_zip
     type = "zip"
+
+    source {
+        content  = file(local.process_lambda_script)
+        filename = "${local.process_lambda_file}.py"
+    }
+
+    source {
+        content  = file(local.telemetry_script)
+        filename = "telemetry.py"
+    }
+
+    source {
+        content  = file(local.multipart_script)
+        filename = "multipart.py"
+    }
 }
 
 resource "aws_s3_object" "process_lambda" {
@@ -121,9 +155,18 @@ resource "aws_lambda_function" "processing" {
 # --- WAREHOUSE LAMBDA ---
 
 data "archive_file" "warehouse_lambda_zip" {
-    source_file = local.warehouse_lambda_script
     output_path = local.warehouse_lambda_zip
     type = "zip"
+
+    source {
+        content  = file(local.warehouse_lambda_script)
+        filename = "${local.warehouse_lambda_file}.py"
+    }
+
+    source {
+        content  = file(local.telemetry_script)
+        filename = "telemetry.py"
+    }
 }
 
 resource "aws_s3_object" "warehouse_lambda" {
@@ -12,6 +12,10 @@ locals {
     warehouse_lambda_file   = "warehousing_lambda"
     warehouse_lambda_script = "${path.module}/../src/${local.warehouse_lambda_file}.py"
     warehouse_lambda_zip    = "${path.module}/lambdas/${local.warehouse_lambda_file}.zip"
+
+    # Shared modules, packaged next to each handler that imports them
+    telemetry_script = "${path.module}/../src/telemetry.py"
+    multipart_script = "${path.module}/../src/multipart.py"
 }
 
 variable "python_version" {
@@ -19,5 +23,10 @@ variable "python_version" {
     default = "python3.13"
 }
 
+variable "ingest_concurrency" {
+    type = number
+    default = 4
+}
+
 variable warehouse_username {}
 variable warehouse_password {sensitive = true}
\ No newline at end of file